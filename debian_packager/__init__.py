@@ -1,65 +1,86 @@
+import errno
+import fcntl
+import fnmatch
+import mmap
 import re
 import os
 import jinja2
+import shutil
 import subprocess
+import tempfile
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 
 IGNORE_PATTERNS = [".catkin"]
-
-def is_text_file(path, blocksize=512):
+VENV_PYTHON = "/opt/tailor_venv/bin/python3"
+SYSTEM_PYTHON = "/usr/bin/python3"
+REWRITE_THREADS = 4
+# Bytes sniffed for null bytes to tell binary files apart
+TEXT_SNIFF_SIZE = 512
+# Files at least this large are searched through mmap rather than read
+MMAP_THRESHOLD = 1024 * 1024
+# ioctl cloning a whole file into another one sharing its extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# Devices on which FICLONE isn't supported, so that it's only tried once per filesystem
+_NO_REFLINK_DEVICES: Set[int] = set()
+# Compressors accepted by dpkg-deb -Z
+COMPRESSORS = ("zstd", "xz", "gzip", "none")
+
+
+def reflink(src, dst) -> bool:
     """
-    Rough equivalent of `grep -I`: detect binary files by checking for null bytes.
+    Clone src into dst with a copy-on-write reflink, which shares the data blocks of both files until one is modified.
+    :returns: whether the filesystem supported it, dst doesn't exist otherwise
     """
-    try:
-        with open(path, 'rb') as f:
-            chunk = f.read(blocksize)
-        return b"\0" not in chunk
-    except Exception:
+    device = os.stat(src).st_dev
+    if device in _NO_REFLINK_DEVICES:
         return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV):
+            _NO_REFLINK_DEVICES.add(device)
+            return False
+        raise
+    shutil.copystat(src, dst)
+    return True
 
 
-def replace_in_file(path, replacements):
+def stage_file(src, dst):
     """
-    Safely replace text in a file in-place.
-    `replacements` = [(old, new), ...]
+    copytree copy function staging a file without copying its data when possible: as a reflink if the filesystem
+    supports it, as a hardlink otherwise. Files rewritten by fix_local_paths are copied on write, so that the
+    install tree hardlinked into staging is never modified.
     """
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        content = f.read()
-
-    new_content = content
-    for old, new in replacements:
-        new_content = old.sub(new, new_content)
-
-    if new_content != content:
-        # Preserve mode bits
-        st = os.stat(path)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(new_content)
-        os.chmod(path, st.st_mode)
+    if reflink(src, dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. staging on another filesystem than the install tree
+        shutil.copy2(src, dst)
 
 
-def retarget_symlink(link_path, replacements):
+def retarget(old_target, link_dir, replacements):
     """
-    Apply the same replacements to a symlink's target string and recreate the link if changed.
+    Apply replacements to a symlink target, keeping relative targets relative to link_dir.
     - `replacements` is [(compiled_regex, replacement_str), ...]
     """
-    try:
-        old_target = os.readlink(link_path)  # readlink does not dereference
-    except OSError:
-        return False
-
     new_target = old_target
     for pat, repl in replacements:
         new_target = pat.sub(repl, new_target)
 
     if new_target == old_target:
-        return False  # no change
+        return old_target  # no change
 
     # Preserve relative vs absolute semantics:
-    link_dir = os.path.dirname(link_path)
     # If original target was absolute, keep absolute. If relative, keep relative.
     if not os.path.isabs(old_target) and os.path.isabs(new_target):
         # Convert absolute new_target back to a path relative to the link's directory
@@ -71,6 +92,23 @@ def retarget_symlink(link_path, replacements):
             # If relpath fails (shouldn't), fall back to absolute
             pass
 
+    return new_target
+
+
+def retarget_symlink(link_path, replacements):
+    """
+    Apply the same replacements to a symlink's target string and recreate the link if changed.
+    - `replacements` is [(compiled_regex, replacement_str), ...]
+    """
+    try:
+        old_target = os.readlink(link_path)  # readlink does not dereference
+    except OSError:
+        return False
+
+    new_target = retarget(old_target, os.path.dirname(link_path), replacements)
+    if new_target == old_target:
+        return False  # no change
+
     # Recreate the symlink atomically
     tmp = f"{link_path}.tmp.{os.getpid()}"
     try:
@@ -85,12 +123,201 @@ def retarget_symlink(link_path, replacements):
         raise
 
 
+class LocalPathRewriter:
+    """
+    Rewrites workspace paths into their /opt install location with a single combined regex. Each replacement
+    is an alternative of the regex in its own named group, and the group that matched selects the replacement
+    from a dispatch table, so the result is the same as applying the replacements one after the other.
+    """
+    def __init__(self, replacements: List[Tuple[str, str]], needles: List[str]):
+        """
+        :param replacements: [(pattern, literal replacement), ...], in priority order
+        :param needles: Substrings at least one of which is part of every possible match, used to skip files early
+        """
+        alternation = "|".join(f"(?P<r{i}>{pattern})" for i, (pattern, _) in enumerate(replacements))
+        self.pattern = re.compile(alternation)
+        self.table = {f"r{i}": replacement for i, (_, replacement) in enumerate(replacements)}
+        self.bytes_pattern = re.compile(os.fsencode(alternation))
+        self.bytes_table = {group: os.fsencode(replacement) for group, replacement in self.table.items()}
+        self.needles = [os.fsencode(needle) for needle in needles]
+
+    def replace(self, match: re.Match) -> str:
+        return self.table[str(match.lastgroup)]
+
+    def replace_bytes(self, match: re.Match) -> bytes:
+        return self.bytes_table[str(match.lastgroup)]
+
+    def contains_needle(self, content) -> bool:
+        return any(content.find(needle) != -1 for needle in self.needles)
+
+    def rewritten_content(self, path: str) -> Optional[bytes]:
+        """
+        Read a file and rewrite its workspace paths, reading it only once and skipping binary files like
+        `grep -I` does: those with a null byte in their first TEXT_SNIFF_SIZE bytes.
+        :returns: the rewritten content, or None if the file doesn't change
+        """
+        with open(path, "rb") as f:
+            head = f.read(TEXT_SNIFF_SIZE)
+            if b"\0" in head:
+                return None
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                # Large files are searched without being read into memory, most of them contain no local path
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if not self.contains_needle(mm):
+                        return None
+                    content = mm[:]
+            else:
+                content = head + f.read()
+                if not self.contains_needle(content):
+                    return None
+
+        new_content = self.bytes_pattern.sub(self.replace_bytes, content)
+        if new_content == content:
+            return None
+        return new_content
+
+    def rewrite_file(self, path: str) -> bool:
+        """
+        Rewrite the workspace paths of a text file. The rewritten content replaces the file rather than being
+        written into it.
+        :returns: whether the file was changed
+        """
+        new_content = self.rewritten_content(path)
+        if new_content is None:
+            return False
+
+        # Copy on write: the staged file may be a hardlink to the install tree, which must be left untouched
+        st = os.stat(path)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(new_content)
+            # Preserve mode bits
+            os.chmod(tmp, st.st_mode)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return True
+
+
+def local_path_rewriter(organization: str, release_label: str, distribution: str, install_dir) -> LocalPathRewriter:
+    opt_prefix = f"/opt/{organization}/{release_label}/{distribution}"
+    install_base = re.escape(str(Path(install_dir).parent))
+
+    return LocalPathRewriter(
+        [
+            (rf"{install_base}/[^\r\n/]+/lib\b", f"{opt_prefix}/lib"),
+            (rf"{install_base}/[^\r\n/]+/bin\b", f"{opt_prefix}/bin"),
+            (rf"{install_base}/[^\r\n/]+/etc\b", f"{opt_prefix}/etc"),
+            (rf"{install_base}/[^\r\n/]+/include\b", f"{opt_prefix}/include"),
+            (re.escape(str(install_dir)), opt_prefix),
+            (re.escape(VENV_PYTHON), SYSTEM_PYTHON),
+        ],
+        needles=[str(Path(install_dir).parent), VENV_PYTHON],
+    )
+
+
+def installed_size_kib(size: int) -> int:
+    """Size of a regular file in the Installed-Size unit, rounded up to a whole KiB like dpkg-gencontrol does."""
+    return (size + 1023) // 1024
+
+
+def stage_tree(
+    src,
+    staging_dir,
+    rewriter: Optional[LocalPathRewriter],
+    merge_dir=None,
+    max_workers: int = REWRITE_THREADS
+) -> int:
+    """
+    Stage an install tree for packaging in a single traversal, doing at once what copying it, fix_local_paths and
+    measuring it used to do in separate walks: files are staged with stage_file, .pyc files are left out, symlink
+    targets are rewritten and text files are rewritten across a pool of max_workers threads.
+
+    :param src: Install tree of the package
+    :param staging_dir: Where to stage it. If None, nothing is staged and the tree is measured as DebWriter packages
+        it in place.
+    :param rewriter: Rewriter of the local paths, see local_path_rewriter. None stages and measures the tree as is.
+    :param merge_dir: Merged workspace to also copy the tree into, as is. Files it already has are an error.
+    :returns: the Installed-Size of the staged tree in KiB: regular files rounded up to 1 KiB each, plus 1 KiB for
+        every other filesystem object, as computed by dpkg-gencontrol
+    """
+    installed_size = 0
+    # Pending rewrites or measures of the files with their staged path, if any, and their unrewritten size
+    rewrites: List[Tuple[Future, Optional[str], int]] = []
+
+    def walk(src_dir: str, stage_dir: Optional[str], merge: Optional[str]):
+        nonlocal installed_size
+        if stage_dir is not None:
+            os.makedirs(stage_dir, exist_ok=True)
+        if merge is not None:
+            os.makedirs(merge, exist_ok=True)
+
+        with os.scandir(src_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        for entry in entries:
+            if any(fnmatch.fnmatch(entry.name, pattern) for pattern in IGNORE_PATTERNS):
+                continue
+            staged = os.path.join(stage_dir, entry.name) if stage_dir is not None else None
+            merged = os.path.join(merge, entry.name) if merge is not None else None
+            if merged is not None and os.path.lexists(merged) and not entry.is_dir(follow_symlinks=False):
+                raise FileExistsError(
+                    f"File conflict in {merge_dir}: '{merged}' already provided by a previously packaged source package"
+                )
+
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                if merged is not None:
+                    os.symlink(target, merged)
+                if staged is not None:
+                    if rewriter is not None:
+                        target = retarget(target, stage_dir, [(rewriter.pattern, rewriter.replace)])
+                    os.symlink(target, staged)
+                installed_size += 1
+            elif entry.is_dir():
+                installed_size += 1
+                walk(entry.path, staged, merged)
+            elif entry.is_file():
+                if merged is not None:
+                    shutil.copy2(entry.path, merged)
+                if entry.name.endswith(".pyc"):
+                    continue
+                size = installed_size_kib(entry.stat(follow_symlinks=False).st_size)
+                installed_size += size
+                if staged is not None:
+                    stage_file(entry.path, staged)
+                    if rewriter is not None:
+                        rewrites.append((pool.submit(rewriter.rewrite_file, staged), staged, size))
+                elif rewriter is not None:
+                    # Measure the file the way the in-process writer rewrites it, so that both packaging paths
+                    # get the same Installed-Size and compression profile
+                    rewrites.append((pool.submit(rewriter.rewritten_content, entry.path), None, size))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        walk(str(src), str(staging_dir) if staging_dir is not None else None,
+             str(merge_dir) if merge_dir is not None else None)
+
+        for rewrite, staged, size in rewrites:
+            # Rewriting paths changes the size of the few files it applies to
+            result = rewrite.result()
+            if not result:
+                continue
+            new_size = os.path.getsize(staged) if staged is not None else len(result)
+            installed_size += installed_size_kib(new_size) - size
+
+    return installed_size
+
+
 def fix_local_paths(
     organization: str,
     release_label: str,
     distribution: str,
     staging_dir,
-    install_dir
+    install_dir,
+    max_workers: int = REWRITE_THREADS
 ):
     """
     Replaces the local workspace paths in various package files with the correct
@@ -109,37 +336,34 @@ def fix_local_paths(
     files internally within packages (cmake/venv) use the isolated install
     structure.
 
+    Files are rewritten across a pool of max_workers threads, and only those
+    containing the workspace or venv path are decoded and substituted.
+
     """
-    opt_prefix = f"/opt/{organization}/{release_label}/{distribution}"
-    install_base = Path(install_dir).parent
-
-    REPLACE_PATTERNS = [
-        (re.compile(rf"{install_base}/([^\r\n/]+)/lib\b"), rf"{opt_prefix}/lib"),
-        (re.compile(rf"{install_base}/([^\r\n/]+)/bin\b"), rf"{opt_prefix}/bin"),
-        (re.compile(rf"{install_base}/([^\r\n/]+)/etc\b"), rf"{opt_prefix}/etc"),
-        (re.compile(rf"{install_base}/([^\r\n/]+)/include\b"), rf"{opt_prefix}/include"),
-        (re.compile(rf"{install_dir}"), rf"{opt_prefix}"),
-        (re.compile(r"/opt/tailor_venv/bin/python3"), r"/usr/bin/python3")
-    ]
-    for root, dirs, files in os.walk(staging_dir):
-        for name in files:
-            path = os.path.join(root, name)
-
-            # Handle symlinks first (do NOT follow them)
-            if os.path.islink(path):
-                retarget_symlink(path, REPLACE_PATTERNS)
-                continue
+    rewriter = local_path_rewriter(organization, release_label, distribution, install_dir)
 
-            # 1. Remove .pyc files
-            if name.endswith(".pyc"):
-                os.remove(path)
-                continue
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rewrites = []
+        for root, dirs, files in os.walk(staging_dir):
+            for name in files:
+                path = os.path.join(root, name)
+
+                # Handle symlinks first (do NOT follow them)
+                if os.path.islink(path):
+                    retarget_symlink(path, [(rewriter.pattern, rewriter.replace)])
+                    continue
+
+                # Remove .pyc files
+                if name.endswith(".pyc"):
+                    os.remove(path)
+                    continue
+
+                rewrites.append(pool.submit(rewriter.rewrite_file, path))
+
+        for rewrite in rewrites:
+            rewrite.result()
 
-            # 3. Process only text files
-            if not is_text_file(path):
-                continue
 
-            replace_in_file(path, REPLACE_PATTERNS)
 # Taken from bloom to format the description:
 # https://github.com/ros-infrastructure/bloom/blob/master/bloom/generators/debian/generator.py
 def debianize_string(value):
@@ -173,27 +397,63 @@ def format_description(value):
     return u"{0}.\n {1}".format(parts[0], parts[1].strip())
 
 
-def package_debian(
+@dataclass
+class CompressionProfile:
+    """
+    dpkg-deb compression settings, used for packages whose installed size is at least min_size bytes. These come
+    from the deb_compression list of the recipe, e.g.:
+
+    deb_compression:
+      - {compressor: gzip, level: 1}
+      - {compressor: zstd, level: 19, threads: 0, min_size: 10485760}
+    """
+    compressor: str = "xz"
+    level: Optional[int] = None
+    # Maximum number of compression threads, 0 lets dpkg-deb use every CPU
+    threads: Optional[int] = None
+    min_size: int = 0
+
+    def __post_init__(self):
+        if self.compressor not in COMPRESSORS:
+            raise ValueError(f"Unknown debian compressor {self.compressor}, expected one of {COMPRESSORS}")
+
+    def dpkg_deb_args(self) -> List[str]:
+        args = [f"-Z{self.compressor}"]
+        if self.level is not None:
+            args.append(f"-z{self.level}")
+        if self.threads is not None:
+            args.append(f"--threads-max={self.threads}")
+        return args
+
+
+def select_compression(profiles: List[Dict[str, Any]], size: int) -> Optional[CompressionProfile]:
+    """
+    Pick the compression profile of a package from the recipe deb_compression list.
+    :param profiles: Profile settings, as accepted by CompressionProfile
+    :param size: Installed size of the package, in bytes
+    :returns: the profile with the largest min_size the package reaches, None to keep the dpkg-deb defaults
+    """
+    candidates = [CompressionProfile(**profile) for profile in profiles]
+    candidates = [profile for profile in candidates if size >= profile.min_size]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda profile: profile.min_size)
+
+
+def debian_filename(deb_name: str, deb_version: str, os_version: str) -> str:
+    return f"{deb_name}_{deb_version}_amd64_{os_version}.deb"
+
+
+def render_control(
     deb_name: str,
     deb_version: str,
     description: str,
     maintainers: str,
-    os_version: str,
-    staging_dir: Path,
-    run_depends: List[str] | None = None,
-    build_depends: List[str] | None = None,
-    installed_size: str | None = None,
+    run_depends: List[str],
+    build_depends: List[str],
+    installed_size: int | None = None,
     build_time: float | None = None
-):
-    if run_depends is None:
-        run_depends = []
-    if build_depends is None:
-        build_depends = []
-
-    # Create DEBIAN control directory
-    debian_dir = staging_dir / "DEBIAN"
-    debian_dir.mkdir()
-
+) -> str:
     env = jinja2.Environment(
         loader=jinja2.PackageLoader("tailor_distro", "debian_templates"),
         undefined=jinja2.StrictUndefined,
@@ -213,22 +473,57 @@ def package_debian(
     if len(build_depends) > 0:
         context["build_depends"] = build_depends
 
-    if installed_size:
+    if installed_size is not None:
         context["installed_size"] = installed_size
 
     if build_time:
         context["build_time"] = build_time
 
     control = env.get_template("control.j2")
-    stream = control.stream(**context)
-    stream.dump(str(debian_dir / "control"))
+    return control.render(**context)
+
+
+def package_debian(
+    deb_name: str,
+    deb_version: str,
+    description: str,
+    maintainers: str,
+    os_version: str,
+    staging_dir: Path,
+    run_depends: List[str] | None = None,
+    build_depends: List[str] | None = None,
+    installed_size: int | None = None,
+    build_time: float | None = None,
+    compression: List[Dict[str, Any]] | None = None
+):
+    if run_depends is None:
+        run_depends = []
+    if build_depends is None:
+        build_depends = []
+
+    # Create DEBIAN control directory
+    debian_dir = staging_dir / "DEBIAN"
+    debian_dir.mkdir()
+
+    (debian_dir / "control").write_text(
+        render_control(deb_name, deb_version, description, maintainers, run_depends, build_depends,
+                       installed_size, build_time)
+    )
+
+    compression_args = []
+    if compression:
+        # stage_tree already measured the package, Installed-Size is in KiB
+        profile = select_compression(compression, (installed_size or 0) * 1024)
+        if profile is not None:
+            compression_args = profile.dpkg_deb_args()
 
     p = subprocess.run(
         [
             "dpkg-deb",
+            *compression_args,
             "--build",
             staging_dir,
-            f"{deb_name}_{deb_version}_amd64_{os_version}.deb",
+            debian_filename(deb_name, deb_version, os_version),
         ]
     )
     if p.returncode != 0:
@@ -0,0 +1,279 @@
+import fnmatch
+import gzip
+import io
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional, Set
+
+from . import (
+    IGNORE_PATTERNS,
+    CompressionProfile,
+    LocalPathRewriter,
+    debian_filename,
+    render_control,
+    retarget,
+    select_compression,
+)
+
+DEBIAN_BINARY = b"2.0\n"
+AR_MAGIC = b"!<arch>\n"
+# ar member header: name, mtime, uid, gid, mode, size, terminator
+AR_HEADER = "{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n"
+AR_HEADER_SIZE = 60
+# Default dpkg-deb compression
+DEFAULT_COMPRESSION = CompressionProfile("xz")
+TAR_EXTENSIONS = {
+    "zstd": ".zst",
+    "xz": ".xz",
+    "gzip": ".gz",
+    "none": "",
+}
+
+
+class DataTree(NamedTuple):
+    """A directory packaged under a prefix of the installed system, e.g. an install tree under opt/<org>/..."""
+    source: Path
+    prefix: str
+
+
+def _ar_header(name: str, size: int, mtime: int) -> bytes:
+    return AR_HEADER.format(name, mtime, 0, 0, "100644", size).encode("ascii")
+
+
+def _compressor(fileobj: BinaryIO, profile: CompressionProfile) -> io.BufferedIOBase:
+    """Wrap fileobj in a writer compressing with profile, closing the writer leaves fileobj open."""
+    if profile.compressor == "gzip":
+        return gzip.GzipFile(filename="", fileobj=fileobj, mode="wb", mtime=0,
+                             compresslevel=9 if profile.level is None else profile.level)
+    if profile.compressor == "xz":
+        # Like dpkg-deb, compress with the xz and zstd tools, which unlike the python modules support threads
+        command = ["xz", "-c", f"-{6 if profile.level is None else profile.level}"]
+        if profile.threads is not None:
+            command.append(f"-T{profile.threads}")
+        return _CommandCompressor(command, fileobj)
+    if profile.compressor == "zstd":
+        level = 3 if profile.level is None else profile.level
+        command = ["zstd", "-c", "-q", f"-{level}"]
+        if level > 19:
+            command.append("--ultra")
+        if profile.threads is not None:
+            command.append(f"-T{profile.threads}")
+        return _CommandCompressor(command, fileobj)
+    return _Uncompressed(fileobj)
+
+
+class _Uncompressed(io.BufferedIOBase):
+    def __init__(self, fileobj: BinaryIO):
+        self._fileobj = fileobj
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return self._fileobj.write(data)
+
+
+class _CommandCompressor(io.BufferedIOBase):
+    """Pipes the data written through a compression command into fileobj."""
+    def __init__(self, command: List[str], fileobj: BinaryIO):
+        if shutil.which(command[0]) is None:
+            raise RuntimeError(f"In-process {command[0]} compression of debians requires the {command[0]} tool")
+        self._command = command
+        self._fileobj = fileobj
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert self._process.stdout is not None
+        self._copier = threading.Thread(target=shutil.copyfileobj, args=(self._process.stdout, fileobj))
+        self._copier.start()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        assert self._process.stdin is not None
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        assert self._process.stdin is not None
+        self._process.stdin.close()
+        self._copier.join()
+        if self._process.wait() != 0:
+            raise RuntimeError(f"{' '.join(self._command)} failed with exit code {self._process.returncode}")
+        super().close()
+
+
+class DebWriter:
+    """
+    Writes a .deb the way dpkg-deb --build lays it out: an ar archive holding debian-binary, control.tar and
+    data.tar. The data tarball is streamed into the archive from the source trees, remapped to their install
+    prefix and with local paths rewritten on the way, so that no staging directory is needed.
+    """
+    def __init__(self, path: Path, profile: CompressionProfile = DEFAULT_COMPRESSION,
+                 rewriter: Optional[LocalPathRewriter] = None):
+        """
+        :param path: .deb to write
+        :param profile: Compression of control.tar and data.tar
+        :param rewriter: Rewrites local paths in text files and symlink targets, if given
+        """
+        self.path = path
+        self.profile = profile
+        self.rewriter = rewriter
+        self.mtime = int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+
+    def write(self, control: str, trees: List[DataTree]) -> None:
+        with open(self.path, "wb") as f:
+            f.write(AR_MAGIC)
+            self._write_member(f, "debian-binary", DEBIAN_BINARY)
+            self._write_member(f, self._tar_name("control"), self._control_tar(control))
+
+            # data.tar is streamed, its size is only known once written
+            header_offset = f.tell()
+            f.write(b"\0" * AR_HEADER_SIZE)
+            with _compressor(f, self.profile) as compressed:
+                with tarfile.open(fileobj=compressed, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                    self._add_trees(tar, trees)
+            size = f.tell() - header_offset - AR_HEADER_SIZE
+            if size % 2:
+                f.write(b"\n")
+            f.seek(header_offset)
+            f.write(_ar_header(self._tar_name("data"), size, self.mtime))
+
+    def _tar_name(self, name: str) -> str:
+        return f"{name}.tar{TAR_EXTENSIONS[self.profile.compressor]}"
+
+    def _write_member(self, f: BinaryIO, name: str, data: bytes) -> None:
+        f.write(_ar_header(name, len(data), self.mtime))
+        f.write(data)
+        if len(data) % 2:
+            f.write(b"\n")
+
+    def _tar_info(self, name: str, st: Optional[os.stat_result] = None) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        info.mode = stat.S_IMODE(st.st_mode) if st is not None else 0o755
+        info.mtime = int(st.st_mtime) if st is not None else self.mtime
+        return info
+
+    def _control_tar(self, control: str) -> bytes:
+        buffer = io.BytesIO()
+        with _compressor(buffer, self.profile) as compressed:
+            with tarfile.open(fileobj=compressed, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                directory = self._tar_info("./")
+                directory.type = tarfile.DIRTYPE
+                tar.addfile(directory)
+
+                content = control.encode("utf-8")
+                info = self._tar_info("./control")
+                info.mode = 0o644
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        return buffer.getvalue()
+
+    def _add_trees(self, tar: tarfile.TarFile, trees: List[DataTree]) -> None:
+        added: Set[str] = set()
+
+        def add_directory(name: str, st: Optional[os.stat_result] = None):
+            if name in added:
+                return
+            added.add(name)
+            info = self._tar_info(name, st)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+
+        add_directory("./")
+        for tree in trees:
+            prefix = "."
+            for part in Path(tree.prefix).parts:
+                prefix = f"{prefix}/{part}"
+                add_directory(f"{prefix}/")
+
+            for root, dirs, files in os.walk(tree.source):
+                rel = os.path.relpath(root, tree.source)
+                archive_dir = prefix if rel == "." else f"{prefix}/{Path(rel).as_posix()}"
+                # Symlinks to directories are packaged as symlinks, like copytree(symlinks=True) stages them
+                links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+                dirs[:] = sorted(name for name in dirs if name not in links and not self._ignored(name))
+
+                for name in sorted(files + links):
+                    if self._ignored(name) or name.endswith(".pyc"):
+                        continue
+                    path = os.path.join(root, name)
+                    self._add_file(tar, path, f"{archive_dir}/{name}")
+
+                for name in dirs:
+                    add_directory(f"{archive_dir}/{name}/", os.lstat(os.path.join(root, name)))
+
+    @staticmethod
+    def _ignored(name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in IGNORE_PATTERNS)
+
+    def _add_file(self, tar: tarfile.TarFile, path: str, name: str) -> None:
+        st = os.lstat(path)
+        info = self._tar_info(name, st)
+
+        if stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+            if self.rewriter is not None:
+                # Relative targets are resolved from where the link gets installed
+                install_dir = os.path.dirname(name[1:])
+                info.linkname = retarget(info.linkname, install_dir,
+                                         [(self.rewriter.pattern, self.rewriter.replace)])
+            tar.addfile(info)
+        elif stat.S_ISREG(st.st_mode):
+            content = self.rewriter.rewritten_content(path) if self.rewriter is not None else None
+            if content is not None:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            else:
+                info.size = st.st_size
+                with open(path, "rb") as f:
+                    tar.addfile(info, f)
+
+
+def stream_package_debian(
+    deb_name: str,
+    deb_version: str,
+    description: str,
+    maintainers: str,
+    os_version: str,
+    trees: List[DataTree],
+    rewriter: Optional[LocalPathRewriter] = None,
+    run_depends: List[str] | None = None,
+    build_depends: List[str] | None = None,
+    installed_size: int | None = None,
+    build_time: float | None = None,
+    compression: List[Dict[str, Any]] | None = None
+) -> Path:
+    """
+    In-process equivalent of package_debian, packaging trees in place rather than a staging directory.
+    :param trees: Directories to package and their install prefix, none for a metapackage
+    :param rewriter: Local path rewriter, applied to the packaged files like fix_local_paths does
+    :returns: path of the written debian
+    """
+    profile = None
+    if compression:
+        profile = select_compression(compression, (installed_size or 0) * 1024)
+
+    control = render_control(deb_name, deb_version, description, maintainers, run_depends or [],
+                             build_depends or [], installed_size, build_time)
+
+    path = Path(debian_filename(deb_name, deb_version, os_version))
+    try:
+        DebWriter(path, profile or DEFAULT_COMPRESSION, rewriter).write(control, trees)
+    except Exception:
+        print(f"Failed to package {deb_name}")
+        print(control)
+        path.unlink(missing_ok=True)
+        raise
+    return path
@@ -1,6 +1,4 @@
-import os
 import shutil
-import math
 import time
 
 from pathlib import Path
@@ -13,40 +11,17 @@ from colcon_core.verb.build import BuildVerb
 
 from tailor_distro.blossom import Graph
 
-from . import fix_local_paths, package_debian, environment_debian_info
+from . import local_path_rewriter, package_debian, environment_debian_info, stage_tree
+from .deb_writer import DataTree, stream_package_debian
 
 PACKAGING_THREADS = 4
-IGNORE_PATTERNS = [".catkin"]
-
-
-def size2str(size: int) -> str:
-    if size == 0:
-        return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB")
-    i = int(math.floor(math.log(size, 1024)))
-    p = math.pow(1024, i)
-    s = round(size / p, 2)
-    return f"{s} {size_name[i]}"
-
-
-def calculate_size(path: str) -> str:
-    def _calculate_size(path: str) -> int:
-        total_size = 0
-        for entry in os.scandir(path):
-            if entry.is_file():
-                total_size += entry.stat().st_size
-            elif entry.is_dir():
-                total_size += _calculate_size(entry.path)
-
-        return total_size
-
-    return size2str(_calculate_size(path))
 
 
 class PackagingTaskWrapper:
     """Wraps a build task to submit debian packaging to a thread pool after a successful build."""
 
-    def __init__(self, build_task, graph, ros_version, optinstall, packaging_executor, futures, packaging_failed):
+    def __init__(self, build_task, graph, ros_version, optinstall, packaging_executor, futures, packaging_failed,
+                 in_process=False):
         self._build_task = build_task
         self._graph = graph
         self._ros_version = ros_version
@@ -54,6 +29,7 @@ class PackagingTaskWrapper:
         self._packaging_executor = packaging_executor
         self._futures = futures
         self._packaging_failed = packaging_failed
+        self._in_process = in_process
 
     def set_context(self, *, context):
         self._build_task.set_context(context=context)
@@ -85,84 +61,31 @@ class PackagingTaskWrapper:
                 name, path,
                 self._graph, self._ros_version, self._optinstall,
                 self._packaging_failed,
-                duration
+                duration,
+                self._in_process
             )
         )
 
         return 0
 
 
-def _package_debian_worker(name, path, graph, ros_version, optinstall, packaging_failed, build_time):
+def _package_debian_worker(name, path, graph, ros_version, optinstall, packaging_failed, build_time, in_process=False):
     """Runs in a background thread to package a single .deb."""
     try:
-        _do_package_debian(name, path, graph, ros_version, optinstall, build_time)
+        _do_package_debian(name, path, graph, ros_version, optinstall, build_time, in_process)
     except Exception:
         print(f"Packaging FAILED for {name}")
         packaging_failed.set()
         raise
 
 
-def _copy_no_overwrite(src, dst):
-    if os.path.exists(dst):
-        raise FileExistsError(
-            f"File conflict in optinstall: '{dst}' already provided by a previously packaged source package"
-        )
-    shutil.copy2(src, dst)
-
-
-def _do_package_debian(name, path, graph, ros_version, optinstall, build_time):
-    """Core packaging logic for a single .deb."""
+def _do_package_debian(name, path, graph, ros_version, optinstall, build_time, in_process=False):
+    """
+    Core packaging logic for a single .deb. With in_process, the .deb is written straight from the install
+    tree by the in-process writer instead of staging a copy for dpkg-deb.
+    """
     print(f"Packaging {name} as a debian from path {path}")
 
-    # Copy installed files to the merged workspace (optinstall).
-    # This is required as the non --merge-install build isolates
-    # packages, which in turn requires 700+ individual paths to be
-    # defined in the environment. By copying here we're effectively
-    # merging all the packages after the fact, which allows us to
-    # define a single path to the workspace
-    # (ROS_PACKAGE_PATH/PYTHONPATH/LD_LIBRARY_PATH/etc)
-    shutil.copytree(
-        path,
-        optinstall,
-        dirs_exist_ok=True,
-        ignore=shutil.ignore_patterns(*IGNORE_PATTERNS),
-        symlinks=True,
-        copy_function=_copy_no_overwrite,
-    )
-
-    # Create packaging folder structure
-    staging_dir = Path("staging") / name
-
-    # Clean old staging
-    shutil.rmtree(staging_dir, ignore_errors=True)
-
-    pkg_staging = (
-        staging_dir
-        / "opt"
-        / graph.organization
-        / graph.release_label
-        / ros_version
-    )
-    pkg_staging.mkdir(parents=True)
-
-    shutil.copytree(
-        path,
-        pkg_staging,
-        dirs_exist_ok=True,
-        ignore=shutil.ignore_patterns(*IGNORE_PATTERNS),
-        symlinks=True
-    )
-
-    installed_size = calculate_size(str(staging_dir / "opt"))
-
-    # Replace local paths with the correct /opt install location
-    fix_local_paths(
-        graph.organization,
-        graph.release_label,
-        ros_version,
-        staging_dir, path
-    )
-
     package = graph.packages[ros_version][name]
 
     # APT dependency names can be used as-is, but source dependencies
@@ -205,6 +128,53 @@ def _do_package_debian(name, path, graph, ros_version, optinstall, build_time):
     deb_name = package.debian_name(*graph.debian_info)
     deb_version = package.debian_version(graph.build_date)
 
+    rewriter = local_path_rewriter(graph.organization, graph.release_label, ros_version, path)
+
+    # Copy installed files to the merged workspace (optinstall).
+    # This is required as the non --merge-install build isolates
+    # packages, which in turn requires 700+ individual paths to be
+    # defined in the environment. By copying here we're effectively
+    # merging all the packages after the fact, which allows us to
+    # define a single path to the workspace
+    # (ROS_PACKAGE_PATH/PYTHONPATH/LD_LIBRARY_PATH/etc)
+    if in_process:
+        # The in-process writer streams the install tree itself, only merge and measure it
+        installed_size = stage_tree(path, None, rewriter, merge_dir=optinstall)
+
+        stream_package_debian(
+            deb_name,
+            deb_version,
+            package.description,
+            package.maintainers,
+            graph.os_version,
+            [DataTree(path, f"opt/{graph.organization}/{graph.release_label}/{ros_version}")],
+            rewriter,
+            build_depends=build_depends,
+            run_depends=run_depends,
+            installed_size=installed_size,
+            build_time=build_time,
+            compression=graph.deb_compression
+        )
+        return
+
+    # Create packaging folder structure
+    staging_dir = Path("staging") / name
+
+    # Clean old staging
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    pkg_staging = (
+        staging_dir
+        / "opt"
+        / graph.organization
+        / graph.release_label
+        / ros_version
+    )
+
+    # Merge, stage and measure the install tree in a single pass. Files are staged as
+    # reflinks or hardlinks, and local paths replaced with the correct /opt install location.
+    installed_size = stage_tree(path, pkg_staging, rewriter, merge_dir=optinstall)
+
     package_debian(
         deb_name,
         deb_version,
@@ -215,7 +185,8 @@ def _do_package_debian(name, path, graph, ros_version, optinstall, build_time):
         build_depends=build_depends,
         run_depends=run_depends,
         installed_size=installed_size,
-        build_time=build_time
+        build_time=build_time,
+        compression=graph.deb_compression
     )
 
 
@@ -237,11 +208,16 @@ class DebianPackagerVerb(BuildVerb):
             '--ros-version', required=True,
             help='The ROS distribution version to package.'
         )
+        group.add_argument(
+            '--in-process-deb', action='store_true',
+            help='Write debians in-process straight from the install tree, without staging them for dpkg-deb.'
+        )
 
     def main(self, *, context):
         args = context.args
         self._graph = Graph.from_yaml(args.graph)
         self._ros_version = args.ros_version
+        self._in_process = args.in_process_deb
 
         # Set up merged optinstall directory
         optinstall_root = Path("optinstall")
@@ -288,6 +264,7 @@ class DebianPackagerVerb(BuildVerb):
             job.task = PackagingTaskWrapper(
                 job.task, self._graph, self._ros_version, self._optinstall,
                 self._packaging_executor, self._futures, self._packaging_failed,
+                in_process=self._in_process,
             )
 
         return jobs, unselected
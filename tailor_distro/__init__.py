@@ -20,7 +20,7 @@ from typing import Iterable, List, Optional
 
 
 SCHEME_S3 = "s3://"
-ARCH_LIST = ["amd64", "armhf", "i386"]
+ARCH_LIST = ["amd64", "arm64", "armhf", "i386"]
 S3_CHUNK_SIZE = 1000
 DEB_S3_BIN = "deb-s3"
 
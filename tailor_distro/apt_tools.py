@@ -1,10 +1,17 @@
+import fcntl
+import hashlib
+import json
+import os
 import tempfile
 import subprocess
 import apt
 import shutil
+import time
 
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple
 from pathlib import Path
+from urllib import request, error
 
 APT_CONFIG_TEMPLATE = """
 Dir "{root}";
@@ -22,30 +29,283 @@ APT::Architecture "{arch}";
 Acquire::AllowInsecureRepositories "true";
 """
 
+# Sandboxes are kept here between runs so the package indexes only need to be downloaded when
+# the remote repository actually changes.
+APT_SANDBOX_CACHE_ENV = "TAILOR_APT_SANDBOX_CACHE"
+DEFAULT_APT_SANDBOX_CACHE = Path.home() / ".cache" / "tailor-distro" / "aptsandbox"
+
+# Cached sandboxes that haven't been used for this long are removed when a new sandbox is opened.
+SANDBOX_MAX_AGE_SECONDS = 14 * 24 * 60 * 60
+
+FINGERPRINTS_FILE = "release-fingerprints.json"
+RELEASE_FILES = ["InRelease", "Release"]
+HEAD_TIMEOUT_SEC = 30
+
+# Marker used for a Release file that doesn't exist (yet). A repository appearing later changes
+# the fingerprint and triggers a refresh.
+MISSING_RELEASE = "missing"
+
+# apt-transport-s3 credentials file, and the settings it holds
+S3_AUTH_FILE = "s3auth.conf"
+S3_AUTH_KEYS = ("AccessKeyId", "SecretAccessKey", "Token", "Region")
+
+# Priorities of the packages every Ubuntu base image already has installed
+BASE_PRIORITIES = ("required",)
+
+
+def release_urls(source: str) -> List[str]:
+    """
+    Get the candidate Release file URLs for a sources.list entry.
+    :param source: A single 'deb [options] uri suite [components...]' line
+    :returns: URLs of the InRelease and Release files, in the order apt tries them
+    """
+    parts = source.split()
+    if parts and parts[0] == "deb":
+        parts = parts[1:]
+    if parts and parts[0].startswith("["):
+        while parts and not parts[0].endswith("]"):
+            parts = parts[1:]
+        parts = parts[1:]
+    if len(parts) < 2:
+        raise ValueError(f"Unable to parse apt source: {source}")
+
+    uri, suite = parts[0].rstrip("/"), parts[1]
+    if suite.endswith("/"):
+        # Flat repository, the Release files live directly in the suite path
+        base = f"{uri}/{suite.strip('/')}" if suite.strip("/") else uri
+    else:
+        base = f"{uri}/dists/{suite}"
+    return [f"{base}/{name}" for name in RELEASE_FILES]
+
+
+def s3_credentials(local_configs: List[Path]) -> Dict[str, str]:
+    """
+    Read the credentials apt-transport-s3 uses from the s3auth.conf among the local apt configs, so that
+    Release files on S3 are fingerprinted with the same credentials apt downloads them with.
+    :param local_configs: Local configuration files or directories copied into the sandbox
+    :returns: AccessKeyId, SecretAccessKey, Token and Region settings that are set
+    """
+    credentials = {}
+    for local_path in local_configs:
+        paths = local_path.rglob(S3_AUTH_FILE) if local_path.is_dir() else [local_path]
+        for path in paths:
+            if path.name != S3_AUTH_FILE or not path.is_file():
+                continue
+            for line in path.read_text().splitlines():
+                key, sep, value = line.partition("=")
+                value = value.strip().strip("'\"")
+                if sep and key.strip() in S3_AUTH_KEYS and value:
+                    credentials[key.strip()] = value
+    return credentials
+
+
+def _s3_fingerprint(url: str, credentials: Dict[str, str]) -> Optional[str]:
+    import boto3  # type: ignore[import-not-found]
+    import botocore.exceptions  # type: ignore[import-not-found]
+
+    bucket, _, key = url[len("s3://"):].partition("/")
+    try:
+        # Sessions aren't thread-safe and sandboxes are opened concurrently, so every lookup gets its own
+        session = boto3.session.Session(
+            aws_access_key_id=credentials.get("AccessKeyId"),
+            aws_secret_access_key=credentials.get("SecretAccessKey"),
+            aws_session_token=credentials.get("Token"),
+            region_name=credentials.get("Region"),
+        )
+        response = session.client("s3").head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return MISSING_RELEASE
+        return None
+    except botocore.exceptions.BotoCoreError:
+        # e.g. no credentials, the indexes are refreshed instead
+        return None
+    return response.get("ETag")
+
+
+def _http_fingerprint(url: str) -> Optional[str]:
+    try:
+        with request.urlopen(request.Request(url, method="HEAD"), timeout=HEAD_TIMEOUT_SEC) as response:
+            headers = response.headers
+    except error.HTTPError as e:
+        return MISSING_RELEASE if e.code == 404 else None
+    except (error.URLError, OSError):
+        return None
+
+    if headers.get("ETag"):
+        return headers["ETag"]
+    if headers.get("Last-Modified"):
+        return f"{headers['Last-Modified']}/{headers.get('Content-Length')}"
+    return None
+
+
+def _file_fingerprint(url: str) -> Optional[str]:
+    path = Path(request.url2pathname(url[len("file://"):]))
+    if not path.exists():
+        return MISSING_RELEASE
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def release_fingerprint(source: str, s3_auth: Optional[Dict[str, str]] = None) -> Optional[str]:
+    """
+    Get a cheap fingerprint of the Release file published for a sources.list entry, without
+    downloading any package indexes.
+    :param source: A single sources.list entry
+    :param s3_auth: Credentials for s3:// sources, see s3_credentials
+    :returns: A string that changes whenever the Release file changes, or None when the
+              fingerprint can't be determined and the indexes must be refreshed.
+    """
+    for url in release_urls(source):
+        if url.startswith("s3://"):
+            fingerprint = _s3_fingerprint(url, s3_auth or {})
+        elif url.startswith(("http://", "https://")):
+            fingerprint = _http_fingerprint(url)
+        elif url.startswith("file://"):
+            fingerprint = _file_fingerprint(url)
+        else:
+            fingerprint = None
+
+        if fingerprint is None:
+            return None
+        if fingerprint != MISSING_RELEASE:
+            return f"{url}:{fingerprint}"
+
+    return MISSING_RELEASE
+
+
+def _hash_path(digest, path: Path):
+    if path.is_dir():
+        for child in sorted(path.rglob("*")):
+            if child.is_file():
+                digest.update(str(child.relative_to(path)).encode())
+                digest.update(child.read_bytes())
+    elif path.is_file():
+        digest.update(path.read_bytes())
+
+
+def sandbox_key(sources: List[str], local_configs: List[Path], arch: str) -> str:
+    """Compute the cache key of a sandbox from its sources, local configuration and architecture."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({"sources": sources, "arch": arch}, sort_keys=True).encode())
+    for local_path in local_configs:
+        digest.update(str(local_path).encode())
+        _hash_path(digest, local_path)
+    return digest.hexdigest()[:16]
+
+
+def _holds_lock(lock_file: TextIO, lock_path: Path) -> bool:
+    """Check that a locked file is still the lock file of its path, rather than one unlinked by pruning."""
+    try:
+        return os.fstat(lock_file.fileno()).st_ino == lock_path.stat().st_ino
+    except FileNotFoundError:
+        return False
+
 
 class AptSandbox:
-    def __init__(self, sources: List[str], local_configs: List[Path] = []):
-        self.root = Path(tempfile.mkdtemp(prefix="aptsandbox-"))
+    """
+    An isolated apt root used to query repositories without touching the host's apt state.
+
+    Sandboxes are cached in a persistent directory keyed by their sources and local configs, so
+    repeated runs on the same node reuse the package indexes. `apt-get update` only runs when
+    the fingerprint of a remote Release/InRelease file changed since the last refresh.
+
+    The sandbox should be closed once it's no longer needed, preferably by using it as a
+    context manager. Non-persistent sandboxes are deleted on close.
+    """
+
+    def __init__(
+        self,
+        sources: List[str],
+        local_configs: List[Path] = [],
+        arch: str = "amd64",
+        cache_dir: Optional[Path] = None,
+        persistent: bool = True,
+    ):
+        for local_path in local_configs:
+            if not local_path.is_absolute():
+                raise Exception(f"Path for local configs must be absolute: {local_path}")
+            if not local_path.exists():
+                raise Exception(f"Path does not exist: {local_path}")
+
+        self.sources = sources
+        self.arch = arch
+        self.persistent = persistent
+        self.s3_auth = s3_credentials(local_configs)
+        self._lock_file: Optional[TextIO] = None
+
+        if persistent:
+            if cache_dir is None:
+                cache_dir = Path(os.environ.get(APT_SANDBOX_CACHE_ENV, DEFAULT_APT_SANDBOX_CACHE))
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._prune_stale_sandboxes(cache_dir)
+
+            key = sandbox_key(sources, local_configs, arch)
+            self.root = cache_dir / f"aptsandbox-{key}"
+            self._lock(cache_dir / f"aptsandbox-{key}.lock")
+        else:
+            self.root = Path(tempfile.mkdtemp(prefix="aptsandbox-"))
+
+        self._setup(local_configs)
 
-        for path in ["etc/apt", "etc/apt/preferences.d", "etc/apt/trusted.gpg.d", "var/lib/apt/lists", "var/cache/apt/archives", "var/cache/apt/archives/partial"]:
+        if not persistent:
+            self.update()
+            return
+
+        fingerprints = self._release_fingerprints()
+        if self._needs_update(fingerprints):
+            self.update(fingerprints)
+        else:
+            print(f"Apt indexes in {self.root} are up to date, skipping apt update")
+
+        # Mark the sandbox as recently used so it survives pruning
+        os.utime(self.root)
+
+    def _lock(self, lock_path: Path):
+        while True:
+            lock_file = open(lock_path, "w")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if _holds_lock(lock_file, lock_path):
+                break
+            # The sandbox was pruned while we waited for its lock, lock the new file instead
+            lock_file.close()
+        self._lock_file = lock_file
+
+    def _prune_stale_sandboxes(self, cache_dir: Path):
+        now = time.time()
+        for sandbox in cache_dir.glob("aptsandbox-*"):
+            if not sandbox.is_dir() or now - sandbox.stat().st_mtime < SANDBOX_MAX_AGE_SECONDS:
+                continue
+            lock_path = sandbox.with_name(sandbox.name + ".lock")
+            with open(lock_path, "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # In use by another process
+                    continue
+                if not _holds_lock(lock, lock_path) or not sandbox.is_dir():
+                    # Pruned by another process in the meantime
+                    continue
+                print(f"Removing stale apt sandbox {sandbox}")
+                shutil.rmtree(sandbox, ignore_errors=True)
+                # Unlinked while still locked, so that processes waiting on it retry with a new lock file
+                lock_path.unlink(missing_ok=True)
+
+    def _setup(self, local_configs: List[Path]):
+        for path in ["etc/apt", "etc/apt/preferences.d", "etc/apt/trusted.gpg.d", "var/lib/apt/lists",
+                     "var/cache/apt/archives", "var/cache/apt/archives/partial"]:
             (self.root / path).mkdir(parents=True, exist_ok=True)
 
         self._copy_host_apt_trust()
 
         (self.root / "etc/apt/sources.list").write_text(
-            "\n".join(sources) + "\n"
+            "\n".join(self.sources) + "\n"
         )
 
         (self.root / "etc/apt/apt.conf").write_text(
-            APT_CONFIG_TEMPLATE.format(root=self.root, arch="amd64")
+            APT_CONFIG_TEMPLATE.format(root=self.root, arch=self.arch)
         )
 
         for local_path in local_configs:
-            if not local_path.is_absolute():
-                raise Exception(f"Path for local configs must be absolute: {local_path}")
-            if not local_path.exists():
-                raise Exception(f"Path does not exist: {local_path}")
-
             sandbox_path = self.root / local_path.relative_to(Path("/"))
 
             if local_path.is_dir():
@@ -61,7 +321,28 @@ class AptSandbox:
         dpkg_dir.mkdir(parents=True, exist_ok=True)
         (dpkg_dir / "status").touch()
 
-        # Run apt-get update (sandboxed)
+    def _release_fingerprints(self) -> Dict[str, Optional[str]]:
+        return {source: release_fingerprint(source, self.s3_auth) for source in self.sources}
+
+    def _needs_update(self, fingerprints: Dict[str, Optional[str]]) -> bool:
+        if None in fingerprints.values():
+            return True
+
+        fingerprints_path = self.root / FINGERPRINTS_FILE
+        if not fingerprints_path.exists():
+            return True
+
+        return json.loads(fingerprints_path.read_text()) != fingerprints
+
+    def update(self, fingerprints: Optional[Dict[str, Optional[str]]] = None):
+        """
+        Run apt-get update in the sandbox.
+        :param fingerprints: Release fingerprints to record after a successful update, so later
+                             runs can skip the update if nothing changed.
+        """
+        fingerprints_path = self.root / FINGERPRINTS_FILE
+        fingerprints_path.unlink(missing_ok=True)
+
         try:
             subprocess.run(
                 [
@@ -78,6 +359,14 @@ class AptSandbox:
             )
         except subprocess.CalledProcessError:
             print("Could not run apt update, repo may not exist yet")
+            # Don't let a cached sandbox keep serving the indexes of an earlier update
+            lists = self.root / "var/lib/apt/lists"
+            shutil.rmtree(lists, ignore_errors=True)
+            lists.mkdir(parents=True)
+            return
+
+        if fingerprints:
+            fingerprints_path.write_text(json.dumps(fingerprints, indent=2, sort_keys=True))
 
     def _copy_host_apt_trust(self):
         trusted_keyring = Path("/etc/apt/trusted.gpg")
@@ -91,3 +380,98 @@ class AptSandbox:
     @property
     def cache(self):
         return apt.Cache(rootdir=str(self.root))
+
+    def resolve(self, packages: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Resolve the full installation closure of a set of packages against the sandbox indexes.
+        All packages are marked in a single apt session, so shared dependencies are only resolved
+        once and the result is a consistent install set. Essential and required packages, which make
+        up the base system of the image the closure gets installed in, are left out of it.
+        :param packages: Names of the packages to install
+        :returns: Tuple of (mapping of every package in the closure to its candidate version,
+                  list of requested packages that couldn't be resolved)
+        """
+        cache = self.cache
+        unresolved = []
+
+        with cache.actiongroup():
+            # The parent image already ships the base system, at versions the sandbox doesn't know. Mark it
+            # first so that neither it nor what it depends on ends up pinned in the closure.
+            for pkg in cache:
+                if pkg.candidate is not None and (pkg.essential or pkg.candidate.priority in BASE_PRIORITIES):
+                    pkg.mark_install(auto_fix=False)
+            base = {pkg.name for pkg in cache.get_changes()}
+
+            for name in sorted(set(packages)):
+                if name not in cache and cache.is_virtual_package(name):
+                    providers = cache.get_providing_packages(name)
+                    if providers:
+                        name = sorted(providers, key=lambda p: p.name)[0].name
+
+                if name not in cache or cache[name].candidate is None:
+                    unresolved.append(name)
+                    continue
+
+                try:
+                    cache[name].mark_install()
+                except SystemError as e:
+                    print(f"Unable to resolve {name}: {e}")
+                    unresolved.append(name)
+
+        closure = {
+            pkg.name: pkg.candidate.version
+            for pkg in cache.get_changes()
+            if pkg.marked_install and pkg.name not in base
+        }
+        return closure, unresolved
+
+    def close(self):
+        """Release the sandbox. Non-persistent sandboxes are deleted."""
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+        if not self.persistent:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sandboxes(
+    sources: Dict[str, List[str]],
+    local_configs: List[Path] = [],
+    cache_dir: Optional[Path] = None,
+) -> Dict[str, AptSandbox]:
+    """
+    Open one sandbox per architecture, fetching the package indexes of all architectures
+    concurrently so that adding an architecture doesn't add another sequential index download.
+    :param sources: Mapping of architecture to the sources.list entries for that architecture
+    :param local_configs: Local configuration files copied into every sandbox
+    :param cache_dir: Optional override of the sandbox cache directory
+    :returns: Mapping of architecture to its sandbox
+    """
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as pool:
+        futures = {
+            arch: pool.submit(AptSandbox, arch_sources, local_configs=local_configs, arch=arch, cache_dir=cache_dir)
+            for arch, arch_sources in sources.items()
+        }
+
+    sandboxes = {}
+    errors = []
+    for arch, future in futures.items():
+        try:
+            sandboxes[arch] = future.result()
+        except Exception as e:
+            errors.append(e)
+
+    if errors:
+        for sandbox in sandboxes.values():
+            sandbox.close()
+        raise errors[0]
+
+    return sandboxes
@@ -0,0 +1,85 @@
+import argparse
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import List
+
+import click
+
+from debian_packager import CompressionProfile, stage_tree
+
+# Profiles compared when none are given: the dpkg-deb default, then fast and dense settings of each compressor
+DEFAULT_PROFILES = [
+    CompressionProfile("xz"),
+    CompressionProfile("xz", threads=0),
+    CompressionProfile("zstd", level=3, threads=0),
+    CompressionProfile("zstd", level=19, threads=0),
+    CompressionProfile("gzip", level=1),
+    CompressionProfile("gzip", level=9),
+]
+
+
+def parse_profile(value: str) -> CompressionProfile:
+    """Parse a compressor[:level[:threads]] profile, e.g. zstd:19:0."""
+    compressor, *settings = value.split(":")
+    level = int(settings[0]) if len(settings) > 0 and settings[0] else None
+    threads = int(settings[1]) if len(settings) > 1 and settings[1] else None
+    try:
+        return CompressionProfile(compressor, level=level, threads=threads)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def profile_name(profile: CompressionProfile) -> str:
+    return " ".join(profile.dpkg_deb_args())
+
+
+def benchmark_deb(deb: pathlib.Path, profiles: List[CompressionProfile]) -> None:
+    """
+    Repack an existing debian with each compression profile and report how long it took and how large it got.
+    :param deb: Debian to benchmark, usually one of the largest of a build
+    :param profiles: Compression profiles to compare
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = pathlib.Path(tmp) / "tree"
+        subprocess.run(["dpkg-deb", "--raw-extract", str(deb), str(tree)], check=True)
+        # Measured like packaging does, Installed-Size is in KiB
+        size = stage_tree(tree, None, None) * 1024
+        click.echo(f"{deb.name}: {size / 1024 / 1024:.1f} MiB staged, {deb.stat().st_size / 1024 / 1024:.1f} MiB built")
+
+        for profile in profiles:
+            output = pathlib.Path(tmp) / "repacked.deb"
+            start = time.monotonic()
+            subprocess.run(
+                ["dpkg-deb", *profile.dpkg_deb_args(), "--build", str(tree), str(output)],
+                check=True, stdout=subprocess.DEVNULL,
+            )
+            duration = time.monotonic() - start
+            packed = output.stat().st_size
+            click.echo(
+                f"  {profile_name(profile):<32} {duration:8.2f}s {packed / 1024 / 1024:10.1f} MiB "
+                f"{packed / max(size, 1):8.1%}"
+            )
+            output.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dpkg-deb compression time against debian size")
+    parser.add_argument("debs", type=pathlib.Path, nargs="+", help="Debians to repack")
+    parser.add_argument("--profile", type=parse_profile, action="append", dest="profiles",
+                        help="Compression profile as compressor[:level[:threads]], may be repeated "
+                             "(default: a set of xz, zstd and gzip profiles)")
+    args = parser.parse_args()
+
+    profiles = args.profiles or DEFAULT_PROFILES
+    # Largest debians first, they are the ones compression settings matter for
+    for deb in sorted(args.debs, key=lambda deb: deb.stat().st_size, reverse=True):
+        benchmark_deb(deb, profiles)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,13 +18,15 @@ from typing import (
     TypeVar
 )
 
-from catkin_pkg.topological_order import topological_order
+from catkin_pkg.topological_order import topological_order, topological_order_packages
 from catkin_pkg.package import Package
 from rosdep2.sources_list import SourcesListLoader
 from rosdep2.lookup import RosdepLookup, ResolutionError
 from rosdep2.rospkg_loader import DEFAULT_VIEW_KEY
 
-from .apt_tools import AptSandbox
+from . import ARCH_LIST
+from .apt_tools import open_sandboxes
+from .package_index import package_index_path, packages_from_index
 
 logger = logging.getLogger("blossom")
 
@@ -62,6 +64,7 @@ class GraphPackage:
     reverse_depends: List[str] = field(default_factory=list)
     ros2_reverse_depends: List[str] = field(default_factory=list)
     apt_candidate_version: str | None = None
+    apt_candidate_versions: Dict[str, str] = field(default_factory=dict)
     description: str | None = None
     maintainers: str | None = None
 
@@ -177,6 +180,9 @@ class Graph:
     init_apt: bool = True
     merge_dependencies: bool = True
     package_release_label: str | None = None
+    architectures: List[str] = field(default_factory=lambda: ["amd64"])
+    # dpkg-deb compression profiles, see debian_packager.CompressionProfile
+    deb_compression: List[Dict[str, Any]] = field(default_factory=list)
 
     def __hash__(self):
         return hash(self.name)
@@ -283,21 +289,26 @@ class Graph:
             maintainers=" ".join([str(p) for p in package.maintainers]),
         )
 
-        # Check if there is an APT candidate for the source package
-        pkg.apt_candidate_version = self._get_apt_candidate_version(pkg)
+        # Check if there are APT candidates for the source package. The candidate of the primary
+        # (first) architecture is the one used to decide whether the package needs a rebuild.
+        for arch in self.architectures:
+            version = self._get_apt_candidate_version(pkg, arch)
+            if version:
+                pkg.apt_candidate_versions[arch] = version
+        pkg.apt_candidate_version = pkg.apt_candidate_versions.get(self.architectures[0])
 
         self.packages[ros_distro][package.name] = pkg
 
         # Calculate reverse depends afterwards (in finalize())
 
-    def _get_apt_candidate_version(self, package: GraphPackage) -> str | None:
+    def _get_apt_candidate_version(self, package: GraphPackage, arch: str) -> str | None:
         if not self.init_apt:
             return None
 
         deb_name = package.debian_name(self.organization, self.package_name_release_label)
 
         try:
-            deb_pkg = self._apt_cache[deb_name]
+            deb_pkg = self._apt_caches[arch][deb_name]
         except KeyError:
             return None
 
@@ -424,6 +435,54 @@ class Graph:
 
         return list(apt_deps)
 
+    def flavour_apt_depends(self, flavour_data: Dict[str, Any]) -> List[str]:
+        """
+        Collect the apt dependencies needed by all root packages of a recipe flavour. Distributions
+        without root packages include every package of the distribution.
+        """
+        apt_deps = set()
+        for ros_dist, dist_data in flavour_data["distributions"].items():
+            root_packages = dist_data["root_packages"] or self.packages[ros_dist].keys()
+
+            for pkg_name in root_packages:
+                apt_deps.update(self.all_apt_depends(pkg_name, ros_dist))
+
+        return sorted(apt_deps)
+
+    def lockfile_name(self, flavour: str, arch: str) -> str:
+        return f"{flavour}-{self.os_version}-{self.release_label}-{arch}.lock"
+
+    def write_lockfiles(self, flavours: Dict[str, Any], path: Path):
+        """
+        Resolve the full apt closure of each flavour in the apt sandbox and write it as a lockfile
+        of package=version lines, one per architecture. Dependencies which can't be resolved would
+        leave the install unpinned, so they fail graph generation instead and no lockfile is written.
+        """
+        if not self._apt_sandboxes:
+            raise Exception("Lockfiles can only be written for graphs created with an apt sandbox")
+
+        lockfiles: Dict[Path, List[str]] = {}
+        unresolved: List[str] = []
+
+        for flavour, flavour_data in flavours.items():
+            apt_deps = self.flavour_apt_depends(flavour_data)
+
+            for arch, sandbox in self._apt_sandboxes.items():
+                closure, missing = sandbox.resolve(apt_deps)
+                unresolved.extend(f"{name} ({flavour}, {arch})" for name in sorted(missing))
+
+                lockfiles[path / self.lockfile_name(flavour, arch)] = [
+                    f"{name}={version}" for name, version in sorted(closure.items())
+                ]
+
+        if unresolved:
+            raise Exception(f"Could not resolve apt dependencies: {', '.join(unresolved)}")
+
+        path.mkdir(parents=True, exist_ok=True)
+        for filename, lines in lockfiles.items():
+            filename.write_text("\n".join(lines) + "\n")
+            print(f"Wrote {filename}")
+
     @lru_cache
     def package_needs_rebuild(self, package: GraphPackage) -> bool:
         # Check if there is an APT candidate for the source package. If not we need to build it.
@@ -532,14 +591,25 @@ class Graph:
         # apt sandbox. Its only when the graph is created where we need to utilize the apt
         # sandbox. From that point on a graph should contain the candidate versions for the
         # packages if they exist.
-        if self.init_apt:
-            sources = [
-                f"deb [arch=amd64 trusted=yes] {self.apt_repo}/{self.release_label}/ubuntu {self.os_version} main",
-                f"deb [arch=amd64 trusted=yes] {self.apt_repo}/{self.release_label}/ubuntu {self.os_version}-mirror {self.os_version}"
-            ]
+        unknown_archs = set(self.architectures) - set(ARCH_LIST)
+        if unknown_archs:
+            raise Exception(f"Unsupported architectures {sorted(unknown_archs)}, expected one of {ARCH_LIST}")
 
-            self._apt_sandbox = AptSandbox(sources, local_configs=self.apt_configs)
-            self._apt_cache = self._apt_sandbox.cache
+        # Each architecture gets its own sandbox so that the indexes can be fetched concurrently.
+        self._apt_sandboxes = {}
+        self._apt_caches = {}
+        if self.init_apt:
+            repo = f"{self.apt_repo}/{self.release_label}/ubuntu"
+            sources = {
+                arch: [
+                    f"deb [arch={arch} trusted=yes] {repo} {self.os_version} main",
+                    f"deb [arch={arch} trusted=yes] {repo} {self.os_version}-mirror {self.os_version}"
+                ]
+                for arch in self.architectures
+            }
+
+            self._apt_sandboxes = open_sandboxes(sources, local_configs=self.apt_configs)
+            self._apt_caches = {arch: sandbox.cache for arch, sandbox in self._apt_sandboxes.items()}
 
         sources_loader = SourcesListLoader.create_default()
         self._rosdep_lookup = RosdepLookup.create_from_rospkg(
@@ -547,6 +617,16 @@ class Graph:
         )
         self._rosdep_view = self._rosdep_lookup.get_rosdep_view(DEFAULT_VIEW_KEY)
 
+    def close(self):
+        """
+        Release the apt sandboxes used to look up candidate versions. The graph can still be
+        queried and written afterwards.
+        """
+        for sandbox in self._apt_sandboxes.values():
+            sandbox.close()
+        self._apt_sandboxes = {}
+        self._apt_caches = {}
+
     def write_yaml(self, path: Path):
         if not path.exists():
             path.mkdir(exist_ok=True)
@@ -609,9 +689,19 @@ class Graph:
                     repos[info['repo']] = info["sha"]
                 return repos
 
+        @lru_cache(maxsize=None)
+        def _ordered_packages(src: Path) -> List[Tuple[str, Package]]:
+            # The package index written by the source pull spares crawling and parsing the source tree
+            index_path = package_index_path(src, src.name)
+            if index_path.exists():
+                return topological_order_packages(packages_from_index(index_path))
+            return topological_order(src)
+
         graphs = []
 
         apt_repo = recipe["common"]["apt_repo"]
+        architectures = recipe["common"].get("architectures", ["amd64"])
+        deb_compression = recipe["common"].get("deb_compression", [])
 
         for os_name, versions in recipe["os"].items():
             for os_version in versions:
@@ -624,6 +714,8 @@ class Graph:
                     apt_configs=apt_configs,
                     init_apt=init_apt,
                     package_release_label=package_release_label,
+                    architectures=architectures,
+                    deb_compression=deb_compression,
                 )
 
                 for ros_dist, data in recipe["common"]["distributions"].items():
@@ -639,9 +731,7 @@ class Graph:
                         continue
                     repos = _load_repo_jsonl(json_path)
 
-                    for path, package in topological_order(
-                        workspace / Path("src") / Path(ros_dist)
-                    ):
+                    for path, package in _ordered_packages(workspace / Path("src") / Path(ros_dist)):
                         # The first part of the path should be the repository name. Use this to
                         # index into the repos dict for the SHA hash.
                         repo = Path(path).parts[0]
@@ -7,6 +7,7 @@ import os
 
 from concurrent import futures
 from pathlib import Path
+from typing import Any, Dict, List
 
 from debian_packager import (
     build_debian_info,
@@ -14,9 +15,11 @@ from debian_packager import (
     build_package_version,
     fix_local_paths,
     package_debian,
+    stage_tree,
     environment_package_name,
     environment_package_version
 )
+from debian_packager.deb_writer import stream_package_debian
 
 from . import YamlLoadAction
 from .blossom import Graph
@@ -50,6 +53,7 @@ def create_environment_packages(
     package_release_label: str,
     os_version: str,
     build_date: str,
+    compression: List[Dict[str, Any]] | None = None,
 ):
     """
     Bundles the setup/env files at the root of the ROS distribution (e.g. setup.sh)
@@ -149,6 +153,8 @@ def create_environment_packages(
         "James Prestwood <jprestwood@locusrobotics.com>",
         os_version,
         ros1_staging,
+        installed_size=stage_tree(ros1_staging, None, None),
+        compression=compression,
     )
 
     package_debian(
@@ -158,10 +164,12 @@ def create_environment_packages(
         "James Prestwood <jprestwood@locusrobotics.com>",
         os_version,
         ros2_staging,
+        installed_size=stage_tree(ros2_staging, None, None),
+        compression=compression,
     )
 
 
-def create_build_tools_packages(graph: Graph):
+def create_build_tools_packages(graph: Graph, in_process: bool = False):
     for ros_dist in ["ros1", "ros2"]:
         # Gather build depends from all packages
         build_depends = set()
@@ -177,6 +185,28 @@ def create_build_tools_packages(graph: Graph):
                     f"{dep_pkg.debian_name(*graph.debian_info)} (= {dep_pkg.debian_version(graph.build_date)})"
                 )
 
+        deb_name = build_package_name(graph.organization, graph.package_name_release_label, ros_dist)
+        deb_version = build_package_version(graph.build_date, graph.os_version)
+        description = (
+            f"Meta-package for the {graph.organization}-{graph.package_name_release_label} {ros_dist} "
+            "build tools bundle"
+        )
+
+        # Metapackages have no files, the in-process writer doesn't need a staging directory for them
+        if in_process:
+            stream_package_debian(
+                deb_name,
+                deb_version,
+                description,
+                "James Prestwood <jprestwood@locusrobotics.com>",
+                graph.os_version,
+                [],
+                run_depends=list(build_depends),
+                installed_size=0,
+                compression=graph.deb_compression,
+            )
+            continue
+
         staging_dir = pathlib.Path("staging") / f"{ros_dist}_build_tools"
 
         # Clean old staging
@@ -184,22 +214,22 @@ def create_build_tools_packages(graph: Graph):
 
         staging_dir.mkdir()
 
-        deb_name = build_package_name(graph.organization, graph.package_name_release_label, ros_dist)
-        deb_version = build_package_version(graph.build_date, graph.os_version)
-
         package_debian(
             deb_name,
             deb_version,
-            f"Meta-package for the {graph.organization}-{graph.package_name_release_label} {ros_dist} build tools bundle",
+            description,
             "James Prestwood <jprestwood@locusrobotics.com>",
             graph.os_version,
             staging_dir,
             run_depends=list(build_depends),
+            installed_size=0,
+            compression=graph.deb_compression,
         )
 
 def create_bundle_packages(
     graph: Graph,
     recipe: dict,
+    in_process: bool = False,
 ):
     """
     Creates meta-packages for each bundle flavor. The work here is pulling out all the
@@ -257,14 +287,6 @@ def create_bundle_packages(
 
         print(f"Creating debian templates for {bundle}. Dependencies: {source_depends}")
 
-        # The directory tree where package install files will be copied
-        staging = pathlib.Path("staging") / bundle
-
-        # Clean old staging
-        shutil.rmtree(staging, ignore_errors=True)
-
-        staging.mkdir()
-
         # For convenience add the build-tools bundle as a build depend for all bundles. This allows
         # us to save a lot of space in images by not including build tools, but for workspace
         # overlays we can still install the build tools with:
@@ -278,15 +300,42 @@ def create_bundle_packages(
         # TODO: Maybe a better way of determining versions for the bundles?
         deb_version = f"{graph.build_date}{graph.os_version}"
 
+        description = f"Meta-package for the {graph.organization}-{graph.package_name_release_label} {bundle} bundle"
+
+        if in_process:
+            stream_package_debian(
+                deb_name,
+                deb_version,
+                description,
+                "James Prestwood <jprestwood@locusrobotics.com>",
+                graph.os_version,
+                [],
+                run_depends=source_depends,
+                build_depends=build_depends,
+                installed_size=0,
+                compression=graph.deb_compression,
+            )
+            continue
+
+        # The directory tree where package install files will be copied
+        staging = pathlib.Path("staging") / bundle
+
+        # Clean old staging
+        shutil.rmtree(staging, ignore_errors=True)
+
+        staging.mkdir()
+
         package_debian(
             deb_name,
             deb_version,
-            f"Meta-package for the {graph.organization}-{graph.package_name_release_label} {bundle} bundle",
+            description,
             "James Prestwood <jprestwood@locusrobotics.com>",
             graph.os_version,
             staging,
             run_depends=source_depends,
-            build_depends=build_depends
+            build_depends=build_depends,
+            installed_size=0,
+            compression=graph.deb_compression,
         )
 
 
@@ -309,6 +358,11 @@ def main():
         type=Path,
         required=True
     )
+    parser.add_argument(
+        "--in-process-deb",
+        action="store_true",
+        help="Write the bundle and build tools metapackages in-process rather than with dpkg-deb"
+    )
     args = parser.parse_args()
 
     graph = Graph.from_yaml(args.graph)
@@ -320,16 +374,19 @@ def main():
             graph.release_label,
             graph.package_name_release_label,
             graph.os_version,
-            graph.build_date
+            graph.build_date,
+            graph.deb_compression,
         )
         bundles = executor.submit(
             create_bundle_packages,
             graph,
-            args.recipe
+            args.recipe,
+            args.in_process_deb
         )
         build_tools = executor.submit(
             create_build_tools_packages,
-            graph
+            graph,
+            args.in_process_deb
         )
 
         environment.result()
@@ -10,6 +10,7 @@ from typing import List, Tuple
 
 from . import YamlLoadAction
 from .blossom import Graph, GraphPackage
+from .source_image import mounted_source_image
 
 
 def get_build_list(graph: Graph, ros_distro: str, recipe: dict | None = None) -> Tuple[List[GraphPackage], List[GraphPackage]]:
@@ -64,6 +65,11 @@ def main():
         "--no-clean",
         action="store_true"
     )
+    parser.add_argument(
+        "--src-image",
+        type=pathlib.Path,
+        help="Source image to mount read-only on <workspace>/src while building"
+    )
 
     args, unknown_args = parser.parse_known_args()
 
@@ -235,12 +241,14 @@ def main():
 
     print(" ".join(colcon_command))
 
-    build_proc = subprocess.Popen(
-        colcon_command,
-        env=clean_env
-    )
+    with mounted_source_image(args.src_image, args.workspace):
+        build_proc = subprocess.Popen(
+            colcon_command,
+            env=clean_env
+        )
+        returncode = build_proc.wait()
 
-    exit(build_proc.wait())
+    exit(returncode)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,274 @@
+import argparse
+import gzip
+import hashlib
+import lzma
+import pathlib
+import random
+import time
+
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from typing import Dict, List, Optional, Tuple
+
+from . import ARCH_LIST
+
+
+COMPRESSION_TYPES = ["none", "gz", "xz"]
+FIXTURE_START_DATE = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def synthetic_package_name(index: int) -> str:
+    """Name of the synthetic source package with the given index."""
+    return f"pkg_{index:05d}"
+
+
+def synthetic_versions(index: int, num_versions: int, epoch_every: int, rng: random.Random) -> List[str]:
+    """
+    Create the version history of a synthetic package, oldest first. Versions follow the
+    <version>-<build date>+git<sha> scheme of packages built by tailor. Every `epoch_every`
+    package has its upstream version downgraded halfway through its history, which is
+    published with a bumped epoch, the same way a package moved between repositories would be.
+    """
+    versions = []
+    epoch = 0
+    for n in range(num_versions):
+        upstream = f"{index % 7}.{n}.0"
+        if epoch_every and index % epoch_every == 0 and n >= num_versions // 2 > 0:
+            epoch = 1
+            upstream = f"{index % 7}.{n - num_versions // 2}.0"
+
+        build_date = (FIXTURE_START_DATE + timedelta(days=n, seconds=index)).strftime("%Y%m%d.%H%M%S")
+        sha = f"{rng.getrandbits(28):07x}"
+        version = f"{upstream}-{build_date}+git{sha}"
+        versions.append(f"{epoch}:{version}" if epoch else version)
+
+    return versions
+
+
+def _packages_stanza(deb_name: str, version: str, arch: str, priority: str = "standard",
+                     depends: Optional[str] = None, provides: Optional[str] = None) -> str:
+    filename_version = version.replace(":", "%3a")
+    relations = ""
+    if depends:
+        relations += f"Depends: {depends}\n"
+    if provides:
+        relations += f"Provides: {provides}\n"
+    return (
+        f"Package: {deb_name}\n"
+        f"Version: {version}\n"
+        f"Architecture: {arch}\n"
+        "Maintainer: Tailor Fixtures <fixtures@example.com>\n"
+        f"Priority: {priority}\n"
+        f"{relations}"
+        "Section: main\n"
+        f"Filename: pool/main/{deb_name[0]}/{deb_name}/{deb_name}_{filename_version}_{arch}.deb\n"
+        "Size: 1024\n"
+        f"SHA256: {hashlib.sha256(f'{deb_name}{version}{arch}'.encode()).hexdigest()}\n"
+        f"Description: Synthetic fixture package {deb_name}\n"
+        "\n"
+    )
+
+
+def _write_index(path: pathlib.Path, content: bytes, compression: str) -> List[Tuple[pathlib.Path, bytes]]:
+    """Write a Packages index and return the (path, content) entries to list in the Release file."""
+    # apt expects the uncompressed index to be listed in the Release file even when only a
+    # compressed copy is published, the same as reprepro and aptly do.
+    entries = [(path, content)]
+    if compression == "gz":
+        # mtime=0 keeps the output reproducible
+        entries.append((path.with_name(path.name + ".gz"), gzip.compress(content, mtime=0)))
+    elif compression == "xz":
+        entries.append((path.with_name(path.name + ".xz"), lzma.compress(content)))
+
+    entries[-1][0].write_bytes(entries[-1][1])
+    return entries
+
+
+def _write_release(dist_dir: pathlib.Path, suite: str, components: List[str], architectures: List[str],
+                   indexes: List[Tuple[pathlib.Path, bytes]]):
+    entries = [
+        (hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest(), len(data), str(path.relative_to(dist_dir)))
+        for path, data in sorted(indexes)
+    ]
+
+    lines = [
+        "Origin: tailor-fixtures",
+        "Label: tailor-fixtures",
+        f"Suite: {suite}",
+        f"Codename: {suite}",
+        f"Date: {formatdate(FIXTURE_START_DATE.timestamp(), usegmt=True)}",
+        f"Architectures: {' '.join(architectures)}",
+        f"Components: {' '.join(components)}",
+        "MD5Sum:",
+        *[f" {md5} {size} {name}" for md5, _, size, name in entries],
+        "SHA256:",
+        *[f" {sha256} {size} {name}" for _, sha256, size, name in entries],
+    ]
+    (dist_dir / "Release").write_text("\n".join(lines) + "\n")
+
+
+def _write_suite(repo_root: pathlib.Path, suite: str, component: str, architectures: List[str],
+                 stanzas: Dict[str, List[str]], compression: str):
+    dist_dir = repo_root / "dists" / suite
+    indexes: List[Tuple[pathlib.Path, bytes]] = []
+    for arch in architectures:
+        binary_dir = dist_dir / component / f"binary-{arch}"
+        binary_dir.mkdir(parents=True, exist_ok=True)
+        # Drop indexes left over from a previous run with a different compression
+        for stale in binary_dir.glob("Packages*"):
+            stale.unlink()
+        indexes.extend(_write_index(binary_dir / "Packages", "".join(stanzas.get(arch, [])).encode(), compression))
+
+    _write_release(dist_dir, suite, [component], architectures, indexes)
+
+
+def generate_apt_repo(
+    output: pathlib.Path,
+    release_label: str,
+    os_version: str,
+    organization: str = "locusrobotics",
+    ros_distros: List[str] = ["ros1", "ros2"],
+    architectures: List[str] = ["amd64"],
+    num_packages: int = 100,
+    num_versions: int = 5,
+    epoch_every: int = 10,
+    compression: str = "none",
+    seed: int = 0,
+    depends_on_previous: bool = False,
+    required_packages: int = 0,
+    provided_virtual: Optional[str] = None,
+    lagging_architectures: List[str] = [],
+) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Generate an offline APT repository with the same layout as the published tailor repository,
+    so that Graph(apt_repo=f"file://{output}") can consume it through an AptSandbox.
+    :param output: Directory in which to create the repository
+    :param release_label: Release label, used in the repository path and package names
+    :param os_version: Ubuntu codename used as the suite
+    :param organization: Organization prefix of the package names
+    :param ros_distros: ROS distributions to generate packages for
+    :param architectures: Architectures to publish indexes for
+    :param num_packages: Number of synthetic source packages per ROS distribution
+    :param num_versions: Number of historical versions published for every package
+    :param epoch_every: Publish an epoch-bumped downgrade for every Nth package (0 disables)
+    :param compression: Compression of the Packages indexes, one of COMPRESSION_TYPES
+    :param seed: Seed for the generated git SHAs
+    :param depends_on_previous: Make every package depend on the package generated before it
+    :param required_packages: Number of packages published with the required priority of a base system
+    :param provided_virtual: Virtual package provided by the last package of every ROS distribution
+    :param lagging_architectures: Architectures the newest version of every package isn't published for yet
+    :returns: Mapping of ROS distribution to source package name to its versions, oldest first
+    """
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError(f"Unknown compression {compression}, expected one of {COMPRESSION_TYPES}")
+
+    rng = random.Random(seed)
+    repo_root = output / release_label / "ubuntu"
+
+    published: Dict[str, Dict[str, List[str]]] = {}
+    stanzas: Dict[str, List[str]] = {arch: [] for arch in architectures}
+    for ros_distro in ros_distros:
+        published[ros_distro] = {}
+        previous: Optional[str] = None
+        for index in range(num_packages):
+            name = synthetic_package_name(index)
+            deb_name = f"{organization}-{release_label}-{ros_distro}-{name.replace('_', '-')}"
+            versions = synthetic_versions(index, num_versions, epoch_every, rng)
+            published[ros_distro][name] = versions
+
+            priority = "required" if index < required_packages else "standard"
+            depends = previous if depends_on_previous and index > 0 else None
+            provides = provided_virtual if index == num_packages - 1 else None
+            previous = deb_name
+
+            for arch in architectures:
+                arch_versions = versions[:-1] if arch in lagging_architectures else versions
+                stanzas[arch].extend(_packages_stanza(deb_name, version, arch, priority, depends, provides)
+                                     for version in arch_versions)
+
+    _write_suite(repo_root, os_version, "main", architectures, stanzas, compression)
+    # The graph always adds the upstream mirror suite as well. Publish it empty so apt doesn't
+    # report a missing repository.
+    _write_suite(repo_root, f"{os_version}-mirror", os_version, architectures, {}, compression)
+
+    return published
+
+
+def benchmark_candidate_lookup(output: pathlib.Path, release_label: str, os_version: str, organization: str,
+                               published: Dict[str, Dict[str, List[str]]], architectures: List[str]):
+    """Time sandbox creation and candidate lookup of every published package against the fixture repository."""
+    from .blossom import Graph, GraphPackage
+
+    start = time.perf_counter()
+    graph = Graph(
+        "ubuntu",
+        os_version,
+        release_label,
+        FIXTURE_START_DATE.strftime("%Y%m%d.%H%M%S"),
+        apt_repo=output.resolve().as_uri(),
+        organization=organization,
+        architectures=architectures,
+    )
+    sandbox_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lookups = 0
+    rebuilds = 0
+    for ros_distro, packages in published.items():
+        for name in packages:
+            package = GraphPackage(name, "0.0.0", "0000000", "", ros_distro, [], [])
+            for arch in architectures:
+                version = graph._get_apt_candidate_version(package, arch)
+                if version:
+                    package.apt_candidate_versions[arch] = version
+                lookups += 1
+            package.apt_candidate_version = package.apt_candidate_versions.get(architectures[0])
+            rebuilds += graph.package_needs_rebuild(package)
+    lookup_time = time.perf_counter() - start
+    graph.close()
+
+    print(f"Sandbox setup: {sandbox_time:.2f}s")
+    print(f"Candidate lookups: {lookups} in {lookup_time:.2f}s ({lookups / max(lookup_time, 1e-9):.0f}/s)")
+    print(f"Packages needing a rebuild: {rebuilds}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate an offline APT repository of synthetic tailor packages")
+    parser.add_argument("output", type=pathlib.Path)
+    parser.add_argument("--release-label", default="hotdog")
+    parser.add_argument("--os-version", default="jammy")
+    parser.add_argument("--organization", default="locusrobotics")
+    parser.add_argument("--ros-distros", nargs="+", default=["ros1", "ros2"])
+    parser.add_argument("--architectures", nargs="+", default=["amd64"], choices=ARCH_LIST)
+    parser.add_argument("--num-packages", type=int, default=100)
+    parser.add_argument("--num-versions", type=int, default=5)
+    parser.add_argument("--epoch-every", type=int, default=10)
+    parser.add_argument("--compression", choices=COMPRESSION_TYPES, default="none")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--benchmark", action="store_true", help="Time candidate lookups against the generated repo")
+    args = parser.parse_args()
+
+    published = generate_apt_repo(
+        args.output,
+        args.release_label,
+        args.os_version,
+        organization=args.organization,
+        ros_distros=args.ros_distros,
+        architectures=args.architectures,
+        num_packages=args.num_packages,
+        num_versions=args.num_versions,
+        epoch_every=args.epoch_every,
+        compression=args.compression,
+        seed=args.seed,
+    )
+    print(f"Wrote {args.num_packages * args.num_versions * len(args.ros_distros)} package versions "
+          f"to {args.output.resolve().as_uri()}")
+
+    if args.benchmark:
+        benchmark_candidate_lookup(
+            args.output, args.release_label, args.os_version, args.organization, published, args.architectures
+        )
+
+
+if __name__ == "__main__":
+    main()
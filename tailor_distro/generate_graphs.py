@@ -9,6 +9,7 @@ from typing import List
 
 from . import YamlLoadAction, SCHEME_S3
 from .blossom import Graph
+from .source_image import mounted_source_image
 
 
 def load_repositories(path):
@@ -39,8 +40,16 @@ def generate_graphs(
         package_release_label=package_release_label,
     )
 
-    for graph in graphs:
-        graph.write_yaml(workspace / pathlib.Path("graphs"))
+    try:
+        for graph in graphs:
+            graph.write_yaml(workspace / pathlib.Path("graphs"))
+            # Pin the apt dependencies of every flavour while the apt sandbox is available, so
+            # the environment images install exactly the versions the graph was resolved against.
+            if not skip_apt:
+                graph.write_lockfiles(recipe["flavours"], workspace / pathlib.Path("graphs"))
+    finally:
+        for graph in graphs:
+            graph.close()
 
     env = jinja2.Environment(
         loader=jinja2.PackageLoader("tailor_distro", "debian_templates"),
@@ -84,17 +93,23 @@ def main():
         default=None,
         help="Override used only for Debian package names. Defaults to --release-label.",
     )
+    parser.add_argument(
+        "--src-image",
+        type=pathlib.Path,
+        help="Source image to mount read-only on <workspace>/src while generating the graphs.",
+    )
     args = parser.parse_args()
 
-    generate_graphs(
-        args.recipe,
-        args.workspace,
-        args.release_label,
-        args.timestamp,
-        args.apt_configs,
-        args.skip_apt,
-        args.package_release_label,
-    )
+    with mounted_source_image(args.src_image, args.workspace):
+        generate_graphs(
+            args.recipe,
+            args.workspace,
+            args.release_label,
+            args.timestamp,
+            args.apt_configs,
+            args.skip_apt,
+            args.package_release_label,
+        )
 
 
 if __name__ == '__main__':
@@ -11,6 +11,11 @@ def main():
     parser.add_argument("--recipe", type=pathlib.Path, required=True)
     parser.add_argument("--workspace", type=pathlib.Path, default=pathlib.Path("workspace"))
     parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument(
+        "--locked",
+        action="store_true",
+        help="Write the pinned package=version closure from the lockfile generated next to the graph.",
+    )
     args = parser.parse_args()
 
     graph = Graph.from_yaml(args.graph)
@@ -20,13 +25,14 @@ def main():
     deps_path.mkdir(parents=True, exist_ok=True)
 
     for flavour, flavour_data in recipe["flavours"].items():
-        apt_deps = set()
-        for ros_dist, dist_data in flavour_data["distributions"].items():
-            root_packages = dist_data["root_packages"] or graph.packages[ros_dist].keys()
-
-            for pkg_name in root_packages:
-                deps = set(graph.all_apt_depends(pkg_name, ros_dist))
-                apt_deps.update(deps)
+        lockfile = args.graph.parent / graph.lockfile_name(flavour, graph.architectures[0])
+        if args.locked and lockfile.exists():
+            apt_deps = [line for line in lockfile.read_text().splitlines() if line]
+        else:
+            if args.locked:
+                # Graphs generated with --skip-apt have no lockfiles
+                print(f"No lockfile {lockfile} for {flavour}, writing its unpinned dependencies")
+            apt_deps = graph.flavour_apt_depends(flavour_data)
 
         deps_file = deps_path / f"{flavour}-{graph.os_version}-{graph.release_label}-dependencies.txt"
 
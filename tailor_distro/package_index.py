@@ -0,0 +1,118 @@
+import hashlib
+import json
+import pathlib
+import posixpath
+
+from typing import Any, Dict, Iterable, List, Set
+
+from catkin_pkg.package import PACKAGE_MANIFEST_FILENAME, Package, parse_package_string
+from catkin_pkg.packages import DEFAULT_IGNORE_MARKERS, find_package_paths
+
+# Files that make catkin_pkg skip the folder containing them
+IGNORE_MARKERS = DEFAULT_IGNORE_MARKERS
+
+# Dependency lists of a package manifest stored in the index, with their conditions
+DEPENDENCY_TYPES = [
+    "build_depends",
+    "buildtool_depends",
+    "build_export_depends",
+    "buildtool_export_depends",
+    "exec_depends",
+    "run_depends",
+    "test_depends",
+    "doc_depends",
+    "group_depends",
+    "member_of_groups",
+]
+
+
+def package_index_path(distro_dir: pathlib.Path, distro_name: str) -> pathlib.Path:
+    """Path of the package index of a distribution, next to its repositories data."""
+    return distro_dir / f"{distro_name}_package_index.jsonl"
+
+
+def discover_packages(manifests: Dict[str, bytes], ignored_dirs: Set[str]) -> Dict[str, bytes]:
+    """
+    Apply the catkin_pkg crawling rules to the package manifests found in a repository, without walking it:
+    folders containing an ignore marker, hidden folders and packages nested in other packages are skipped.
+    :param manifests: package.xml contents by package folder, relative to the repository root ("" for the root)
+    :param ignored_dirs: Folders containing one of the catkin_pkg ignore markers
+    :returns: package.xml contents of the packages catkin_pkg would find, by package folder
+    """
+    packages: Dict[str, bytes] = {}
+    # Parents sort before their children, so nested packages are seen after the package containing them
+    for path in sorted(manifests):
+        parents = [posixpath.dirname(path)] if path else []
+        while parents and parents[-1]:
+            parents.append(posixpath.dirname(parents[-1]))
+        if any(part.startswith(".") for part in path.split("/") if part):
+            continue
+        if path in ignored_dirs or any(parent in ignored_dirs for parent in parents):
+            continue
+        if path in packages or any(parent in packages for parent in parents):
+            continue
+        packages[path] = manifests[path]
+    return packages
+
+
+def index_entry(repo: str, path: str, manifest: bytes) -> Dict[str, Any]:
+    """
+    Create the index entry of a package.
+    :param repo: Name of the repository the package belongs to
+    :param path: Folder of the package relative to the distribution source folder
+    :param manifest: Raw package.xml content
+    """
+    package = parse_package_string(manifest.decode("utf-8"), filename=posixpath.join(path, PACKAGE_MANIFEST_FILENAME))
+    return {
+        "name": package.name,
+        "repo": repo,
+        "path": path,
+        "version": package.version,
+        "depends": {
+            dep_type: [{"name": dep.name, "condition": dep.condition} for dep in getattr(package, dep_type)]
+            for dep_type in DEPENDENCY_TYPES
+        },
+        "sha256": hashlib.sha256(manifest).hexdigest(),
+        "manifest": manifest.decode("utf-8"),
+    }
+
+
+def scan_packages(repo_dir: pathlib.Path) -> Dict[str, bytes]:
+    """
+    Read the package manifests of a repository already on disk, e.g. one pulled before indexes were written.
+    :param repo_dir: Repository folder
+    :returns: package.xml contents by package folder, relative to repo_dir
+    """
+    return {
+        "" if path == "." else pathlib.PurePath(path).as_posix():
+            (repo_dir / path / PACKAGE_MANIFEST_FILENAME).read_bytes()
+        for path in find_package_paths(str(repo_dir))
+    }
+
+
+def write_package_index(path: pathlib.Path, entries: Iterable[Dict[str, Any]]) -> None:
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for entry in sorted(entries, key=lambda e: e["path"]):
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    tmp.replace(path)
+
+
+def load_package_index(path: pathlib.Path) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def packages_from_index(path: pathlib.Path) -> Dict[str, Package]:
+    """
+    Load the packages of a distribution from its index, in the form returned by catkin_pkg.packages.find_packages.
+    :param path: Path of the package index
+    :returns: Package objects by their folder, relative to the distribution source folder
+    """
+    packages = {}
+    for entry in load_package_index(path):
+        filename = posixpath.join(entry["path"], PACKAGE_MANIFEST_FILENAME)
+        packages[entry["path"]] = parse_package_string(entry["manifest"], filename=filename)
+    return packages
@@ -5,31 +5,73 @@ import pathlib
 import rosdistro
 import sys
 import tarfile
-import glob
+import posixpath
 import shutil
+import fcntl
+import fnmatch
+import os
 import github
+import hashlib
 import json
-import os
+import queue
+import random
+import re
+import requests
+import subprocess
+import threading
+import time
+import yaml
 
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass
-from requests.exceptions import HTTPError
-from catkin_pkg.package import parse_package
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
+from urllib3.exceptions import HTTPError as TransferError
+from catkin_pkg.package import Dependency, parse_package_string
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
 from jinja2 import Environment, BaseLoader
+from rosdep2.lookup import RosdepLookup
+from rosdep2.rospkg_loader import DEFAULT_VIEW_KEY
+from rosdep2.sources_list import SourcesListLoader
 from shutil import rmtree
-from typing import Any, List, Mapping, Optional, Dict, Tuple
-from urllib import request, error
+from typing import Any, Deque, Iterable, Iterator, List, Mapping, Optional, Dict, Literal, Sequence, Set, Tuple, TypeVar
 from time import sleep
 from textwrap import indent
+from urllib.parse import urlparse
 import tempfile
 
 from . import YamlLoadAction
+from .package_index import (
+    IGNORE_MARKERS, discover_packages, index_entry, load_package_index, package_index_path, scan_packages,
+    write_package_index,
+)
+from .pull_report import PullReport, RepoMetrics
+from .ref_cache import DAY_SECONDS, DEFAULT_REF_CACHE, RefCache
+from .source_image import IMAGE_FORMATS, create_source_image
+from .tarball_cache import DEFAULT_CACHE_SIZE_GB, TarballCache, open_tarball_cache
 
 PULL_WORKERS = 10
+MIN_PULL_WORKERS = 2
+MAX_PULL_WORKERS = 48
 DOWNLOAD_RETRIES = 3
 RETRY_WAIT_SECONDS = 15
+BACKOFF_BASE_SECONDS = 2
+MAX_BACKOFF_SECONDS = 120
 DOWNLOAD_TIMEOUT_SEC = 30
 CHUNK_SIZE = 1024 * 1024
+DEFAULT_GIT_CACHE = pathlib.Path.home() / ".cache" / "tailor-distro" / "git"
+GRAPHQL_IN_FLIGHT = 4
+MIN_GRAPHQL_CHUNK = 10
+# Throughput is averaged over this window before the download concurrency is adjusted
+THROUGHPUT_WINDOW_SEC = 5.0
+THROTTLE_STATUS_CODES = (403, 429)
+
+T = TypeVar("T")
+TarStreamMode = Literal["r|gz", "r|"]
 
 @dataclass
 class RepoInformation:
@@ -39,6 +81,16 @@ class RepoInformation:
     sha: str
     tarball: str
 
+@dataclass
+class RepoPull:
+    distro: str
+    repo: RepoInformation
+    whitelist: Optional[List[str]] = None
+    backend: Optional["FetchBackend"] = None
+    # Globs of the repository files to leave out, see matches_exclude
+    excludes: Optional[List[str]] = None
+
+
 def get_name_and_owner(repo_url: str) -> Tuple[Optional[str], str]:
     """
     Parse the repository url to obtain the name and owner data.
@@ -83,134 +135,950 @@ def graphql_with_retry(requester, query, max_attempts=DOWNLOAD_RETRIES, delay=RE
     raise last_error
 
 
+def _tarball_query(batch: List[Tuple[Tuple[Optional[str], str], str]]) -> str:
+    query_content = []
+    for idx, ((repo_owner, repo_name), ref) in enumerate(batch):
+        alias = f"r{idx}"
+        query_content.append(
+            f"""
+          {alias}: repository(owner: "{repo_owner}", name: "{repo_name}") {{
+            version: object(expression:"{ref}") {{
+              __typename
+              ... on Commit {{ oid tarballUrl }}
+              ... on Tag {{
+                target {{ ... on Commit {{ oid tarballUrl }} oid }}
+              }}
+            }}
+            tag: ref(qualifiedName:"refs/tags/{ref}") {{ name }}
+          }}"""
+        )
+    query_content.append("\n  rateLimit { cost remaining resetAt }")
+
+    return f"query {{\n{indent(''.join(query_content), '  ')}\n}}"
+
+
+def is_immutable_ref(ref: str) -> bool:
+    """Whether a ref is a full commit SHA, which always resolves to the same commit."""
+    return re.fullmatch(r"[0-9a-f]{40}", ref) is not None
+
+
+def _query_tarballs(
+    requester, batch: List[Tuple[Tuple[Optional[str], str], str]], report: Optional[PullReport] = None,
+    ref_cache: Optional[RefCache] = None,
+) -> Tuple[List[RepoInformation], Optional[Dict[str, Any]]]:
+    start = time.monotonic()
+    _, result = graphql_with_retry(requester, _tarball_query(batch))
+    if report is not None:
+        cost = (result["data"].get("rateLimit") or {}).get("cost", 0)
+        report.record_graphql(len(batch), time.monotonic() - start, cost)
+
+    out: List[RepoInformation] = []
+    for idx, ((repo_owner, repo_name), ref) in enumerate(batch):
+        node = result["data"][f"r{idx}"]
+        if node["version"] is not None:
+            v = node["version"]
+            if v["__typename"] == "Commit":
+                sha = v["oid"]
+                tarball = v["tarballUrl"]
+            else:
+                sha = v["target"]["oid"]
+                tarball = v["target"]["tarballUrl"]
+            click.echo(f"Obtained tarball URL for {repo_name}... (ref: {ref}, sha: {sha})")
+            exists = True
+            # Tags are trusted not to move, unlike branches
+            if ref_cache is not None and repo_owner and (node.get("tag") or is_immutable_ref(ref)):
+                ref_cache.put(repo_owner, repo_name, ref, sha, tarball)
+        else:
+            raise RuntimeError(
+                f"Could not obtain tarball URL for {repo_name}... (ref: {ref})"
+            )
+        out.append(
+            RepoInformation(
+                owner=repo_owner,
+                name=repo_name,
+                exists=exists,
+                sha=sha,
+                tarball=tarball,
+            )
+        )
+    return out, result["data"].get("rateLimit")
+
+
+def _seconds_until(timestamp: str) -> float:
+    reset = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    return max(0.0, reset.timestamp() - time.time())
+
+
 def retrieve_tarballs(
-    repos_url: List[str], refs: List[str], github_client, chunk: int = 100
-) -> List[RepoInformation]:
+    repos_url: List[str],
+    refs: List[str],
+    github_client,
+    chunk: int = 100,
+    max_in_flight: int = GRAPHQL_IN_FLIGHT,
+    report: Optional[PullReport] = None,
+    ref_cache: Optional[RefCache] = None,
+) -> Iterator[RepoInformation]:
     """
     Retrieve the tarball for a list of repositories using the GraphQL API of Github. If the ref_branch exists,
     the tarball corresponding to that reference is returned. Otherwise, exists bool is set to False.
+    Chunks of repositories are queried concurrently, and results are yielded as soon as their chunk resolves.
+    The first chunk is sent on its own, the rate limit cost it reports sizes the chunks that follow.
     :param repos_url: list of repository URLs
     :param refs: default versions to retrieve
     :param github_client: Github client
     :chunk: limit of the number of repositories that can be processed to avoid running into rate limit issues
-    :returns: a list of RepoInformation objects containing all relevant data
+    :max_in_flight: limit of the number of chunk queries sent concurrently
+    :report: report to record the latency of every chunk query in
+    :ref_cache: cache of tags and SHAs resolved by previous pulls, these refs aren't queried again
+    :returns: an iterator of RepoInformation objects containing all relevant data
     """
-    names_and_owners = [get_name_and_owner(url) for url in repos_url]
+    pending: Deque[Tuple[Tuple[Optional[str], str], str]] = deque()
+    for (repo_owner, repo_name), ref in zip([get_name_and_owner(url) for url in repos_url], refs):
+        cached = ref_cache.get(repo_owner, repo_name, ref) if ref_cache is not None and repo_owner else None
+        if cached is not None and repo_owner:
+            sha, tarball = cached
+            click.echo(f"Using cached tarball URL for {repo_name}... (ref: {ref}, sha: {sha})")
+            yield RepoInformation(owner=repo_owner, name=repo_name, exists=True, sha=sha, tarball=tarball)
+        else:
+            pending.append(((repo_owner, repo_name), ref))
+
     requester = github_client._Github__requester
-    out: List[RepoInformation] = []
-    for start in range(0, len(names_and_owners), chunk):
-        slice_ = names_and_owners[start:start + chunk]
-        slice_refs = refs[start:start + chunk]
-        query_content = []
-        for idx, ((repo_owner, repo_name), ref) in enumerate(zip(slice_, slice_refs)):
-            alias = f"r{idx}"
-            query_content.append(
-                f"""
-              {alias}: repository(owner: "{repo_owner}", name: "{repo_name}") {{
-                version: object(expression:"{ref}") {{
-                  __typename
-                  ... on Commit {{ oid tarballUrl }}
-                  ... on Tag {{
-                    target {{ ... on Commit {{ oid tarballUrl }} oid }}
-                  }}
-                }}
-              }}"""
-            )
 
-        query = f"query {{\n{indent(''.join(query_content), '  ')}\n}}"
-        _, result = graphql_with_retry(requester, query)
+    chunk_size = chunk
+    cost = 1
+    remaining: Optional[int] = None
+    reset_at: Optional[str] = None
+    probed = False
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        in_flight: Set[Future] = set()
+        while pending or in_flight:
+            while pending and len(in_flight) < (max_in_flight if probed else 1):
+                if remaining is not None and remaining < cost * (len(in_flight) + 1):
+                    if in_flight:
+                        break
+                    wait_sec = _seconds_until(reset_at) if reset_at else RETRY_WAIT_SECONDS
+                    click.echo(
+                        click.style(f"GraphQL rate limit exhausted, waiting {wait_sec:.0f}s for reset", fg="yellow"),
+                        err=True,
+                    )
+                    sleep(wait_sec)
+                    remaining = None
+
+                batch = [pending.popleft() for _ in range(min(chunk_size, len(pending)))]
+                in_flight.add(pool.submit(_query_tarballs, requester, batch, report, ref_cache))
+                if remaining is not None:
+                    remaining -= cost
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                repos, rate_limit = future.result()
+                if rate_limit:
+                    probed = True
+                    cost = max(1, rate_limit["cost"])
+                    remaining = rate_limit["remaining"]
+                    reset_at = rate_limit["resetAt"]
+                    # Smaller chunks keep each query at the minimum cost
+                    if cost > 1:
+                        chunk_size = max(MIN_GRAPHQL_CHUNK, chunk_size // cost)
+                yield from repos
+
+    if ref_cache is not None:
+        ref_cache.save()
+
 
-        for idx, ((repo_owner, repo_name), ref) in enumerate(zip(slice_, slice_refs)):
-            node = result["data"][f"r{idx}"]
-            if node["version"] is not None:
-                v = node["version"]
-                if v["__typename"] == "Commit":
-                    sha = v["oid"]
-                    tarball = v["tarballUrl"]
+def prefetch(iterables: Sequence[Iterable[T]]) -> Iterator[T]:
+    """
+    Consume iterables in background threads, one each, so that producing items overlaps with processing them.
+    Items are yielded in the order they are produced, interleaving the iterables. Exceptions raised by an
+    iterable are re-raised to the consumer.
+    """
+    items: queue.Queue = queue.Queue()
+    done = object()
+
+    def produce(iterable: Iterable[T]):
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+        finally:
+            items.put((done, None))
+
+    def consume() -> Iterator[T]:
+        running = len(iterables)
+        while running:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            if item is done:
+                running -= 1
+                continue
+            yield item
+
+    # Start producing right away rather than on the first next() of the consumer
+    for iterable in iterables:
+        threading.Thread(target=produce, args=(iterable,), daemon=True).start()
+    return consume()
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter, so that throttled workers don't retry in lockstep."""
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def throttle_delay(response: requests.Response) -> Optional[float]:
+    """
+    Read how long GitHub asks us to back off for from the Retry-After and X-RateLimit headers.
+    :param response: HTTP response
+    :returns: Seconds to wait, or None if the response doesn't ask to slow down
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(0.0, float(response.headers["X-RateLimit-Reset"]) - time.time())
+        except (KeyError, ValueError):
+            pass
+
+    if response.status_code == 429:
+        return 0.0
+    return None
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for downloads, adjusted additively while the observed throughput keeps growing, and
+    halved whenever the server throttles us.
+    """
+    def __init__(self, initial: int = PULL_WORKERS, minimum: int = MIN_PULL_WORKERS,
+                 maximum: int = MAX_PULL_WORKERS, window: float = THROUGHPUT_WINDOW_SEC):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.active = 0
+        self.resume_at = 0.0
+        self._cond = threading.Condition()
+        self._samples: Deque[Tuple[float, int]] = deque()
+        self._last_adjust = time.monotonic()
+        self._last_throughput = 0.0
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Wait until a download is allowed to start, and hold its slot while it runs."""
+        with self._cond:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self.active >= self.limit:
+                    self._cond.wait()
                 else:
-                    sha = v["target"]["oid"]
-                    tarball = v["target"]["tarballUrl"]
-                click.echo(f"Obtained tarball URL for {repo_name}... (ref: {ref}, sha: {sha})")
-                exists = True
+                    break
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    def record(self, nbytes: int) -> None:
+        """Record downloaded bytes, and adjust the limit once per throughput window."""
+        with self._cond:
+            now = time.monotonic()
+            self._samples.append((now, nbytes))
+            while self._samples and self._samples[0][0] < now - self.window:
+                self._samples.popleft()
+            if now - self._last_adjust < self.window:
+                return
+
+            throughput = sum(n for _, n in self._samples) / self.window
+            if throughput > self._last_throughput * 1.1 and self.active >= self.limit:
+                # Every slot is busy and more slots made us faster, the link isn't saturated yet
+                self.limit = min(self.maximum, self.limit + 1)
+            elif throughput < self._last_throughput * 0.7:
+                self.limit = max(self.minimum, self.limit - 1)
+            self._last_throughput = throughput
+            self._last_adjust = now
+            self._cond.notify_all()
+
+    def throttle(self, delay: float) -> None:
+        """Halve the limit and pause new downloads for delay seconds."""
+        with self._cond:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.resume_at = max(self.resume_at, time.monotonic() + delay)
+            self._last_adjust = time.monotonic()
+            self._cond.notify_all()
+
+
+class StreamReader:
+    """
+    File-like wrapper that reports downloaded bytes to a limiter and to the repository metrics, and optionally
+    copies them into a sink. Time spent waiting on the source is counted as download time.
+    """
+    def __init__(self, src, limiter: Optional[AdaptiveLimiter] = None, sink=None,
+                 metrics: Optional[RepoMetrics] = None):
+        self.src = src
+        self.limiter = limiter
+        self.sink = sink
+        self.metrics = metrics
+        self._unreported = 0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.monotonic()
+        data = self.src.read(size)
+        if self.metrics is not None:
+            self.metrics.download_seconds += time.monotonic() - start
+            self.metrics.bytes_downloaded += len(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        self._unreported += len(data)
+        if self.limiter is not None and (self._unreported >= CHUNK_SIZE or not data):
+            self.limiter.record(self._unreported)
+            self._unreported = 0
+        return data
+
+
+class ResumableStream:
+    """
+    File-like view of an HTTP download that picks up where it left off with a Range request when the
+    connection drops, so the reader sees one continuous stream and only the missing bytes are transferred
+    again. The stream ends with an error if it isn't as long as the server announced. Servers that don't announce
+    a length, e.g. codeload.github.com sending tarballs chunked, give nothing to verify a resumed download against,
+    so those are never resumed and the error is raised for the download to start over.
+    """
+    def __init__(self, session: requests.Session, url: str, response: requests.Response,
+                 retries: int = DOWNLOAD_RETRIES, metrics: Optional[RepoMetrics] = None):
+        self.session = session
+        self.url = url
+        self.response = response
+        self.retries = retries
+        self.metrics = metrics
+        self.offset = 0
+        self.resumes = 0
+        self.length = self._total_length(response)
+        # Only splice two responses together if they are for the same version of the tarball
+        self.validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+    @staticmethod
+    def _total_length(response: requests.Response) -> Optional[int]:
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2] if response.status_code == 206 else \
+            response.headers.get("Content-Length", "")
+        return int(total) if total.isdigit() else None
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            try:
+                data = self.response.raw.read(size)
+            except (TransferError, OSError) as exc:
+                self._resume(exc)
+                continue
+
+            if not data and self.length is not None and self.offset != self.length:
+                if self.offset > self.length:
+                    raise EOFError(f"{self.url}: received {self.offset} bytes, expected {self.length}")
+                self._resume(EOFError(f"connection closed after {self.offset} of {self.length} bytes"))
+                continue
+            self.offset += len(data)
+            return data
+
+    def _resume(self, exc: Exception) -> None:
+        if self.length is None:
+            click.echo(click.style(f"{self.url}: {exc} - no Content-Length to verify a resumed download against, "
+                                   "not resuming", fg="yellow"), err=True)
+            raise exc
+        if self.resumes == self.retries:
+            raise exc
+        self.resumes += 1
+        if self.metrics is not None:
+            self.metrics.retries += 1
+        self.response.close()
+        wait = backoff_delay(self.resumes - 1)
+        click.echo(click.style(f"{self.url}: {exc} - resuming at byte {self.offset} in {wait:.0f}s", fg="yellow"),
+                   err=True)
+        sleep(wait)
+
+        headers = {"Range": f"bytes={self.offset}-"}
+        if self.validator:
+            headers["If-Range"] = self.validator
+        response = self.session.get(self.url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT_SEC)
+        if response.status_code != 206 or \
+                not response.headers.get("Content-Range", "").startswith(f"bytes {self.offset}-"):
+            # The server ignored the range, or the tarball changed since: start over from scratch
+            response.close()
+            raise RequestException(f"{self.url}: could not resume at byte {self.offset} ({response.status_code})")
+        self.response = response
+        self.length = self._total_length(response) or self.length
+
+    def close(self) -> None:
+        self.response.close()
+
+
+def strip_top_dir(name: str) -> str:
+    """Strip the <owner>-<repo>-<sha> top directory of a GitHub tarball member name."""
+    parts = name.removeprefix("./").split("/", 1)
+    return parts[1] if len(parts) == 2 else ""
+
+
+def _members(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """Iterate over the members of a tarball with the top directory stripped from their names."""
+    for member in tar:
+        name = strip_top_dir(member.name)
+        if not name:
+            continue
+        member.name = name
+        if member.islnk():
+            member.linkname = strip_top_dir(member.linkname)
+        yield member
+
+
+def _is_under(name: str, roots: List[str]) -> bool:
+    return any(name == root or name.startswith(f"{root}/") for root in roots)
+
+
+def matches_exclude(name: str, excludes: List[str]) -> bool:
+    """
+    Whether a repository file matches one of the recipe exclude globs. Like in .gitignore files, a glob without
+    a slash matches a file or directory name at any depth, while any other glob matches paths from the repository
+    root. Everything under a matching directory is excluded too.
+    :param name: Path of the file, relative to the repository root
+    :param excludes: Exclude globs
+    """
+    parts = name.split("/")
+    prefixes = ["/".join(parts[:i + 1]) for i in range(len(parts))]
+    for pattern in excludes:
+        if "/" in pattern.rstrip("/"):
+            pattern = pattern.strip("/")
+            if any(fnmatch.fnmatchcase(prefix, pattern) for prefix in prefixes):
+                return True
+        elif any(fnmatch.fnmatchcase(part, pattern.rstrip("/")) for part in parts):
+            return True
+    return False
+
+
+def find_excluded_packages(fileobj, whitelist: List[str], mode: TarStreamMode = "r|gz") -> List[str]:
+    """Scan the package.xml members of a repository tarball for packages that aren't whitelisted
+    :param fileobj: Readable tar stream
+    :param whitelist: Names of the packages to keep
+    :param mode: tarfile stream mode, "r|gz" for gzipped or "r|" for plain tar streams
+    :returns: Directories of the packages to leave out, relative to the repository root
+    """
+    excluded = []
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in _members(tar):
+            if not member.isfile() or posixpath.basename(member.name) != "package.xml":
+                continue
+            path = posixpath.dirname(member.name)
+            # A package at the root of the repository can't be left out without dropping the whole repository
+            if not path:
+                continue
+            manifest = tar.extractfile(member)
+            assert manifest is not None
+            package = parse_package_string(manifest.read().decode("utf-8"), filename=member.name)
+            if package.name not in whitelist:
+                click.echo(f"Skipping {package.name}, not in whitelist", err=True)
+                excluded.append(path)
+    return excluded
+
+
+def extract_stream(fileobj, dest: pathlib.Path, whitelist: Optional[List[str]] = None,
+                   mode: TarStreamMode = "r|gz", metrics: Optional[RepoMetrics] = None,
+                   manifests: Optional[Dict[str, bytes]] = None, excludes: Optional[List[str]] = None) -> None:
+    """Decompress and extract a repository tarball, stripping its top directory
+    :param fileobj: Readable tar stream, e.g. an HTTP response. With a whitelist, package names are read in a
+        first pass over the member list, so a stream that can't seek is spooled to disk first.
+    :param dest: Directory where to extract the repository contents
+    :param whitelist: Names of the packages to extract. Packages that aren't listed are never written to disk,
+        while files outside of any package are always extracted. An empty whitelist extracts everything.
+    :param mode: tarfile stream mode, "r|gz" for gzipped or "r|" for plain tar streams
+    :param metrics: Metrics to record the extracted size and kept / pruned packages in
+    :param manifests: Filled with the package.xml contents of the extracted packages, by package folder relative
+        to dest, following the catkin_pkg crawling rules
+    :param excludes: Globs of the files to leave out, see matches_exclude
+    """
+    excluded: List[str] = []
+    if whitelist:
+        if not (hasattr(fileobj, "seekable") and fileobj.seekable()):
+            with tempfile.TemporaryFile() as spool:
+                shutil.copyfileobj(fileobj, spool, CHUNK_SIZE)
+                spool.seek(0)
+                extract_stream(spool, dest, whitelist, mode, metrics, manifests, excludes)
+            return
+        start = fileobj.tell()
+        excluded = find_excluded_packages(fileobj, whitelist, mode)
+        fileobj.seek(start)
+
+    dest.mkdir(parents=True, exist_ok=True)
+    directories = []
+    found: Dict[str, bytes] = {}
+    ignored: Set[str] = set()
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in _members(tar):
+            if excluded and _is_under(member.name, excluded):
+                continue
+            if excludes and (
+                matches_exclude(member.name, excludes) or member.islnk() and matches_exclude(member.linkname, excludes)
+            ):
+                continue
+
+            if metrics is not None and member.isfile():
+                metrics.extracted_bytes += member.size
+                metrics.packages_kept += posixpath.basename(member.name) == "package.xml"
+
+            if member.isdir():
+                # Like extractall, set directory permissions last in case they are read-only
+                directories.append(member)
+                tar.extract(member, path=dest, set_attrs=False)
             else:
-                raise RuntimeError(
-                    f"Could not obtain tarball URL for {repo_name}... (ref: {ref})"
-                )
-            out.append(
-                RepoInformation(
-                    owner=repo_owner,
-                    name=repo_name,
-                    exists=exists,
-                    sha=sha,
-                    tarball=tarball,
+                tar.extract(member, path=dest)
+
+            basename = posixpath.basename(member.name)
+            if basename in IGNORE_MARKERS:
+                ignored.add(posixpath.dirname(member.name))
+            elif basename == "package.xml" and member.isfile():
+                found[posixpath.dirname(member.name)] = (dest / member.name).read_bytes()
+
+        for member in sorted(directories, key=lambda m: m.name, reverse=True):
+            dirpath = str(dest / member.name)
+            tar.chown(member, dirpath, False)
+            tar.utime(member, dirpath)
+            tar.chmod(member, dirpath)
+
+    if metrics is not None:
+        metrics.packages_pruned += len(excluded)
+    if manifests is not None:
+        manifests.update(discover_packages(found, ignored))
+
+
+class TarballDownloader:
+    """Downloads repository tarballs over pooled keep-alive connections, with adaptive concurrency."""
+    def __init__(self, limiter: Optional[AdaptiveLimiter] = None):
+        self.limiter = limiter or AdaptiveLimiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.limiter.maximum, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def download_and_extract(self, repo: str, tarball_url: str, dest: pathlib.Path,
+                             cache_entry: Optional[Tuple[TarballCache, str, str]] = None,
+                             whitelist: Optional[List[str]] = None, metrics: Optional[RepoMetrics] = None,
+                             manifests: Optional[Dict[str, bytes]] = None,
+                             excludes: Optional[List[str]] = None) -> None:
+        """Stream a repository tarball straight from its URL into dest, retrying on network errors
+        :param repo: Name of the repository
+        :param tarball_url: Tarball URL
+        :param dest: Directory where to extract the repository contents
+        :param cache_entry: (cache, owner, sha) to store the downloaded tarball under
+        :param whitelist: Names of the packages to extract, see extract_stream
+        :param metrics: Metrics of the repository to fill in
+        :param manifests: Filled with the package manifests of the repository, see extract_stream
+        :param excludes: Globs of the files to leave out, see matches_exclude
+        """
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            if dest.exists():
+                rmtree(dest)
+            if metrics is not None:
+                # Only the successful attempt is reported, apart from the retry count
+                metrics.bytes_downloaded = metrics.extracted_bytes = 0
+                metrics.packages_kept = metrics.packages_pruned = 0
+            if manifests is not None:
+                manifests.clear()
+
+            delay = None
+            try:
+                with self.limiter.slot():
+                    with self.session.get(tarball_url, stream=True, timeout=DOWNLOAD_TIMEOUT_SEC) as response:
+                        if response.status_code in THROTTLE_STATUS_CODES:
+                            delay = throttle_delay(response)
+                        if delay is not None:
+                            self.limiter.throttle(max(delay, backoff_delay(attempt)))
+                        response.raise_for_status()
+                        self._extract(repo, response, dest, cache_entry, whitelist, metrics, manifests, excludes)
+                return
+            except (RequestException, TransferError, OSError, EOFError, tarfile.TarError) as exc:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise RuntimeError(f"{repo}: download failed ({exc})") from exc
+                if metrics is not None:
+                    metrics.retries += 1
+
+                # Throttled requests wait for the limiter to resume instead of sleeping here
+                wait = 0.0 if delay is not None else backoff_delay(attempt)
+                click.echo(
+                    click.style(
+                        f"{repo}: {exc} - retrying in {wait:.0f}s "
+                        f"({DOWNLOAD_RETRIES - attempt} left)",
+                        fg="yellow",
+                    ),
+                    err=True,
                 )
-            )
-    return out
+                sleep(wait)
 
+    def _extract(self, repo: str, response: requests.Response, dest: pathlib.Path,
+                 cache_entry: Optional[Tuple[TarballCache, str, str]], whitelist: Optional[List[str]],
+                 metrics: Optional[RepoMetrics], manifests: Optional[Dict[str, bytes]],
+                 excludes: Optional[List[str]]) -> None:
+        stream = ResumableStream(self.session, response.url, response, metrics=metrics)
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".tar.gz") if cache_entry is not None else nullcontext() as tmp:
+                reader = StreamReader(stream, self.limiter, tmp, metrics)
+                if whitelist and tmp is not None:
+                    # Package names are scanned before extracting, reuse the tarball being cached as the seekable
+                    # source rather than spooling the download a second time
+                    while reader.read(CHUNK_SIZE):
+                        pass
+                    tmp.flush()
+                    tmp.seek(0)
+                    extract_stream(tmp, dest, whitelist, metrics=metrics, manifests=manifests, excludes=excludes)
+                else:
+                    extract_stream(reader, dest, whitelist, metrics=metrics, manifests=manifests, excludes=excludes)
+                # Read the end-of-archive padding too, so the download is verified to be complete and the
+                # cached tarball is whole
+                while reader.read(CHUNK_SIZE):
+                    pass
+                if cache_entry is not None and tmp is not None:
+                    cache, owner, sha = cache_entry
+                    tmp.flush()
+                    cache.put(owner, repo, sha, pathlib.Path(tmp.name))
+        finally:
+            stream.close()
 
-def process_repo(repo: str, tarball_url: str, target_dir: pathlib.Path) -> pathlib.Path:
-    """Download and unpack a single repository using its tarball URL
+
+def process_repo(
+    repo: str,
+    tarball_url: str,
+    target_dir: pathlib.Path,
+    owner: Optional[str] = None,
+    sha: Optional[str] = None,
+    cache: Optional[TarballCache] = None,
+    downloader: Optional[TarballDownloader] = None,
+    whitelist: Optional[List[str]] = None,
+    metrics: Optional[RepoMetrics] = None,
+    manifests: Optional[Dict[str, bytes]] = None,
+    excludes: Optional[List[str]] = None,
+) -> pathlib.Path:
+    """Download and unpack a single repository using its tarball URL. The tarball is extracted while it
+    is downloaded, and is only kept on disk if a cache is used.
     :param repo: Name of the repository
     :param tarball_url: Tarball URL
     :param target_dir: Directory where to unpack the repositoriess
+    :param owner: Owner of the repository, used as part of the cache key
+    :param sha: Commit SHA the tarball was generated from, used as part of the cache key
+    :param cache: Tarball cache to consult before downloading
+    :param downloader: Downloader shared between all repositories of a pull
+    :param whitelist: Names of the packages to extract, all packages are extracted if empty
+    :param metrics: Metrics of the repository to fill in
+    :param manifests: Filled with the package manifests of the repository, by package folder relative to the
+        returned path
+    :param excludes: Globs of the files to leave out, see matches_exclude
     :returns: the relative path where the repository has been extracted
     """
-    repo_dir = target_dir / repo
-    repo_dir.mkdir(parents=True, exist_ok=True)
-    retries = DOWNLOAD_RETRIES
-    while True:
-        try:
-            tmp = tempfile.NamedTemporaryFile(delete=False, dir=repo_dir)
-            with request.urlopen(tarball_url, timeout=60) as src:
-                while True:
-                    chunk = src.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    tmp.write(chunk)
-            tmp.close()
-            archive_path = repo_dir / f"{repo}.tar.gz"
-            pathlib.Path(tmp.name).replace(archive_path)
-            break
-        except (error.HTTPError, error.URLError, OSError) as exc:
-            if retries == 0:
-                raise RuntimeError(f"{repo}: download failed ({exc})") from exc
-            retries -= 1
-            click.echo(
-                click.style(
-                    f"{repo}: {exc} - retrying in {RETRY_WAIT_SECONDS}s "
-                    f"({retries} left)",
-                    fg="yellow",
-                ),
-                err=True,
-            )
-            sleep(RETRY_WAIT_SECONDS)
-    with tarfile.open(archive_path) as tar:
-        tar.extractall(path=repo_dir)
-
-    # Rename the extracted dir as the repository name without any sha
-    extracted_dir = None
-    extracted_dir = next(
-        name for name in os.listdir(repo_dir)
-        if os.path.isdir(os.path.join(repo_dir, name))
-    )
-    if extracted_dir is not None:
-        os.rename(
-            os.path.join(repo_dir, extracted_dir),
-            os.path.join(repo_dir, repo),
+    start = time.monotonic()
+    repo_path = target_dir / repo / repo
+    # Extract next to the destination and swap it in once complete, so a previous checkout stays intact
+    # until the new one is ready.
+    staging_path = repo_path.with_name(f".{repo}.partial")
+    downloader = downloader or TarballDownloader()
+
+    cached = cache.get(owner, repo, sha) if cache is not None and owner and sha else None
+    if cached is not None:
+        click.echo(f"Using cached tarball for {repo} (sha: {sha})")
+        if metrics is not None:
+            metrics.status = "cached"
+        if staging_path.exists():
+            rmtree(staging_path)
+        with open(cached, "rb") as f:
+            extract_stream(f, staging_path, whitelist, metrics=metrics, manifests=manifests, excludes=excludes)
+    elif cache is not None and owner and sha:
+        downloader.download_and_extract(
+            repo, tarball_url, staging_path, (cache, owner, sha), whitelist, metrics, manifests, excludes,
         )
+    else:
+        downloader.download_and_extract(
+            repo, tarball_url, staging_path, whitelist=whitelist, metrics=metrics, manifests=manifests,
+            excludes=excludes,
+        )
+
+    swap_in(staging_path, repo_path)
+    if metrics is not None:
+        metrics.extract_seconds = time.monotonic() - start - metrics.download_seconds
+    return repo_path
+
+
+def swap_in(staged: pathlib.Path, dest: pathlib.Path) -> None:
+    """Replace dest by staged. dest is only missing between two renames, never partially written.
+    :param staged: Fully extracted directory
+    :param dest: Directory to replace
+    """
+    if not dest.exists():
+        staged.rename(dest)
+        return
+
+    old = dest.with_name(f".{dest.name}.old")
+    if old.exists():
+        rmtree(old)
+    dest.rename(old)
+    staged.rename(dest)
+    rmtree(old)
+
 
-    # Return the path of the extracted repository
-    dirs = [p for p in repo_dir.iterdir() if p.is_dir()]
-    if len(dirs) == 1:
-        return dirs[0]
-    return repo_dir
+def covers(whitelist: Optional[List[str]], other: Optional[List[str]]) -> bool:
+    """Whether a checkout extracted with whitelist contains every package a checkout with other would."""
+    return not whitelist or bool(other) and set(other or ()) <= set(whitelist)
 
 
-def append_jsonl(log_path: pathlib.Path, repo_info: RepoInformation, repo_path: pathlib.Path) -> None:
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Across filesystems, or on filesystems without hard links
+        shutil.copy2(src, dst)
+
+
+def link_repo(
+    source: "Future[pathlib.Path]",
+    source_manifests: Dict[str, bytes],
+    repo: str,
+    target_dir: pathlib.Path,
+    whitelist: Optional[List[str]] = None,
+    metrics: Optional[RepoMetrics] = None,
+    manifests: Optional[Dict[str, bytes]] = None,
+) -> pathlib.Path:
+    """Materialize a repository already extracted for another distribution, by hard linking its files.
+    :param source: Pull of the same repository at the same SHA, whose checkout covers the whitelist
+    :param source_manifests: Package manifests of that checkout, filled in once source is done
+    :param repo: Name of the repository
+    :param target_dir: Directory where to create the repository
+    :param whitelist: Names of the packages to keep, all packages of the source are kept if empty
+    :param metrics: Metrics of the repository to fill in
+    :param manifests: Filled with the package manifests of the repository, see extract_stream
+    :returns: the path where the repository has been created
+    """
+    source_path = source.result()
+    start = time.monotonic()
+    repo_path = target_dir / repo / repo
+    staging_path = repo_path.with_name(f".{repo}.partial")
+    if staging_path.exists():
+        rmtree(staging_path)
+
+    excluded = {
+        path for path, manifest in source_manifests.items()
+        if whitelist and parse_package_string(manifest.decode("utf-8")).name not in whitelist
+    }
+
+    def ignore(directory: str, names: List[str]) -> Set[str]:
+        relative = pathlib.Path(directory).relative_to(source_path)
+        return {name for name in names if (relative / name).as_posix() in excluded}
+
+    click.echo(f"Linking {repo} from {source_path}")
+    shutil.copytree(source_path, staging_path, symlinks=True, ignore=ignore, copy_function=_link_or_copy)
+    swap_in(staging_path, repo_path)
+
+    if manifests is not None:
+        manifests.update({path: manifest for path, manifest in source_manifests.items() if path not in excluded})
+    if metrics is not None:
+        metrics.status = "linked"
+        metrics.packages_kept = len(source_manifests) - len(excluded)
+        metrics.packages_pruned = len(excluded)
+        metrics.extract_seconds = time.monotonic() - start
+    return repo_path
+
+
+class FetchBackend(ABC):
+    """Resolves refs of, and fetches, repositories hosted on a particular kind of server."""
+
+    @abstractmethod
+    def handles(self, url: str) -> bool:
+        """Whether this backend can fetch the repository at url."""
+
+    @abstractmethod
+    def resolve(self, urls: List[str], refs: List[str]) -> Iterator[RepoInformation]:
+        """
+        Resolve refs of repositories to commit SHAs.
+        :param urls: Repository URLs
+        :param refs: Branch, tag or SHA to resolve for each repository
+        :returns: an iterator of RepoInformation objects, in any order
+        """
+
+    @abstractmethod
+    def fetch(self, repo: RepoInformation, target_dir: pathlib.Path, whitelist: Optional[List[str]],
+              metrics: Optional[RepoMetrics] = None, manifests: Optional[Dict[str, bytes]] = None,
+              excludes: Optional[List[str]] = None) -> pathlib.Path:
+        """
+        Fetch a resolved repository into target_dir/<repo>/<repo>.
+        :param manifests: Filled with the package manifests of the repository, see extract_stream
+        :param excludes: Globs of the files to leave out, see matches_exclude
+        :returns: the path where the repository has been extracted
+        """
+
+
+class GitHubBackend(FetchBackend):
+    """Resolves refs through the GraphQL API and downloads commit tarballs from GitHub."""
+    def __init__(self, github_client, cache: Optional[TarballCache] = None,
+                 downloader: Optional[TarballDownloader] = None, report: Optional[PullReport] = None,
+                 ref_cache: Optional[RefCache] = None):
+        self.github_client = github_client
+        self.cache = cache
+        self.downloader = downloader or TarballDownloader()
+        self.report = report
+        self.ref_cache = ref_cache
+
+    def handles(self, url: str) -> bool:
+        return urlparse(url).hostname in ("github.com", "www.github.com")
+
+    def resolve(self, urls: List[str], refs: List[str]) -> Iterator[RepoInformation]:
+        return retrieve_tarballs(urls, refs, self.github_client, report=self.report, ref_cache=self.ref_cache)
+
+    def fetch(self, repo: RepoInformation, target_dir: pathlib.Path, whitelist: Optional[List[str]],
+              metrics: Optional[RepoMetrics] = None, manifests: Optional[Dict[str, bytes]] = None,
+              excludes: Optional[List[str]] = None) -> pathlib.Path:
+        return process_repo(
+            repo.name, repo.tarball, target_dir, repo.owner, repo.sha, self.cache, self.downloader, whitelist,
+            metrics, manifests, excludes,
+        )
+
+
+class GitBackend(FetchBackend):
+    """
+    Fetches any git repository into a persistent cache of bare repositories, one per URL. Every fetch is
+    shallow, so only the objects of the requested commit that aren't in the cache yet are transferred.
+    """
+    def __init__(self, cache_dir: pathlib.Path = DEFAULT_GIT_CACHE, max_workers: int = PULL_WORKERS):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def handles(self, url: str) -> bool:
+        return True
+
+    @staticmethod
+    def _git(*args: str, **kwargs) -> subprocess.CompletedProcess:
+        kwargs.setdefault("check", True)
+        return subprocess.run(["git", *args], capture_output=True, text=True, **kwargs)
+
+    @staticmethod
+    def _name_and_owner(url: str) -> Tuple[str, str]:
+        path = url.rstrip("/").removesuffix(".git")
+        path = path.split(":", 1)[1] if "://" not in path and ":" in path else urlparse(path).path
+        owner, _, name = path.strip("/").rpartition("/")
+        return owner, name
+
+    def _resolve_one(self, url: str, ref: str) -> RepoInformation:
+        owner, name = self._name_and_owner(url)
+        if re.fullmatch(r"[0-9a-f]{40}", ref):
+            sha = ref
+        else:
+            # ls-remote matches patterns against the tail of ref names, e.g. main also matches feature/main, so
+            # only exact names count. The commit an annotated tag points to comes first, then tags, then branches.
+            if ref.startswith("refs/"):
+                candidates = [f"{ref}^{{}}", ref]
+            else:
+                candidates = [f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", f"refs/heads/{ref}"]
+            lines = self._git("ls-remote", url, *candidates).stdout.splitlines()
+            refs = dict(reversed(line.split("\t", 1)) for line in lines)
+            matches = [refs[candidate] for candidate in candidates if candidate in refs]
+            if not matches:
+                raise RuntimeError(f"Could not resolve {name}... (ref: {ref})")
+            sha = matches[0]
+
+        click.echo(f"Resolved {name} with git... (ref: {ref}, sha: {sha})")
+        return RepoInformation(owner=owner, name=name, exists=True, sha=sha, tarball=url)
+
+    def resolve(self, urls: List[str], refs: List[str]) -> Iterator[RepoInformation]:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self._resolve_one, url, ref) for url, ref in zip(urls, refs)]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def bare_repo(self, url: str) -> pathlib.Path:
+        _, name = self._name_and_owner(url)
+        return self.cache_dir / f"{name}-{hashlib.sha256(url.encode()).hexdigest()[:12]}.git"
+
+    def _lock(self, path: pathlib.Path) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(str(path), threading.Lock())
+
+    @staticmethod
+    def _objects_size(bare: pathlib.Path) -> int:
+        return sum(f.stat().st_size for f in (bare / "objects").rglob("*") if f.is_file())
+
+    def fetch(self, repo: RepoInformation, target_dir: pathlib.Path, whitelist: Optional[List[str]],
+              metrics: Optional[RepoMetrics] = None, manifests: Optional[Dict[str, bytes]] = None,
+              excludes: Optional[List[str]] = None) -> pathlib.Path:
+        start = time.monotonic()
+        url = repo.tarball
+        bare = self.bare_repo(url)
+        repo_path = target_dir / repo.name / repo.name
+        staging_path = repo_path.with_name(f".{repo.name}.partial")
+        if staging_path.exists():
+            rmtree(staging_path)
+
+        # Serialize on the bare repository, both between threads and between pulls sharing the cache
+        bare.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock(bare), open(bare.with_suffix(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not bare.exists():
+                self._git("init", "--bare", "--quiet", str(bare))
+                self._git("-C", str(bare), "remote", "add", "origin", url)
+
+            if self._git("-C", str(bare), "cat-file", "-t", repo.sha, check=False).stdout.strip() != "commit":
+                click.echo(f"Fetching {repo.name} into {bare}... (sha: {repo.sha})")
+                objects_size = self._objects_size(bare)
+                try:
+                    self._git("-C", str(bare), "fetch", "--quiet", "--depth", "1", "--no-tags", "origin", repo.sha)
+                except subprocess.CalledProcessError:
+                    # Not every server allows fetching a commit by SHA, but the SHA was resolved from a ref tip
+                    self._git("-C", str(bare), "fetch", "--quiet", "--depth", "1", "origin",
+                              "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")
+                if metrics is not None:
+                    metrics.download_seconds = time.monotonic() - start
+                    metrics.bytes_downloaded = self._objects_size(bare) - objects_size
+            else:
+                click.echo(f"Using cached git objects for {repo.name} (sha: {repo.sha})")
+                if metrics is not None:
+                    metrics.status = "cached"
+
+            # Prefix the archive the way GitHub tarballs are, the extractor strips the top directory
+            archive = subprocess.Popen(
+                ["git", "-C", str(bare), "archive", "--format=tar", f"--prefix={repo.name}-{repo.sha}/", repo.sha],
+                stdout=subprocess.PIPE,
+            )
+            assert archive.stdout is not None
+            try:
+                extract_stream(
+                    archive.stdout, staging_path, whitelist, mode="r|", metrics=metrics, manifests=manifests,
+                    excludes=excludes,
+                )
+            finally:
+                archive.stdout.close()
+                if archive.wait() != 0:
+                    raise RuntimeError(f"{repo.name}: git archive failed with {archive.returncode}")
+
+        swap_in(staging_path, repo_path)
+        if metrics is not None:
+            metrics.extract_seconds = time.monotonic() - start - metrics.download_seconds
+        return repo_path
+
+
+def append_jsonl(log_path: pathlib.Path, repo_info: RepoInformation, repo_path: pathlib.Path,
+                 whitelist: Optional[List[str]] = None, excludes: Optional[List[str]] = None) -> None:
     """Append repository information to json log file
     :param log_path: path of the log file
     :param repo_info: RepoInformation object containing all relevant data
     :param repo_path: Path where the repository has been extracted to
+    :param whitelist: Packages that were extracted from the repository, if not all of them
+    :param excludes: Globs of the files that were left out
     """
 
     log_path.parent.mkdir(parents=True, exist_ok=True)
@@ -219,70 +1087,379 @@ def append_jsonl(log_path: pathlib.Path, repo_info: RepoInformation, repo_path:
         "repo": repo_info.name,
         "sha": repo_info.sha,
         "path": str(repo_path),
+        "whitelist": whitelist,
+        "excludes": excludes,
     }
     line = json.dumps(repo_log, ensure_ascii=False) + "\n"
     with open(log_path, "a", encoding="utf-8") as f:
         f.write(line)
 
 
+def load_jsonl(log_path: pathlib.Path) -> Dict[str, Dict[str, Any]]:
+    """Load the repository information written by append_jsonl
+    :param log_path: path of the log file
+    :returns: Repository information by repository name, empty if there is no log
+    """
+    if not log_path.exists():
+        return {}
+    with open(log_path, "r", encoding="utf-8") as f:
+        return {info["repo"]: info for info in map(json.loads, f) if info}
+
+
+def is_unchanged(pull: RepoPull, previous: Optional[Dict[str, Any]]) -> bool:
+    """Whether a repository is already on disk at the resolved SHA, with the same whitelist and excludes."""
+    return (
+        previous is not None
+        and previous["sha"] == pull.repo.sha
+        and previous.get("whitelist") == pull.whitelist
+        and previous.get("excludes") == pull.excludes
+        and pathlib.Path(previous["path"]).is_dir()
+    )
+
+
 def pull_repositories(
-    repo_data: List[RepoInformation], base_dir: pathlib.Path, distro_name: str
-) -> None:
-    """Download and unpack a list of repository tarballs
-    :param repo_data: List of RepoInformation class
-    :param base_dir: Directory where to unpack the repositories
-    :param distro_name: Name of the distribution
+    repo_data: Iterable[RepoPull],
+    src_dir: pathlib.Path,
+    cache: Optional[TarballCache] = None,
+    previous: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None,
+    downloader: Optional[TarballDownloader] = None,
+    report: Optional[PullReport] = None,
+) -> Dict[str, Set[str]]:
+    """Download and unpack repository tarballs of any number of distributions through one shared pool.
+    Downloads start as repo_data yields them.
+    :param repo_data: Iterable of RepoPull class
+    :param src_dir: Directory where to unpack the repositories, in a folder per distribution
+    :param cache: Tarball cache to consult before downloading
+    :param previous: Repository information of the existing checkouts by distribution, see load_jsonl.
+        Repositories that are unchanged are left untouched.
+    :param downloader: Downloader for repositories without a fetch backend, whose limiter sizes the pool
+    :param report: Report to record the metrics of every repository in
+    :returns: Names of the repositories pulled, by distribution
+    A repository that more than one distribution pulls at the same SHA is only fetched once, and hard linked
+    into the other distributions when the whitelists allow it.
+    A package index of every distribution is written next to its repositories data, see package_index. It also
+    keeps the packages of repositories that an earlier call logged since the log was last reset.
     """
     click.echo("Download and unpack repositories...", err=False)
-    base_dir.mkdir(parents=True, exist_ok=True)
-    logfile_path = base_dir / f"{distro_name}_repositories_data.jsonl"
+    downloader = downloader or TarballDownloader()
+    previous = previous or {}
+    pulled: Dict[str, Set[str]] = {}
+    index: Dict[str, List[Dict[str, Any]]] = {}
+    previous_index: Dict[str, List[Dict[str, Any]]] = {}
 
-    with ThreadPoolExecutor(max_workers=PULL_WORKERS) as pool:
-        futures = {
-            pool.submit(process_repo, repo.name, repo.tarball, base_dir): repo
-            for repo in repo_data
-            if repo.exists
-        }
+    def log_path(distro: str) -> pathlib.Path:
+        return src_dir / distro / f"{distro}_repositories_data.jsonl"
+
+    def add_to_index(distro: str, repo: str, repo_path: pathlib.Path, manifests: Dict[str, bytes]) -> None:
+        # Package paths are relative to the distribution folder, like catkin_pkg reports them
+        repo_dir = pathlib.PurePosixPath(repo_path.parent.name, repo_path.name)
+        index.setdefault(distro, []).extend(
+            index_entry(repo, str(repo_dir / path), manifest) for path, manifest in manifests.items()
+        )
+
+    def reuse_index(distro: str, repo: str, repo_path: pathlib.Path) -> None:
+        if distro not in previous_index:
+            previous_index[distro] = load_package_index(package_index_path(src_dir / distro, distro))
+        entries = [entry for entry in previous_index[distro] if entry["repo"] == repo]
+        if entries:
+            index.setdefault(distro, []).extend(entries)
+        else:
+            # Checkouts from before package indexes were written have to be read from disk once
+            add_to_index(distro, repo, repo_path, scan_packages(repo_path))
+
+    # The pool is sized for the largest concurrency the limiter may reach, which gates the actual downloads
+    with ThreadPoolExecutor(max_workers=downloader.limiter.maximum) as pool:
+        futures = {}
+        # First pull of every (owner, name, sha), to share with the other distributions
+        fetched: Dict[Tuple[str, str, str], Tuple[Future, RepoPull, Dict[str, bytes]]] = {}
+        for pull in repo_data:
+            if not pull.repo.exists:
+                continue
+            pulled.setdefault(pull.distro, set()).add(pull.repo.name)
+            metrics = report.repo(pull.distro, pull.repo.name, pull.repo.sha) if report is not None else None
+
+            existing = previous.get(pull.distro, {}).get(pull.repo.name)
+            if is_unchanged(pull, existing):
+                assert existing is not None
+                click.echo(f"{pull.repo.name} is up to date (sha: {pull.repo.sha})")
+                if metrics is not None:
+                    metrics.status = "unchanged"
+                append_jsonl(
+                    log_path(pull.distro), pull.repo, pathlib.Path(existing["path"]), pull.whitelist, pull.excludes,
+                )
+                reuse_index(pull.distro, pull.repo.name, pathlib.Path(existing["path"]))
+                continue
+
+            manifests: Dict[str, bytes] = {}
+            key = (pull.repo.owner, pull.repo.name, pull.repo.sha)
+            shared = fetched.get(key)
+            if (
+                shared is not None and shared[1].distro != pull.distro and shared[1].excludes == pull.excludes
+                and covers(shared[1].whitelist, pull.whitelist)
+            ):
+                # The pool runs tasks in submission order, so the fetch this waits on is already running
+                future = pool.submit(
+                    link_repo, shared[0], shared[2], pull.repo.name, src_dir / pull.distro, pull.whitelist, metrics,
+                    manifests,
+                )
+            elif pull.backend is not None:
+                future = pool.submit(
+                    pull.backend.fetch, pull.repo, src_dir / pull.distro, pull.whitelist, metrics, manifests,
+                    pull.excludes,
+                )
+            else:
+                future = pool.submit(
+                    process_repo, pull.repo.name, pull.repo.tarball, src_dir / pull.distro, pull.repo.owner,
+                    pull.repo.sha, cache, downloader, pull.whitelist, metrics, manifests, pull.excludes,
+                )
+            futures[future] = (pull, manifests)
+            fetched.setdefault(key, (future, pull, manifests))
 
         for future in as_completed(futures):
-            repo_info = futures[future]
+            pull, manifests = futures[future]
             try:
                 repo_path = future.result()
             except Exception as exc:
                 click.echo(
-                    click.style(f"[✗] Could not download {repo_info.name}: {exc}", fg="red"),
+                    click.style(f"[✗] Could not download {pull.repo.name}: {exc}", fg="red"),
                     err=True,
                 )
                 raise
-            append_jsonl(logfile_path, repo_info, repo_path)
+            append_jsonl(log_path(pull.distro), pull.repo, repo_path, pull.whitelist, pull.excludes)
+            add_to_index(pull.distro, pull.repo.name, repo_path, manifests)
 
+    for distro, repos in pulled.items():
+        # Keep the packages of repositories logged by an earlier round of the same pull
+        index_path = package_index_path(src_dir / distro, distro)
+        logged = load_jsonl(log_path(distro)).keys() - repos
+        kept = [entry for entry in load_package_index(index_path) if entry["repo"] in logged]
+        write_package_index(index_path, kept + index.get(distro, []))
 
+    click.echo(f"Downloads finished with a concurrency limit of {downloader.limiter.limit}")
+    return pulled
 
-def remove_packages(whitelisted_pkgs: Dict[str, List[str]]) -> None:
-    """
-    Remove all except whitelisted packages
-    param: whitelisted_pkgs: List of whitelisted packages
+
+def distro_repositories(
+    distro, distro_options: Mapping[str, Any], only: Optional[Set[str]] = None,
+) -> Tuple[List[str], List[str], Dict[str, List[str]]]:
+    """List the repositories of a ROS distribution
+    :param distro: rosdistro distribution file
+    :param distro_options: Recipe options of the distribution
+    :param only: Names of the repositories to list, all of them if None
+    :returns: Tuple {repository urls, refs, whitelisted packages by repository name}
     """
-    for repo_dir, whitelist in whitelisted_pkgs.items():
-        # skip if no whitelist (i.e. keep everything)
-        if not whitelist:
+    repo_ids = []
+    refs = []
+    whitelisted_pkgs: Dict[str, List[str]] = {}
+    for repo_name, distro_data in distro.repositories.items():
+        if only is not None and repo_name not in only:
             continue
+
+        # release.url overrides source.url. In most cases they should be equivalent, but sometimes we want to
+        # pull from a bloomed repository with patches
         try:
-            found_packages = glob.glob(str(repo_dir / "**/package.xml"), recursive=True)
-            for package_xml_path in found_packages:
-                package = parse_package(package_xml_path)
-                if package.name not in whitelist:
-                    click.echo(f"Removing {package.name}, not in whitelist", err=True)
-                    shutil.rmtree(pathlib.Path(package_xml_path).parent.resolve())
-        except Exception as e:
-            click.echo(
-                click.style(
-                    f"Unable to reduce {repo_dir} to whitelist {whitelist}: {e}",
-                    fg="yellow",
-                ),
-                err=True,
+            url = distro_data.release_repository.url
+        except AttributeError:
+            url = distro_data.source_repository.url
+
+        # We're fitting to the rosdistro standard here, release.tags.release is a template that can take
+        # parameters, though in our case it's usually just '{{ version }}'.
+        if (
+            distro_data.release_repository
+            and distro_data.release_repository.version is not None
+        ):
+            version_template = distro_data.release_repository.tags["release"]
+            context = {
+                "package": repo_name,
+                "upstream": distro_options["upstream"]["name"],
+                "version": distro_data.release_repository.version,
+            }
+            version = (
+                Environment(loader=BaseLoader())
+                .from_string(version_template)
+                .render(**context)
+            )
+        else:
+            version = distro_data.source_repository.version
+
+        # Repurpose the rosdistro 'release.packages' field as an optional whitelist to prevent building
+        # packages we don't want.
+        if (
+            distro_data.release_repository
+            and distro_data.release_repository.package_names != [repo_name]
+        ):
+            whitelisted_pkgs[repo_name] = (
+                distro_data.release_repository.package_names
             )
-            raise
+
+        repo_ids.append(url)
+        refs.append(version)
+
+    return repo_ids, refs, whitelisted_pkgs
+
+
+def source_excludes(excludes: Mapping[str, Any], repo_name: str) -> Optional[List[str]]:
+    """Exclude globs of a repository, from the recipe 'source_excludes' option:
+        source_excludes:
+          global: ["*.bag", ".github"]
+          repositories:
+            some_repo: ["docs", "test/fixtures"]
+    :param excludes: Value of the source_excludes option
+    :param repo_name: Name of the repository
+    :returns: Globs of the repository files to leave out, None if there are none
+    """
+    globs = list(excludes.get("global", [])) + list(excludes.get("repositories", {}).get(repo_name, []))
+    return globs or None
+
+
+def resolve_distro(
+    index, distro_name: str, distro_options: Mapping[str, Any], backends: List[FetchBackend],
+    excludes: Optional[Mapping[str, Any]] = None, only: Optional[Set[str]] = None,
+) -> Iterator[RepoPull]:
+    """Resolve the refs of all repositories in a ROS distribution
+    :param index: rosdistro index
+    :param distro_name: Name of the distribution
+    :param distro_options: Recipe options of the distribution
+    :param backends: Fetch backends, each repository is handled by the first one that supports its URL
+    :param excludes: Recipe source_excludes option, see source_excludes
+    :param only: Names of the repositories to resolve, all of them if None
+    :returns: an iterator of RepoPull objects, as their refs are resolved
+    """
+    click.echo(click.style(f"Processing repositories for {distro_name} distro...", fg="green"), err=False)
+    distro = rosdistro.get_distribution(index, distro_name)
+    repo_ids, refs, whitelisted_pkgs = distro_repositories(distro, distro_options, only)
+
+    groups: Dict[int, Tuple[List[str], List[str]]] = {}
+    for url, ref in zip(repo_ids, refs):
+        backend_idx = next(i for i, backend in enumerate(backends) if backend.handles(url))
+        urls, backend_refs = groups.setdefault(backend_idx, ([], []))
+        urls.append(url)
+        backend_refs.append(ref)
+
+    def resolve_group(backend: FetchBackend, urls: List[str], backend_refs: List[str]) -> Iterator[RepoPull]:
+        for repo in backend.resolve(urls, backend_refs):
+            yield RepoPull(
+                distro_name, repo, whitelisted_pkgs.get(repo.name), backend, source_excludes(excludes or {}, repo.name),
+            )
+
+    yield from prefetch([resolve_group(backends[idx], *group) for idx, group in groups.items()])
+
+
+def load_graph_packages(graph_paths: List[pathlib.Path]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Read the packages of graphs written by generate_graphs, merging the graphs of every OS version
+    :param graph_paths: Graph files
+    :returns: Package data by name, by distribution
+    """
+    packages: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for path in graph_paths:
+        for distro_name, distro_packages in yaml.safe_load(path.read_text())["packages"].items():
+            packages.setdefault(distro_name, {}).update(distro_packages)
+    return packages
+
+
+def needed_repositories(
+    graph: Mapping[str, Mapping[str, Mapping[str, Any]]], recipes: Mapping[str, Any]
+) -> Optional[Dict[str, Optional[Set[str]]]]:
+    """
+    Find the repositories holding the dependency closure of the root packages of every flavour, according to a
+    previous graph.
+    :param graph: Packages of the graph, see load_graph_packages
+    :param recipes: Recipe configuration
+    :returns: Names of the repositories needed by distribution, None for distributions where all of them are,
+        or None if the closure can't be determined from the graph
+    """
+    roots: Dict[str, Optional[Set[str]]] = {distro_name: set() for distro_name in recipes["common"]["distributions"]}
+    for flavour_data in recipes.get("flavours", {}).values():
+        for distro_name, distro_data in flavour_data.get("distributions", {}).items():
+            if distro_name not in roots:
+                continue
+            root_packages = (distro_data or {}).get("root_packages")
+            distro_roots = roots[distro_name]
+            if not root_packages:
+                # The flavour builds the whole distribution
+                roots[distro_name] = None
+            elif distro_roots is not None:
+                distro_roots.update(root_packages)
+
+    needed: Dict[str, Optional[Set[str]]] = {
+        distro_name: None if not distro_roots else set() for distro_name, distro_roots in roots.items()
+    }
+    stack = [(distro_name, name) for distro_name, distro_roots in roots.items() for name in distro_roots or ()]
+    visited = set()
+    while stack:
+        distro_name, name = stack.pop()
+        if (distro_name, name) in visited:
+            continue
+        visited.add((distro_name, name))
+
+        package = graph.get(distro_name, {}).get(name)
+        if package is None:
+            click.echo(click.style(f"{name} isn't in the {distro_name} graph, pulling everything", fg="yellow"))
+            return None
+        distro_repos = needed.get(distro_name)
+        if distro_repos is not None:
+            distro_repos.add(pathlib.PurePath(package["path"]).parts[0])
+        stack.extend((distro_name, dep.split(":", 1)[1]) for dep in package.get("source_depends", []))
+        stack.extend(("ros1", dep) for dep in package.get("ros1_depends", []))
+    return needed
+
+
+def rosdep_keys() -> Set[str]:
+    """Get the keys of the rosdep database, the dependencies generate_graphs resolves to system packages"""
+    lookup = RosdepLookup.create_from_rospkg(sources_loader=SourcesListLoader.create_default())
+    return set(lookup.get_rosdep_view(DEFAULT_VIEW_KEY).keys())
+
+
+def missing_repositories(
+    index: List[Dict[str, Any]], graph: Mapping[str, Mapping[str, Any]], repo_names: Set[str],
+    requested: Set[str], conditions: Mapping[str, Any], system_keys: Set[str],
+) -> Optional[Set[str]]:
+    """
+    Find the repositories that the pulled packages depend on, but weren't pulled. Packages can have gained
+    dependencies since the graph was generated.
+    :param index: Package index of the pulled repositories of a distribution
+    :param graph: Packages of the distribution in the previous graph
+    :param repo_names: Names of all repositories of the distribution
+    :param requested: Names of the repositories pulled so far
+    :param conditions: Environment the dependency conditions are evaluated in
+    :param system_keys: Dependencies resolved to system packages, see rosdep_keys
+    :returns: Names of the repositories to pull as well, or None if a dependency can't be located and the whole
+        distribution needs pulling
+    """
+    pulled_packages = {entry["name"] for entry in index}
+    groups: Dict[str, Set[str]] = {}
+    for package in graph.values():
+        for group in package.get("member_of_groups", []):
+            groups.setdefault(group, set()).add(pathlib.PurePath(package["path"]).parts[0])
+
+    missing = set()
+    for entry in index:
+        for dep_type in ("build_depends", "buildtool_depends", "build_export_depends", "buildtool_export_depends",
+                         "exec_depends", "run_depends", "group_depends"):
+            for dep in entry["depends"].get(dep_type, []):
+                if dep["name"] in pulled_packages:
+                    continue
+                if not Dependency(dep["name"], condition=dep["condition"]).evaluate_condition(conditions):
+                    continue
+                if dep_type == "group_depends":
+                    repos = groups.get(dep["name"], set())
+                elif dep["name"] in graph:
+                    repos = {pathlib.PurePath(graph[dep["name"]]["path"]).parts[0]}
+                elif dep["name"] in repo_names:
+                    repos = {dep["name"]}
+                elif dep["name"] in system_keys:
+                    continue
+                else:
+                    repos = set()
+                if not repos or not repos <= repo_names:
+                    # A new package of a repository named differently, or a group none of the known packages is in
+                    click.echo(click.style(
+                        f"Can't locate {dep['name']}, a dependency of {entry['name']}, pulling everything",
+                        fg="yellow",
+                    ))
+                    return None
+                missing.update(repos - requested)
+    return missing
 
 
 def pull_distro_repositories(
@@ -291,6 +1468,16 @@ def pull_distro_repositories(
     rosdistro_index: pathlib.Path,
     github_key: str,
     clean: bool,
+    sync: bool = False,
+    tarball_cache: Optional[str] = None,
+    tarball_cache_size: float = DEFAULT_CACHE_SIZE_GB,
+    git_cache: pathlib.Path = DEFAULT_GIT_CACHE,
+    report: Optional[pathlib.Path] = None,
+    ref_cache: Optional[pathlib.Path] = DEFAULT_REF_CACHE,
+    ref_cache_max_age: Optional[float] = None,
+    graph: Optional[List[pathlib.Path]] = None,
+    src_image: Optional[pathlib.Path] = None,
+    src_image_format: str = "squashfs",
 ) -> int:
     """Pull all the packages in all ROS distributions to disk
     :param src_dir: Directory where sources should be pulled.
@@ -298,76 +1485,102 @@ def pull_distro_repositories(
     :param rosdistro_index: Path to rosdistro index.
     :param github_key: Github API key.
     :param clean: Whether to delete distro folders before pulling.
+    :param sync: Whether to only replace repositories whose SHA changed since the last pull, and delete
+        repositories that were removed from the distribution.
+    :param tarball_cache: Directory or s3://bucket/prefix of the repository tarball cache.
+    :param tarball_cache_size: Size bound of the local tarball cache, in GB.
+    :param git_cache: Directory of the bare repositories of repositories that aren't hosted on GitHub.
+    :param report: Path of the JSON pull metrics report, defaults to pull_report.json in src_dir.
+    :param ref_cache: JSON file caching the SHAs that tags resolved to, disabled if None.
+    :param ref_cache_max_age: Days after which cached tags are resolved again, never if None.
+    :param graph: Graphs of a previous build. Only the repositories holding the dependency closure of the
+        flavours' root packages are pulled, plus any that pulled packages now depend on.
+    :param src_image: Where to write a read-only image of src_dir once pulled, with a manifest next to it.
+    :param src_image_format: Filesystem of the source image, squashfs or erofs.
     :returns: Result code
     """
     index = rosdistro.get_index(rosdistro_index.resolve().as_uri())
     github_client = github.Github(github_key)
-    common_options = recipes["common"]
+    cache = open_tarball_cache(tarball_cache, tarball_cache_size)
+    downloader = TarballDownloader()
+    pull_report = PullReport()
+    refs = RefCache(
+        ref_cache, ref_cache_max_age * DAY_SECONDS if ref_cache_max_age is not None else None,
+    ) if ref_cache is not None else None
+    backends: List[FetchBackend] = [
+        GitHubBackend(github_client, cache, downloader, pull_report, refs),
+        GitBackend(git_cache),
+    ]
+    distributions = recipes["common"]["distributions"]
 
-    for distro_name, distro_options in common_options["distributions"].items():
-        click.echo(
-            click.style(
-                f"Processing repositories for {distro_name} distro...", fg="green"
-            ),
-            err=False,
-        )
-        distro = rosdistro.get_distribution(index, distro_name)
+    previous: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for distro_name in distributions:
         target_dir = src_dir / distro_name
-
-        repo_ids = []
-        refs = []
-        whitelisted_pkgs: Dict[str, List[str]] = {}
         if clean and target_dir.exists():
             click.echo(f"Deleting {target_dir} ...", err=False)
             rmtree(str(target_dir))
-
         target_dir.mkdir(parents=True, exist_ok=not clean)
-        for repo_name, distro_data in distro.repositories.items():
-            # release.url overrides source.url. In most cases they should be equivalent, but sometimes we want to
-            # pull from a bloomed repository with patches
-            try:
-                url = distro_data.release_repository.url
-            except AttributeError:
-                url = distro_data.source_repository.url
 
-            # We're fitting to the rosdistro standard here, release.tags.release is a template that can take
-            # parameters, though in our case it's usually just '{{ version }}'.
-            if (
-                distro_data.release_repository
-                and distro_data.release_repository.version is not None
-            ):
-                version_template = distro_data.release_repository.tags["release"]
-                context = {
-                    "package": repo_name,
-                    "upstream": distro_options["upstream"]["name"],
-                    "version": distro_data.release_repository.version,
-                }
-                version = (
-                    Environment(loader=BaseLoader())
-                    .from_string(version_template)
-                    .render(**context)
-                )
-            else:
-                version = distro_data.source_repository.version
+        # The log is rewritten by every pull, so it only lists the repositories currently on disk
+        log_path = target_dir / f"{distro_name}_repositories_data.jsonl"
+        if sync:
+            previous[distro_name] = load_jsonl(log_path)
+        log_path.unlink(missing_ok=True)
 
-            # Repurpose the rosdistro 'release.packages' field as an optional whitelist to prevent building
-            # packages we don't want.
-            if (
-                distro_data.release_repository
-                and distro_data.release_repository.package_names != [repo_name]
-            ):
-                repo_dir = target_dir / repo_name
-                whitelisted_pkgs[repo_dir] = (
-                    distro_data.release_repository.package_names
-                )
+    graph_packages = load_graph_packages(graph) if graph else {}
+    needed = needed_repositories(graph_packages, recipes) if graph else None
+    pending: Dict[str, Optional[Set[str]]] = needed or {distro_name: None for distro_name in distributions}
+    pulled: Dict[str, Set[str]] = {}
+    requested: Dict[str, Set[str]] = {}
+    system_keys: Optional[Set[str]] = None
+    while pending:
+        # Every distribution is resolved in its own thread and feeds the same download pool, so that downloads
+        # of one distribution overlap with ref resolution and extraction of the others.
+        resolvers = [
+            resolve_distro(
+                index, distro_name, distributions[distro_name], backends, recipes["common"].get("source_excludes"),
+                only,
+            )
+            for distro_name, only in pending.items()
+        ]
+        for distro_name, distro_repos in pull_repositories(
+            prefetch(resolvers), src_dir, cache, previous, downloader, pull_report,
+        ).items():
+            pulled.setdefault(distro_name, set()).update(distro_repos)
 
-            # click.echo(click.style(f"Adding '{repo_name}'"), err=False)
-            repo_ids.append(url)
-            refs.append(version)
+        # Expand a closure taken from an old graph until the pulled packages depend on nothing else
+        trimmed = [distro_name for distro_name, only in pending.items() if only is not None]
+        for distro_name in trimmed:
+            requested.setdefault(distro_name, set()).update(pending[distro_name] or ())
+        pending = {}
+        if trimmed and system_keys is None:
+            system_keys = rosdep_keys()
+        for distro_name in trimmed:
+            missing = missing_repositories(
+                load_package_index(package_index_path(src_dir / distro_name, distro_name)),
+                graph_packages.get(distro_name, {}),
+                set(rosdistro.get_distribution(index, distro_name).repositories),
+                requested[distro_name],
+                distributions[distro_name].get("env", {}),
+                system_keys or set(),
+            )
+            if missing is None:
+                pending[distro_name] = None
+            elif missing:
+                click.echo(f"Pulling {', '.join(sorted(missing))} as well, new dependencies of {distro_name}")
+                pending[distro_name] = missing
 
-        repositories_data = retrieve_tarballs(repo_ids, refs, github_client)
-        pull_repositories(repositories_data, target_dir, distro_name)
-        remove_packages(whitelisted_pkgs)
+    for distro_name, repos in previous.items():
+        for repo_name in repos.keys() - pulled.get(distro_name, set()):
+            click.echo(f"Deleting {repo_name}, removed from {distro_name}", err=False)
+            rmtree(src_dir / distro_name / repo_name, ignore_errors=True)
+
+    if refs is not None:
+        click.echo(f"Resolved {refs.hits} refs from the ref cache")
+    pull_report.write(report or src_dir / "pull_report.json")
+    pull_report.print_summary()
+    if src_image is not None:
+        create_source_image(src_dir, src_image, src_image_format)
     return 0
 
 
@@ -377,7 +1590,36 @@ def main():
     parser.add_argument("--recipes", action=YamlLoadAction, required=True)
     parser.add_argument("--rosdistro-index", type=pathlib.Path, required=True)
     parser.add_argument("--github-key", type=str)
-    parser.add_argument("--clean", action="store_true")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--clean", action="store_true")
+    mode.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only replace repositories whose SHA changed since the last pull, and delete removed repositories.",
+    )
+    parser.add_argument(
+        "--tarball-cache",
+        type=str,
+        help="Directory or s3://bucket/prefix where repository tarballs are cached by commit SHA.",
+    )
+    parser.add_argument("--report", type=pathlib.Path,
+                        help="Where to write the JSON pull metrics report, defaults to pull_report.json in --src-dir.")
+    parser.add_argument("--git-cache", type=pathlib.Path, default=DEFAULT_GIT_CACHE,
+                        help="Directory of bare repositories used to fetch repositories not hosted on GitHub.")
+    parser.add_argument("--tarball-cache-size", type=float, default=DEFAULT_CACHE_SIZE_GB,
+                        help="Size bound of the local tarball cache in GB, least recently used tarballs are evicted.")
+    parser.add_argument("--ref-cache", type=pathlib.Path, default=DEFAULT_REF_CACHE,
+                        help="JSON file caching the SHAs that tags resolved to, so that they aren't queried again.")
+    parser.add_argument("--no-ref-cache", dest="ref_cache", action="store_const", const=None,
+                        help="Resolve every ref through the GitHub API.")
+    parser.add_argument("--ref-cache-max-age", type=float,
+                        help="Days after which cached tags are resolved again, in case they were moved.")
+    parser.add_argument("--src-image", type=pathlib.Path,
+                        help="Also pack the pulled sources into a read-only filesystem image for build nodes.")
+    parser.add_argument("--src-image-format", choices=IMAGE_FORMATS, default="squashfs")
+    parser.add_argument("--graph", type=pathlib.Path, action="append",
+                        help="Graph of a previous build, to only pull the repositories the flavours' root packages "
+                             "need. Can be given once per OS version.")
     args = parser.parse_args()
 
     sys.exit(pull_distro_repositories(**vars(args)))
@@ -0,0 +1,110 @@
+import json
+import pathlib
+import threading
+
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Tuple
+
+import click
+
+# Number of repositories listed in the slowest / largest rankings of the summary
+TOP_REPOS = 5
+
+
+@dataclass
+class RepoMetrics:
+    distro: str
+    repo: str
+    sha: str = ""
+    # One of "downloaded", "cached", "linked" (from another distribution) or "unchanged"
+    status: str = "downloaded"
+    bytes_downloaded: int = 0
+    download_seconds: float = 0.0
+    extract_seconds: float = 0.0
+    retries: int = 0
+    extracted_bytes: int = 0
+    packages_kept: int = 0
+    packages_pruned: int = 0
+
+
+@dataclass
+class GraphQLBatch:
+    repositories: int
+    seconds: float
+    cost: int = 0
+
+
+@dataclass
+class PullReport:
+    """Metrics of a source pull, collected from all download threads."""
+    graphql_batches: List[GraphQLBatch] = field(default_factory=list)
+    repositories: Dict[Tuple[str, str], RepoMetrics] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def record_graphql(self, repositories: int, seconds: float, cost: int = 0) -> None:
+        with self._lock:
+            self.graphql_batches.append(GraphQLBatch(repositories, seconds, cost))
+
+    def repo(self, distro: str, repo: str, sha: str = "") -> RepoMetrics:
+        """Get the metrics of a repository, which the pull of that repository fills in."""
+        with self._lock:
+            metrics = self.repositories.setdefault((distro, repo), RepoMetrics(distro, repo))
+            metrics.sha = sha or metrics.sha
+            return metrics
+
+    def totals(self) -> Dict[str, float]:
+        repos = list(self.repositories.values())
+        return {
+            "graphql_batches": len(self.graphql_batches),
+            "graphql_seconds": sum(batch.seconds for batch in self.graphql_batches),
+            "repositories": len(repos),
+            "downloaded": sum(m.status == "downloaded" for m in repos),
+            "cached": sum(m.status == "cached" for m in repos),
+            "linked": sum(m.status == "linked" for m in repos),
+            "unchanged": sum(m.status == "unchanged" for m in repos),
+            "bytes_downloaded": sum(m.bytes_downloaded for m in repos),
+            "download_seconds": sum(m.download_seconds for m in repos),
+            "extract_seconds": sum(m.extract_seconds for m in repos),
+            "retries": sum(m.retries for m in repos),
+            "extracted_bytes": sum(m.extracted_bytes for m in repos),
+            "packages_kept": sum(m.packages_kept for m in repos),
+            "packages_pruned": sum(m.packages_pruned for m in repos),
+        }
+
+    def write(self, path: pathlib.Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report = {
+            "totals": self.totals(),
+            "graphql_batches": [asdict(batch) for batch in self.graphql_batches],
+            "repositories": [asdict(metrics) for metrics in self.repositories.values()],
+        }
+        path.write_text(json.dumps(report, indent=2))
+
+    def print_summary(self) -> None:
+        totals = self.totals()
+        click.echo(click.style("Pull summary:", fg="green"))
+        click.echo(f"  GraphQL: {totals['graphql_batches']} batches in {totals['graphql_seconds']:.1f}s")
+        click.echo(
+            f"  Repositories: {totals['repositories']} ({totals['downloaded']} downloaded, "
+            f"{totals['cached']} from cache, {totals['linked']} linked, {totals['unchanged']} unchanged, "
+            f"{totals['retries']} retries)"
+        )
+        click.echo(
+            f"  Download: {totals['bytes_downloaded'] / 1024 ** 2:.1f} MiB in {totals['download_seconds']:.1f}s"
+        )
+        click.echo(
+            f"  Extraction: {totals['extracted_bytes'] / 1024 ** 2:.1f} MiB in {totals['extract_seconds']:.1f}s, "
+            f"{totals['packages_kept']} packages kept, {totals['packages_pruned']} pruned"
+        )
+
+        repos = list(self.repositories.values())
+        slowest = sorted(repos, key=lambda m: m.download_seconds + m.extract_seconds, reverse=True)[:TOP_REPOS]
+        click.echo("  Slowest repositories: " + ", ".join(
+            f"{m.repo} ({m.download_seconds + m.extract_seconds:.1f}s)" for m in slowest
+        ))
+        largest = sorted(repos, key=lambda m: m.extracted_bytes, reverse=True)[:TOP_REPOS]
+        click.echo("  Largest repositories: " + ", ".join(
+            f"{m.repo} ({m.extracted_bytes / 1024 ** 2:.1f} MiB)" for m in largest
+        ))
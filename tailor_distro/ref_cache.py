@@ -0,0 +1,66 @@
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_REF_CACHE = pathlib.Path.home() / ".cache" / "tailor-distro" / "refs.json"
+DAY_SECONDS = 24 * 60 * 60
+
+
+class RefCache:
+    """
+    Persistent cache of refs resolved to a commit SHA and tarball URL. Only refs that never move are stored,
+    i.e. tags and commit SHAs, so that branches are resolved again on every pull. Tags can still be re-verified
+    once their entry is older than max_age, in case one was deleted and created again.
+    """
+    def __init__(self, path: pathlib.Path = DEFAULT_REF_CACHE, max_age: Optional[float] = None):
+        """
+        :param path: JSON file the cache is kept in
+        :param max_age: Seconds after which entries are resolved again, entries never expire if None
+        """
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            try:
+                self._entries = json.loads(path.read_text())
+            except ValueError:
+                # A corrupt cache only costs a full resolution
+                self._entries = {}
+
+    @staticmethod
+    def key(owner: str, repo: str, ref: str) -> str:
+        return f"{owner}/{repo}@{ref}"
+
+    def get(self, owner: str, repo: str, ref: str) -> Optional[Tuple[str, str]]:
+        """
+        Look up a resolved ref.
+        :returns: (sha, tarball URL), or None if the ref isn't cached or is due for re-verification
+        """
+        with self._lock:
+            entry = self._entries.get(self.key(owner, repo, ref))
+            if entry is None:
+                return None
+            if self.max_age is not None and time.time() - entry["resolved_at"] > self.max_age:
+                return None
+            self.hits += 1
+            return entry["sha"], entry["tarball"]
+
+    def put(self, owner: str, repo: str, ref: str, sha: str, tarball: str) -> None:
+        with self._lock:
+            self._entries[self.key(owner, repo, ref)] = {"sha": sha, "tarball": tarball, "resolved_at": time.time()}
+
+    def save(self) -> None:
+        """Write the cache, atomically so that concurrent pulls never read a partial file."""
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".part")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
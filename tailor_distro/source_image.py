@@ -0,0 +1,143 @@
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import click
+
+IMAGE_FORMATS = ("squashfs", "erofs")
+CHUNK_SIZE = 1024 * 1024
+
+# Commands packing a directory into an image of each format
+CREATE_COMMANDS = {
+    "squashfs": lambda src, image: [
+        "mksquashfs", str(src), str(image), "-noappend", "-no-progress", "-all-root", "-comp", "zstd",
+    ],
+    "erofs": lambda src, image: ["mkfs.erofs", "-zlz4hc", "--all-root", str(image), str(src)],
+}
+# Unprivileged FUSE mounters, tried before a loop mount
+FUSE_COMMANDS = {
+    "squashfs": "squashfuse",
+    "erofs": "erofsfuse",
+}
+
+
+def manifest_path(image: pathlib.Path) -> pathlib.Path:
+    return image.with_name(f"{image.name}.json")
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def create_source_image(src_dir: pathlib.Path, image: pathlib.Path, image_format: str = "squashfs") -> Dict[str, Any]:
+    """
+    Pack a pulled source tree into a compressed read-only filesystem image, and write its manifest next to it.
+    :param src_dir: Source directory written by pull_distro_repositories
+    :param image: Path of the image to create
+    :param image_format: One of IMAGE_FORMATS
+    :returns: the manifest, listing the repositories of every distribution in the image
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown source image format {image_format}, expected one of {IMAGE_FORMATS}")
+
+    image.parent.mkdir(parents=True, exist_ok=True)
+    image.unlink(missing_ok=True)
+    click.echo(f"Creating {image_format} source image {image} from {src_dir}...")
+    subprocess.run(CREATE_COMMANDS[image_format](src_dir, image), check=True)
+
+    distributions: Dict[str, Any] = {}
+    for log_path in sorted(src_dir.glob("*/*_repositories_data.jsonl")):
+        with open(log_path, "r", encoding="utf-8") as f:
+            repos = [json.loads(line) for line in f if line.strip()]
+        distributions[log_path.parent.name] = {
+            info["repo"]: {"owner": info["owner"], "sha": info["sha"]} for info in repos
+        }
+
+    manifest = {
+        "format": image_format,
+        "size": image.stat().st_size,
+        "sha256": file_sha256(image),
+        "distributions": distributions,
+    }
+    manifest_path(image).write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+
+def mount_source_image(image: pathlib.Path, mountpoint: pathlib.Path, verify: bool = True) -> None:
+    """
+    Mount a source image read-only, with FUSE if available and with a loop mount otherwise.
+    :param image: Source image created by create_source_image
+    :param mountpoint: Directory to mount the image on, usually <workspace>/src
+    :param verify: Whether to check the image against the checksum of its manifest first
+    """
+    manifest = json.loads(manifest_path(image).read_text()) if manifest_path(image).exists() else {}
+    image_format = manifest.get("format", "squashfs")
+    if verify and manifest and file_sha256(image) != manifest["sha256"]:
+        raise RuntimeError(f"{image} doesn't match the checksum of its manifest")
+
+    mountpoint.mkdir(parents=True, exist_ok=True)
+    if any(mountpoint.iterdir()):
+        raise RuntimeError(f"Can't mount {image} on {mountpoint}, which isn't empty")
+
+    fuse = shutil.which(FUSE_COMMANDS[image_format])
+    if fuse is not None and os.getuid() != 0:
+        subprocess.run([fuse, str(image), str(mountpoint)], check=True)
+    else:
+        subprocess.run(["mount", "-t", image_format, "-o", "loop,ro", str(image), str(mountpoint)], check=True)
+    click.echo(f"Mounted {image} read-only on {mountpoint}")
+
+
+def unmount_source_image(mountpoint: pathlib.Path) -> None:
+    if os.getuid() != 0 and shutil.which("fusermount"):
+        subprocess.run(["fusermount", "-u", str(mountpoint)], check=True)
+    else:
+        subprocess.run(["umount", str(mountpoint)], check=True)
+
+
+@contextmanager
+def mounted_source_image(image: Optional[pathlib.Path], workspace: pathlib.Path) -> Iterator[None]:
+    """Mount a source image on <workspace>/src while the context is active. Does nothing if image is None."""
+    if image is None:
+        yield
+        return
+
+    mountpoint = workspace / "src"
+    mount_source_image(image, mountpoint)
+    try:
+        yield
+    finally:
+        unmount_source_image(mountpoint)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mount or unmount a source image created by pull_distro_repositories")
+    parser.add_argument("--image", type=pathlib.Path, help="Source image to mount")
+    parser.add_argument("--workspace", type=pathlib.Path, required=True,
+                        help="Workspace whose src directory the image is mounted on")
+    parser.add_argument("--unmount", action="store_true")
+    parser.add_argument("--no-verify", action="store_true", help="Skip checking the image against its manifest")
+    args = parser.parse_args()
+
+    if args.unmount:
+        unmount_source_image(args.workspace / "src")
+    elif args.image is None:
+        parser.error("--image is required to mount")
+    else:
+        mount_source_image(args.image, args.workspace / "src", verify=not args.no_verify)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import click
+
+# Nightlies share one cache between all build nodes. An s3:// URI or a path can be set here so
+# that jobs don't need to pass --tarball-cache explicitly.
+TARBALL_CACHE_ENV = "TAILOR_TARBALL_CACHE"
+DEFAULT_CACHE_SIZE_GB = 20.0
+GIGABYTE = 1024 ** 3
+
+
+class TarballCache(ABC):
+    """Content-addressed store of repository tarballs, keyed by (owner, repo, sha)."""
+
+    @staticmethod
+    def key(owner: str, repo: str, sha: str) -> str:
+        return f"{owner}/{repo}/{sha}.tar.gz"
+
+    @abstractmethod
+    def get(self, owner: str, repo: str, sha: str) -> Optional[pathlib.Path]:
+        """
+        Look up a tarball in the cache.
+        :returns: Local path of the cached tarball, or None if it isn't cached
+        """
+
+    @abstractmethod
+    def put(self, owner: str, repo: str, sha: str, tarball: pathlib.Path) -> pathlib.Path:
+        """
+        Add a tarball to the cache. The source file is left untouched.
+        :returns: Local path of the cached tarball
+        """
+
+
+class LocalTarballCache(TarballCache):
+    """
+    Tarball cache in a local (or network mounted) directory. The least recently used tarballs are
+    evicted once the cache grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir: pathlib.Path, max_bytes: int = int(DEFAULT_CACHE_SIZE_GB * GIGABYTE)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def path(self, owner: str, repo: str, sha: str) -> pathlib.Path:
+        return self.cache_dir / self.key(owner, repo, sha)
+
+    def get(self, owner: str, repo: str, sha: str) -> Optional[pathlib.Path]:
+        path = self.path(owner, repo, sha)
+        try:
+            # Bump the access time used for LRU eviction, noatime mounts don't do it for us
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, owner: str, repo: str, sha: str, tarball: pathlib.Path) -> pathlib.Path:
+        path = self.path(owner, repo, sha)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Copy next to the destination first, so concurrent readers never see a partial tarball
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{sha}.", suffix=".part")
+        os.close(fd)
+        try:
+            shutil.copyfile(tarball, tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self.evict()
+        return path
+
+    def evict(self) -> None:
+        """Remove the least recently used tarballs until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            for path in self.cache_dir.glob("*/*/*.tar.gz"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    # Evicted by another process sharing the cache
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+class S3TarballCache(TarballCache):
+    """
+    Tarball cache in an S3 bucket, shared between build nodes. Tarballs are staged through a local cache,
+    which is consulted first. Eviction from the bucket is left to its lifecycle rules.
+    """
+    def __init__(self, bucket: str, prefix: str, local: LocalTarballCache):
+        import boto3  # type: ignore[import-not-found]
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.local = local
+        self.s3_client = boto3.client("s3")
+
+    def object_key(self, owner: str, repo: str, sha: str) -> str:
+        key = self.key(owner, repo, sha)
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def get(self, owner: str, repo: str, sha: str) -> Optional[pathlib.Path]:
+        import botocore.exceptions  # type: ignore[import-not-found]
+
+        path = self.local.get(owner, repo, sha)
+        if path is not None:
+            return path
+
+        with tempfile.TemporaryDirectory(dir=self.local.cache_dir) as tmp_dir:
+            tmp = pathlib.Path(tmp_dir) / "tarball.tar.gz"
+            try:
+                self.s3_client.download_file(self.bucket, self.object_key(owner, repo, sha), str(tmp))
+            except botocore.exceptions.ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                    return None
+                raise
+            return self.local.put(owner, repo, sha, tmp)
+
+    def put(self, owner: str, repo: str, sha: str, tarball: pathlib.Path) -> pathlib.Path:
+        path = self.local.put(owner, repo, sha, tarball)
+        try:
+            self.s3_client.upload_file(str(tarball), self.bucket, self.object_key(owner, repo, sha))
+        except Exception as e:
+            # A failed upload only costs other nodes a download, don't fail the pull over it
+            click.echo(click.style(f"Unable to upload {repo}@{sha} to the tarball cache: {e}", fg="yellow"), err=True)
+        return path
+
+
+def open_tarball_cache(location: Optional[str], size_gb: float = DEFAULT_CACHE_SIZE_GB,
+                       local_dir: Optional[pathlib.Path] = None) -> Optional[TarballCache]:
+    """
+    Create the tarball cache for a location, falling back to TARBALL_CACHE_ENV.
+    :param location: Cache directory, or s3://bucket/prefix for a cache shared through S3
+    :param size_gb: Size bound of the local cache directory
+    :param local_dir: Local staging directory of an S3 cache
+    :returns: The tarball cache, or None if no location is configured
+    """
+    location = location or os.environ.get(TARBALL_CACHE_ENV)
+    if not location:
+        return None
+
+    max_bytes = int(size_gb * GIGABYTE)
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        local_dir = local_dir or pathlib.Path.home() / ".cache" / "tailor-distro" / "tarballs"
+        return S3TarballCache(bucket, prefix, LocalTarballCache(local_dir, max_bytes))
+    return LocalTarballCache(pathlib.Path(location), max_bytes)
@@ -0,0 +1,332 @@
+import fcntl
+import os
+import subprocess
+import time
+
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from catkin_pkg.package import parse_package_string
+
+from tailor_distro.apt_tools import (
+    FINGERPRINTS_FILE, MISSING_RELEASE, SANDBOX_MAX_AGE_SECONDS, AptSandbox, release_fingerprint, s3_credentials,
+)
+from tailor_distro.blossom import Graph, GraphPackage
+from tailor_distro.generate_apt_repo import generate_apt_repo, synthetic_package_name
+
+RELEASE_LABEL = "test"
+OS_VERSION = "jammy"
+NEW_BUILD_DATE = "20270101.000000"
+
+
+@pytest.fixture
+def fixture_repo(tmp_path, monkeypatch):
+    monkeypatch.setenv("TAILOR_APT_SANDBOX_CACHE", str(tmp_path / "sandboxes"))
+    published = generate_apt_repo(
+        tmp_path / "repo",
+        RELEASE_LABEL,
+        OS_VERSION,
+        ros_distros=["ros1"],
+        architectures=["amd64", "arm64"],
+        num_packages=10,
+        num_versions=4,
+        epoch_every=5,
+        compression="gz",
+    )
+    return tmp_path / "repo", published
+
+
+def make_graph(repo_path):
+    return Graph(
+        "ubuntu",
+        OS_VERSION,
+        RELEASE_LABEL,
+        NEW_BUILD_DATE,
+        apt_repo=repo_path.resolve().as_uri(),
+        architectures=["amd64", "arm64"],
+    )
+
+
+def test_candidate_is_newest_published_version(fixture_repo):
+    """
+    Tests that the candidate lookup picks the newest version for every architecture.
+    """
+    repo_path, published = fixture_repo
+    graph = make_graph(repo_path)
+
+    name = synthetic_package_name(1)
+    package = GraphPackage(name, "0.3.0", "abc1234", "", "ros1", [], [])
+    for arch in graph.architectures:
+        assert graph._get_apt_candidate_version(package, arch) == published["ros1"][name][-1]
+
+    missing = GraphPackage("not_published", "0.0.0", "abc1234", "", "ros1", [], [])
+    assert graph._get_apt_candidate_version(missing, "amd64") is None
+    graph.close()
+
+
+def test_candidate_is_looked_up_per_architecture(tmp_path, monkeypatch):
+    """
+    Tests that every architecture gets its own candidate when arm64 lags behind amd64.
+    """
+    monkeypatch.setenv("TAILOR_APT_SANDBOX_CACHE", str(tmp_path / "sandboxes"))
+    published = generate_apt_repo(
+        tmp_path / "repo",
+        RELEASE_LABEL,
+        OS_VERSION,
+        ros_distros=["ros1"],
+        architectures=["amd64", "arm64"],
+        num_packages=3,
+        num_versions=3,
+        epoch_every=0,
+        lagging_architectures=["arm64"],
+    )
+    graph = make_graph(tmp_path / "repo")
+
+    name = synthetic_package_name(1)
+    package = GraphPackage(name, "0.3.0", "abc1234", "", "ros1", [], [])
+    assert graph._get_apt_candidate_version(package, "amd64") == published["ros1"][name][-1]
+    assert graph._get_apt_candidate_version(package, "arm64") == published["ros1"][name][-2]
+
+    manifest = f"<package format='2'><name>{name}</name><version>0.3.0</version><description>d</description>" \
+        "<maintainer email='maintainer@example.com'>m</maintainer><license>BSD</license></package>"
+    graph.add_package(parse_package_string(manifest), "ros1", Path(name), "abc1234")
+    added = graph.packages["ros1"][name]
+    assert added.apt_candidate_versions == {
+        "amd64": published["ros1"][name][-1],
+        "arm64": published["ros1"][name][-2],
+    }
+    # The primary architecture decides rebuilds
+    assert added.apt_candidate_version == published["ros1"][name][-1]
+    graph.close()
+
+
+def test_epoch_candidate_and_rebuild(fixture_repo):
+    """
+    Tests that epoch-bumped versions are preferred and that rebuild decisions follow the candidate SHA.
+    """
+    repo_path, published = fixture_repo
+    graph = make_graph(repo_path)
+
+    name = synthetic_package_name(0)
+    candidate = graph._get_apt_candidate_version(GraphPackage(name, "0.0.0", "", "", "ros1", [], []), "amd64")
+    assert candidate == published["ros1"][name][-1]
+    assert candidate.startswith("1:")
+
+    sha = candidate.split("+git")[-1]
+    unchanged = GraphPackage(name, "0.1.0", sha, "", "ros1", [], [], apt_candidate_version=candidate)
+    assert not graph.package_needs_rebuild(unchanged)
+
+    # Moving back to an older upstream version needs yet another epoch bump
+    downgraded = GraphPackage(name, "0.0.1", "abc1234", "", "ros1", [], [], apt_candidate_version=candidate)
+    assert graph.package_needs_rebuild(downgraded)
+    assert downgraded.debian_version(NEW_BUILD_DATE) == f"2:0.0.1-{NEW_BUILD_DATE}+gitabc1234"
+    graph.close()
+
+
+def test_sandbox_skips_update_when_release_unchanged(fixture_repo):
+    """
+    Tests that a cached sandbox only refreshes its indexes when the Release file changes.
+    """
+    repo_path, _ = fixture_repo
+    sources = [f"deb [arch=amd64 trusted=yes] {repo_path.resolve().as_uri()}/{RELEASE_LABEL}/ubuntu {OS_VERSION} main"]
+
+    with AptSandbox(sources):
+        pass
+
+    with mock.patch.object(AptSandbox, "update") as update:
+        with AptSandbox(sources):
+            pass
+    update.assert_not_called()
+
+    generate_apt_repo(repo_path, RELEASE_LABEL, OS_VERSION, ros_distros=["ros1"], num_packages=11)
+    with mock.patch.object(AptSandbox, "update") as update:
+        with AptSandbox(sources):
+            pass
+    update.assert_called_once()
+
+
+def test_failed_update_drops_cached_indexes(fixture_repo):
+    """
+    Tests that a cached sandbox whose apt update fails doesn't keep serving the indexes of a previous update.
+    """
+    repo_path, _ = fixture_repo
+    sources = [f"deb [arch=amd64 trusted=yes] {repo_path.resolve().as_uri()}/{RELEASE_LABEL}/ubuntu {OS_VERSION} main"]
+    name = f"locusrobotics-{RELEASE_LABEL}-ros1-{synthetic_package_name(0).replace('_', '-')}"
+
+    with AptSandbox(sources) as sandbox:
+        assert name in sandbox.cache
+        with mock.patch("subprocess.run", side_effect=subprocess.CalledProcessError(100, "apt-get")):
+            sandbox.update(sandbox._release_fingerprints())
+        assert name not in sandbox.cache
+        assert not (sandbox.root / FINGERPRINTS_FILE).exists()
+
+    # The next run updates again rather than trusting the fingerprint of the failed update
+    with mock.patch.object(AptSandbox, "update") as update:
+        with AptSandbox(sources):
+            pass
+    update.assert_called_once()
+
+
+def test_release_fingerprint(tmp_path):
+    """
+    Tests that file:// fingerprints follow the Release file, preferring InRelease like apt does.
+    """
+    dists = tmp_path / "repo" / "dists" / OS_VERSION
+    source = f"deb [trusted=yes] {(tmp_path / 'repo').as_uri()} {OS_VERSION} main"
+    assert release_fingerprint(source) == MISSING_RELEASE
+
+    dists.mkdir(parents=True)
+    (dists / "Release").write_text("Suite: jammy\n")
+    release = release_fingerprint(source)
+    assert release is not None and release.startswith(f"{dists.as_uri()}/Release:")
+
+    (dists / "Release").write_text("Suite: jammy\nDate: later\n")
+    changed = release_fingerprint(source)
+    assert changed is not None and changed != release
+
+    (dists / "InRelease").write_text("Suite: jammy\n")
+    in_release = release_fingerprint(source)
+    assert in_release is not None and in_release.startswith(f"{dists.as_uri()}/InRelease:")
+
+    assert release_fingerprint(f"deb ftp://example.com/ubuntu {OS_VERSION} main") is None
+
+
+def test_s3_release_fingerprint(tmp_path, monkeypatch):
+    """
+    Tests that S3 Release files are looked up with the apt-transport-s3 credentials, and that missing credentials
+    make the indexes refresh rather than failing.
+    """
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN", "AWS_PROFILE"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "missing"))
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(tmp_path / "missing"))
+    monkeypatch.setenv("AWS_EC2_METADATA_DISABLED", "true")
+    source = f"deb [trusted=yes] s3://bucket/{RELEASE_LABEL}/ubuntu {OS_VERSION} main"
+    assert release_fingerprint(source, {"Region": "us-east-1"}) is None
+
+    s3auth = tmp_path / "apt" / "s3auth.conf"
+    s3auth.parent.mkdir()
+    s3auth.write_text("AccessKeyId = key\nSecretAccessKey = secret\nToken = ''\nRegion = 'us-east-2'\n")
+    credentials = s3_credentials([tmp_path / "apt"])
+    assert credentials == {"AccessKeyId": "key", "SecretAccessKey": "secret", "Region": "us-east-2"}
+
+    with mock.patch("boto3.session.Session") as session:
+        session.return_value.client.return_value.head_object.return_value = {"ETag": "etag"}
+        assert release_fingerprint(source, credentials) == \
+            f"s3://bucket/{RELEASE_LABEL}/ubuntu/dists/{OS_VERSION}/InRelease:etag"
+    session.assert_called_with(
+        aws_access_key_id="key", aws_secret_access_key="secret", aws_session_token=None, region_name="us-east-2",
+    )
+
+
+def test_prune_stale_sandboxes(fixture_repo, tmp_path):
+    """
+    Tests that opening a sandbox removes stale sandboxes with their lock files, unless another process holds them.
+    """
+    repo_path, _ = fixture_repo
+    sources = [f"deb [arch=amd64 trusted=yes] {repo_path.resolve().as_uri()}/{RELEASE_LABEL}/ubuntu {OS_VERSION} main"]
+    cache_dir = tmp_path / "sandboxes"
+    stale = time.time() - SANDBOX_MAX_AGE_SECONDS - 60
+
+    for name in ["aptsandbox-stale", "aptsandbox-busy", "aptsandbox-recent"]:
+        (cache_dir / name).mkdir(parents=True)
+        (cache_dir / f"{name}.lock").touch()
+    os.utime(cache_dir / "aptsandbox-stale", (stale, stale))
+    os.utime(cache_dir / "aptsandbox-busy", (stale, stale))
+
+    with open(cache_dir / "aptsandbox-busy.lock", "w") as busy:
+        fcntl.flock(busy, fcntl.LOCK_EX)
+        with AptSandbox(sources, cache_dir=cache_dir) as sandbox:
+            assert sandbox.root.is_dir()
+
+    assert not (cache_dir / "aptsandbox-stale").exists()
+    assert not (cache_dir / "aptsandbox-stale.lock").exists()
+    assert (cache_dir / "aptsandbox-busy").is_dir()
+    assert (cache_dir / "aptsandbox-busy.lock").exists()
+    assert (cache_dir / "aptsandbox-recent").is_dir()
+    assert (cache_dir / "aptsandbox-recent.lock").exists()
+
+
+def deb_name(index, ros_distro="ros1"):
+    return f"locusrobotics-{RELEASE_LABEL}-{ros_distro}-{synthetic_package_name(index).replace('_', '-')}"
+
+
+@pytest.fixture
+def dependency_repo(tmp_path, monkeypatch):
+    """A fixture repository whose packages depend on each other, the first one being part of the base system."""
+    monkeypatch.setenv("TAILOR_APT_SANDBOX_CACHE", str(tmp_path / "sandboxes"))
+    published = generate_apt_repo(
+        tmp_path / "repo",
+        RELEASE_LABEL,
+        OS_VERSION,
+        ros_distros=["ros1"],
+        architectures=["amd64", "arm64"],
+        num_packages=5,
+        num_versions=2,
+        epoch_every=0,
+        depends_on_previous=True,
+        required_packages=1,
+        provided_virtual="virtual-fixture",
+    )
+    return tmp_path / "repo", published["ros1"]
+
+
+def test_resolve_closure(dependency_repo):
+    """
+    Tests that resolving pins the whole dependency closure, picks a provider for virtual packages and leaves out the
+    base system.
+    """
+    repo_path, published = dependency_repo
+    sources = [f"deb [arch=amd64 trusted=yes] {repo_path.resolve().as_uri()}/{RELEASE_LABEL}/ubuntu {OS_VERSION} main"]
+
+    with AptSandbox(sources) as sandbox:
+        closure, unresolved = sandbox.resolve([deb_name(2)])
+        assert closure == {deb_name(i): published[synthetic_package_name(i)][-1] for i in (1, 2)}
+        assert unresolved == []
+
+        closure, unresolved = sandbox.resolve(["virtual-fixture", "not-published"])
+        assert set(closure) == {deb_name(i) for i in (1, 2, 3, 4)}
+        assert unresolved == ["not-published"]
+
+
+def test_write_lockfiles(dependency_repo, tmp_path):
+    """
+    Tests that every flavour gets one lockfile per architecture, pinning the closure of its root packages.
+    """
+    repo_path, published = dependency_repo
+    graph = make_graph(repo_path)
+    graph.packages["ros1"] = {
+        "foo": GraphPackage("foo", "0.1.0", "abc1234", "foo", "ros1", [f"r:{deb_name(2)}"], ["r:bar"]),
+        "bar": GraphPackage("bar", "0.1.0", "abc1234", "bar", "ros1", [f"b:{deb_name(3)}"], []),
+    }
+    graph.finalize()
+    flavours = {"base": {"distributions": {"ros1": {"root_packages": ["foo"]}}}}
+
+    assert graph.flavour_apt_depends(flavours["base"]) == sorted([deb_name(2), deb_name(3)])
+
+    graph.write_lockfiles(flavours, tmp_path / "graphs")
+    expected = "".join(
+        f"{deb_name(i)}={published[synthetic_package_name(i)][-1]}\n" for i in (1, 2, 3)
+    )
+    for arch in ("amd64", "arm64"):
+        assert (tmp_path / "graphs" / graph.lockfile_name("base", arch)).read_text() == expected
+    graph.close()
+
+
+def test_write_lockfiles_unresolved(dependency_repo, tmp_path):
+    """
+    Tests that an unresolvable dependency fails lockfile generation rather than being left unpinned.
+    """
+    repo_path, _ = dependency_repo
+    graph = make_graph(repo_path)
+    graph.packages["ros1"] = {
+        "foo": GraphPackage("foo", "0.1.0", "abc1234", "foo", "ros1", [f"r:{deb_name(2)}", "r:not-published"], []),
+    }
+    graph.finalize()
+
+    with pytest.raises(Exception, match="not-published"):
+        graph.write_lockfiles({"base": {"distributions": {"ros1": {"root_packages": []}}}}, tmp_path / "graphs")
+    assert not (tmp_path / "graphs").exists()
+    graph.close()
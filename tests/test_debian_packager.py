@@ -0,0 +1,200 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+from pathlib import Path
+
+import pytest
+
+from debian_packager import fix_local_paths, local_path_rewriter, select_compression, stage_file, stage_tree
+from debian_packager.deb_writer import DataTree, stream_package_debian
+
+
+def test_fix_local_paths(tmp_path):
+    install_dir = tmp_path / "install" / "ros1"
+    staging_dir = tmp_path / "staging"
+    staging_dir.mkdir()
+    opt = "/opt/locus/hotdog/ros1"
+
+    cmake = staging_dir / "fooConfig.cmake"
+    cmake.write_text(
+        f"{install_dir.parent}/foo/lib/libfoo.so\n"
+        f"{install_dir.parent}/foo/include;{install_dir.parent}/foo/libexec\n"
+        f"{install_dir}/share/foo\n"
+        "#!/opt/tailor_venv/bin/python3\n"
+    )
+    cmake.chmod(0o755)
+    binary = staging_dir / "foo.bin"
+    binary.write_bytes(b"\0" + f"{install_dir}/lib".encode())
+    untouched = staging_dir / "README"
+    untouched.write_text("nothing to see here\n")
+    (staging_dir / "foo.pyc").write_bytes(b"")
+    os.symlink(f"{install_dir.parent}/foo/lib/libfoo.so", staging_dir / "libfoo.so")
+
+    fix_local_paths("locus", "hotdog", "ros1", staging_dir, install_dir)
+
+    assert cmake.read_text() == (
+        f"{opt}/lib/libfoo.so\n"
+        f"{opt}/include;{install_dir.parent}/foo/libexec\n"
+        f"{opt}/share/foo\n"
+        "#!/usr/bin/python3\n"
+    )
+    assert cmake.stat().st_mode & 0o777 == 0o755
+    assert binary.read_bytes() == b"\0" + f"{install_dir}/lib".encode()
+    assert untouched.read_text() == "nothing to see here\n"
+    assert not (staging_dir / "foo.pyc").exists()
+    assert os.readlink(staging_dir / "libfoo.so") == f"{opt}/lib/libfoo.so"
+
+
+def test_fix_local_paths_copies_staged_hardlinks_on_write(tmp_path):
+    install_dir = tmp_path / "install" / "ros1"
+    (install_dir / "share").mkdir(parents=True)
+    installed = install_dir / "share" / "foo.cmake"
+    installed.write_text(f"{install_dir}/share/foo\n")
+    binary = install_dir / "share" / "foo.bin"
+    binary.write_bytes(b"\0" + f"{install_dir}".encode())
+
+    staging_dir = tmp_path / "staging"
+    shutil.copytree(install_dir, staging_dir, symlinks=True, copy_function=stage_file)
+    staged = staging_dir / "share" / "foo.cmake"
+    assert staged.read_text() == installed.read_text()
+
+    fix_local_paths("locus", "hotdog", "ros1", staging_dir, install_dir)
+
+    assert staged.read_text() == "/opt/locus/hotdog/ros1/share/foo\n"
+    assert installed.read_text() == f"{install_dir}/share/foo\n"
+    assert (staging_dir / "share" / "foo.bin").read_bytes() == binary.read_bytes()
+    assert sorted(p.name for p in staged.parent.iterdir()) == ["foo.bin", "foo.cmake"]
+
+
+def test_select_compression():
+    profiles = [
+        {"compressor": "gzip", "level": 1},
+        {"compressor": "zstd", "level": 19, "threads": 0, "min_size": 1024},
+    ]
+
+    small = select_compression(profiles, 10)
+    assert small.dpkg_deb_args() == ["-Zgzip", "-z1"]
+    large = select_compression(profiles, 1024)
+    assert large.dpkg_deb_args() == ["-Zzstd", "-z19", "--threads-max=0"]
+    assert select_compression([{"compressor": "xz", "min_size": 1024}], 10) is None
+
+    with pytest.raises(ValueError):
+        select_compression([{"compressor": "lzma"}], 10)
+
+
+def _ar_members(deb):
+    data = deb.read_bytes()
+    assert data.startswith(b"!<arch>\n")
+    offset, members = 8, {}
+    while offset < len(data):
+        header = data[offset:offset + 60]
+        name, size = header[:16].decode().strip(), int(header[48:58])
+        members[name] = data[offset + 60:offset + 60 + size]
+        offset += 60 + size + size % 2
+    return members
+
+
+def _decompressed(data, compressor):
+    # tarfile can't read zstd
+    if compressor == "zstd":
+        data = subprocess.run(["zstd", "-d", "-c"], input=data, stdout=subprocess.PIPE, check=True).stdout
+    return io.BytesIO(data)
+
+
+@pytest.mark.parametrize("compressor", ["gzip", "xz", "zstd", "none"])
+def test_stream_package_debian(tmp_path, monkeypatch, compressor):
+    install_dir = tmp_path / "install" / "foo"
+    (install_dir / "share" / "foo").mkdir(parents=True)
+    (install_dir / "share" / "foo" / "foo.cmake").write_text(f"{install_dir}/share/foo\n")
+    (install_dir / "share" / "foo" / "foo.pyc").write_bytes(b"")
+    (install_dir / ".catkin").touch()
+    os.symlink(f"{install_dir}/share", install_dir / "share" / "foo" / "share")
+    monkeypatch.chdir(tmp_path)
+
+    deb = stream_package_debian(
+        "foo", "1.0", "Foo. Packages foo.", "Foo <foo@example.com>", "jammy",
+        [DataTree(install_dir, "opt/locus/hotdog/ros1")],
+        local_path_rewriter("locus", "hotdog", "ros1", install_dir),
+        run_depends=["bar"],
+        compression=[{"compressor": compressor, "threads": 0}],
+    )
+
+    assert deb == Path("foo_1.0_amd64_jammy.deb")
+    members = _ar_members(tmp_path / deb)
+    extension = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst", "none": ""}[compressor]
+    assert list(members) == ["debian-binary", f"control.tar{extension}", f"data.tar{extension}"]
+    assert members["debian-binary"] == b"2.0\n"
+
+    with tarfile.open(fileobj=_decompressed(members[f"control.tar{extension}"], compressor)) as tar:
+        control = tar.extractfile("./control").read().decode()
+    assert "Package: foo\n" in control
+    assert "Depends: bar\n" in control
+
+    with tarfile.open(fileobj=_decompressed(members[f"data.tar{extension}"], compressor)) as tar:
+        names = tar.getnames()
+        content = tar.extractfile("./opt/locus/hotdog/ros1/share/foo/foo.cmake").read()
+        link = tar.getmember("./opt/locus/hotdog/ros1/share/foo/share")
+    assert names[:5] == [".", "./opt", "./opt/locus", "./opt/locus/hotdog", "./opt/locus/hotdog/ros1"]
+    assert not any(name.endswith((".pyc", ".catkin")) for name in names)
+    assert content == b"/opt/locus/hotdog/ros1/share/foo\n"
+    assert link.linkname == "/opt/locus/hotdog/ros1/share"
+
+    if shutil.which("dpkg-deb"):
+        subprocess.run(["dpkg-deb", "--info", str(deb)], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(["dpkg-deb", "--extract", str(deb), "extracted"], check=True)
+        assert (tmp_path / "extracted/opt/locus/hotdog/ros1/share/foo/foo.cmake").exists()
+
+
+def test_stage_tree(tmp_path):
+    install_dir = tmp_path / "install" / "foo"
+    (install_dir / "share" / "foo").mkdir(parents=True)
+    cmake = install_dir / "share" / "foo" / "foo.cmake"
+    cmake.write_text(f"{install_dir}/share/foo\n")
+    (install_dir / "share" / "foo" / "data").write_bytes(b"\0" * 2049)
+    (install_dir / "share" / "foo" / "foo.pyc").write_bytes(b"")
+    (install_dir / ".catkin").touch()
+    os.symlink(f"{install_dir}/share", install_dir / "share" / "foo" / "share")
+    staging_dir = tmp_path / "staging"
+    optinstall = tmp_path / "optinstall"
+    rewriter = local_path_rewriter("locus", "hotdog", "ros1", install_dir)
+
+    installed_size = stage_tree(install_dir, staging_dir, rewriter, merge_dir=optinstall)
+
+    # share, share/foo and the symlink, plus 1 KiB for foo.cmake and 3 KiB for data
+    assert installed_size == 3 + 1 + 3
+    assert (staging_dir / "share" / "foo" / "foo.cmake").read_text() == "/opt/locus/hotdog/ros1/share/foo\n"
+    assert os.readlink(staging_dir / "share" / "foo" / "share") == "/opt/locus/hotdog/ros1/share"
+    assert not (staging_dir / "share" / "foo" / "foo.pyc").exists()
+    assert not (staging_dir / ".catkin").exists()
+    assert cmake.read_text() == f"{install_dir}/share/foo\n"
+
+    # The merged workspace gets the tree as is
+    assert (optinstall / "share" / "foo" / "foo.cmake").read_text() == cmake.read_text()
+    assert (optinstall / "share" / "foo" / "foo.pyc").exists()
+    assert os.readlink(optinstall / "share" / "foo" / "share") == f"{install_dir}/share"
+
+    # Packages can't provide the same file in the merged workspace
+    with pytest.raises(FileExistsError):
+        stage_tree(install_dir, None, rewriter, merge_dir=optinstall)
+
+
+def test_stage_tree_measures_like_staging(tmp_path):
+    """
+    Tests that measuring a tree without staging it accounts for rewritten files like staging it does.
+    """
+    install_dir = tmp_path / "install" / "foo"
+    install_dir.mkdir(parents=True)
+    # Rewriting the paths brings the file below 1 KiB
+    lines = 1100 // (len(str(install_dir)) + 1) + 1
+    assert lines * len("/opt/locus/hotdog/ros1\n") < 1024
+    (install_dir / "paths.txt").write_text(f"{install_dir}\n" * lines)
+    rewriter = local_path_rewriter("locus", "hotdog", "ros1", install_dir)
+
+    staged = stage_tree(install_dir, tmp_path / "staging", rewriter)
+    assert staged == 1
+    assert stage_tree(install_dir, None, rewriter) == staged
+    # Without a rewriter the tree is measured as is
+    assert stage_tree(install_dir, None, None) == 2
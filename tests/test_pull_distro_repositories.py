@@ -0,0 +1,562 @@
+import functools
+import os
+import re
+import subprocess
+import tarfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from unittest import mock
+
+import pytest
+import requests
+
+from tailor_distro.package_index import load_package_index, packages_from_index
+from tailor_distro.pull_distro_repositories import (
+    AdaptiveLimiter, GitBackend, RepoInformation, RepoPull, load_jsonl, missing_repositories, needed_repositories,
+    prefetch, process_repo, pull_repositories, retrieve_tarballs, source_excludes, throttle_delay,
+)
+from tailor_distro.pull_report import PullReport, RepoMetrics
+from tailor_distro.ref_cache import RefCache
+from tailor_distro.tarball_cache import LocalTarballCache
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_root(tmp_path):
+    """Serve a directory over HTTP, returning the directory and its base URL."""
+    root = tmp_path / "www"
+    root.mkdir()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def make_tarball(path, top_dir, files):
+    src = path.parent / f"{path.name}-src" / top_dir
+    for name, content in files.items():
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_text(content)
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(src, arcname=top_dir)
+    return path
+
+
+def test_process_repo_uses_cached_tarball(tmp_path, http_root):
+    """
+    Tests that a repository is only downloaded once per commit SHA.
+    """
+    root, url = http_root
+    make_tarball(root / "repo.tar.gz", "owner-repo-abc1234", {"package.xml": "<package/>"})
+    cache = LocalTarballCache(tmp_path / "cache")
+
+    repo_path = process_repo("repo", f"{url}/repo.tar.gz", tmp_path / "first", "owner", "abc1234", cache)
+    assert (repo_path / "package.xml").exists()
+    assert cache.get("owner", "repo", "abc1234") is not None
+
+    # The tarball URL is never opened on a cache hit
+    repo_path = process_repo("repo", f"{url}/missing.tar.gz", tmp_path / "second", "owner", "abc1234", cache)
+    assert (repo_path / "package.xml").read_text() == "<package/>"
+
+
+def test_process_repo_streams_without_archive(tmp_path, http_root):
+    """
+    Tests that the tarball top directory is stripped while extracting and that no archive is left behind.
+    """
+    root, url = http_root
+    make_tarball(root / "repo.tar.gz", "owner-repo-abc1234", {"pkg/package.xml": "<package/>"})
+
+    repo_path = process_repo("repo", f"{url}/repo.tar.gz", tmp_path / "src")
+    assert repo_path == tmp_path / "src" / "repo" / "repo"
+    assert (repo_path / "pkg" / "package.xml").exists()
+    assert not list((tmp_path / "src").rglob("*.tar.gz"))
+
+
+class FlakyRangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves a tarball with Range support, dropping the connection halfway through the first full download. Chunked
+    responses have no Content-Length, like the tarballs of codeload.github.com.
+    """
+    protocol_version = "HTTP/1.1"
+    body = b""
+    chunked = False
+    ranges: List[Optional[str]] = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start = int(re.match(r"bytes=(\d+)-", self.headers.get("Range", "bytes=0-")).group(1))
+        self.ranges.append(self.headers.get("Range"))
+        self.send_response(206 if start else 200)
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(len(self.body) - start))
+        self.send_header("ETag", '"v1"')
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(self.body) - 1}/{len(self.body)}")
+        self.end_headers()
+
+        body = self.body[start:]
+        if self.chunked:
+            self.wfile.write(f"{len(body):x}\r\n".encode())
+        if len(self.ranges) == 1:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+        if self.chunked:
+            self.wfile.write(b"\r\n0\r\n\r\n")
+
+
+def test_download_resumes_after_connection_drop(tmp_path):
+    """
+    Tests that an interrupted download is resumed with a Range request instead of starting over.
+    """
+    files = {f"pkg/file{i}": os.urandom(64 * 1024).hex() for i in range(4)}
+    tarball = make_tarball(tmp_path / "repo.tar.gz", "owner-repo-abc1234", files)
+    FlakyRangeHandler.body = tarball.read_bytes()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyRangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    metrics = RepoMetrics("ros1", "repo")
+    try:
+        with mock.patch("tailor_distro.pull_distro_repositories.backoff_delay", return_value=0):
+            repo_path = process_repo(
+                "repo", f"http://127.0.0.1:{server.server_address[1]}/repo.tar.gz", tmp_path / "src", metrics=metrics,
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert all((repo_path / name).read_text() == content for name, content in files.items())
+    assert FlakyRangeHandler.ranges == [None, f"bytes={len(FlakyRangeHandler.body) // 2}-"]
+    assert metrics.bytes_downloaded == len(FlakyRangeHandler.body)
+    assert metrics.retries == 1
+
+
+def test_download_restarts_without_content_length(tmp_path):
+    """
+    Tests that an interrupted download without a Content-Length starts over rather than being resumed, as the
+    resumed download couldn't be verified.
+    """
+    files = {f"pkg/file{i}": os.urandom(64 * 1024).hex() for i in range(4)}
+    tarball = make_tarball(tmp_path / "repo.tar.gz", "owner-repo-abc1234", files)
+    handler = type("ChunkedHandler", (FlakyRangeHandler,), {"body": tarball.read_bytes(), "chunked": True, "ranges": []})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    metrics = RepoMetrics("ros1", "repo")
+    try:
+        with mock.patch("tailor_distro.pull_distro_repositories.backoff_delay", return_value=0):
+            repo_path = process_repo(
+                "repo", f"http://127.0.0.1:{server.server_address[1]}/repo.tar.gz", tmp_path / "src", metrics=metrics,
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert all((repo_path / name).read_text() == content for name, content in files.items())
+    assert handler.ranges == [None, None]
+    assert metrics.bytes_downloaded == len(handler.body)
+    assert metrics.retries == 1
+
+
+def manifest(name):
+    return f"<package format='2'><name>{name}</name><version>0.0.0</version><description>d</description>" \
+        "<maintainer email='maintainer@example.com'>m</maintainer><license>BSD</license></package>"
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_process_repo_extracts_only_whitelisted_packages(tmp_path, http_root, cached):
+    """
+    Tests that packages outside the whitelist are never written to disk, while repository level files are, whether
+    the tarball is streamed, downloaded into the cache or extracted from it.
+    """
+    root, url = http_root
+    make_tarball(root / "repo.tar.gz", "owner-repo-abc1234", {
+        "README.md": "readme",
+        "wanted/package.xml": manifest("wanted"),
+        "wanted/src/main.cpp": "",
+        "unwanted_dir/package.xml": manifest("unwanted"),
+        "unwanted_dir/src/main.cpp": "",
+    })
+    cache = LocalTarballCache(tmp_path / "cache") if cached else None
+
+    written = []
+    makefile = tarfile.TarFile.makefile
+    makedir = tarfile.TarFile.makedir
+
+    def record(original):
+        def wrapper(self, member, targetpath):
+            written.append(member.name)
+            return original(self, member, targetpath)
+        return wrapper
+
+    with mock.patch.object(tarfile.TarFile, "makefile", record(makefile)), \
+            mock.patch.object(tarfile.TarFile, "makedir", record(makedir)):
+        for attempt in ["download", "cache hit"] if cached else ["download"]:
+            written.clear()
+            metrics = RepoMetrics("ros1", "repo")
+            repo_path = process_repo("repo", f"{url}/repo.tar.gz", tmp_path / "src", "owner", "abc1234", cache,
+                                     whitelist=["wanted"], metrics=metrics)
+            assert (repo_path / "README.md").exists()
+            assert (repo_path / "wanted" / "src" / "main.cpp").exists()
+            assert "wanted/src/main.cpp" in written
+            assert not [name for name in written if name.startswith("unwanted_dir")], attempt
+
+            assert metrics.extracted_bytes == len("readme") + len(manifest("wanted"))
+            assert (metrics.packages_kept, metrics.packages_pruned, metrics.retries) == (1, 1, 0)
+
+    assert metrics.bytes_downloaded == (0 if cached else (root / "repo.tar.gz").stat().st_size)
+
+
+def test_process_repo_leaves_out_excluded_files(tmp_path, http_root):
+    """
+    Tests that files matching the recipe exclude globs are never written to disk.
+    """
+    root, url = http_root
+    make_tarball(root / "repo.tar.gz", "owner-repo-abc1234", {
+        "pkg/package.xml": manifest("pkg"),
+        "pkg/src/main.cpp": "",
+        "pkg/test/data/recording.bag": "bag",
+        "pkg/docs/index.md": "docs",
+        "docs/index.md": "docs",
+    })
+    excludes = source_excludes({"global": ["*.bag"], "repositories": {"repo": ["docs"], "other": ["src"]}}, "repo")
+
+    repo_path = process_repo("repo", f"{url}/repo.tar.gz", tmp_path / "src", excludes=excludes)
+    assert sorted(p.relative_to(repo_path).as_posix() for p in repo_path.rglob("*") if p.is_file()) == [
+        "pkg/package.xml", "pkg/src/main.cpp",
+    ]
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """
+    Tests that the cache stays within its size bound by evicting the least recently used tarballs.
+    """
+    source = tmp_path / "tarball"
+    source.write_bytes(b"x" * 100)
+    cache = LocalTarballCache(tmp_path / "cache", max_bytes=250)
+
+    for i, sha in enumerate(["a", "b"]):
+        path = cache.put("owner", "repo", sha, source)
+        os.utime(path, (i, i))
+
+    # Reading 'a' makes 'b' the least recently used tarball
+    assert cache.get("owner", "repo", "a") is not None
+    cache.put("owner", "repo", "c", source)
+
+    assert cache.get("owner", "repo", "b") is None
+    assert cache.get("owner", "repo", "a") is not None
+    assert cache.get("owner", "repo", "c") is not None
+
+
+def test_limiter_backs_off_when_throttled():
+    """
+    Tests that rate-limit headers halve the download concurrency and pause new downloads.
+    """
+    response = requests.Response()
+    response.status_code = 403
+    response.headers["X-RateLimit-Remaining"] = "0"
+    response.headers["X-RateLimit-Reset"] = str(time.time() + 60)
+    assert 55 < throttle_delay(response) <= 60
+
+    response.headers = requests.structures.CaseInsensitiveDict({"Retry-After": "7"})
+    assert throttle_delay(response) == 7
+
+    limiter = AdaptiveLimiter(initial=8, minimum=2)
+    limiter.throttle(0.2)
+    assert limiter.limit == 4
+
+    start = time.monotonic()
+    with limiter.slot():
+        pass
+    assert time.monotonic() - start >= 0.15
+
+
+class FakeRequester:
+    """
+    Answers tarball queries, reporting a rate limit cost of 2 for queries of more than 10 repositories.
+    Refs starting with a digit are tags.
+    """
+    def __init__(self):
+        self.batch_sizes = []
+
+    def graphql_query(self, query, variables):
+        aliases = re.findall(
+            r"(r\d+): repository\(owner: \"(\w+)\", name: \"(\w+)\"\) \{\s*version: object\(expression:\"([^\"]+)\"\)",
+            query,
+        )
+        self.batch_sizes.append(len(aliases))
+        data = {
+            alias: {
+                "version": {"__typename": "Commit", "oid": f"{name}sha", "tarballUrl": f"https://{owner}/{name}"},
+                "tag": {"name": ref} if ref[0].isdigit() else None,
+            }
+            for alias, owner, name, ref in aliases
+        }
+        cost = 2 if len(aliases) > 10 else 1
+        data["rateLimit"] = {"cost": cost, "remaining": 5000, "resetAt": "2026-01-01T00:00:00Z"}
+        return {}, {"data": data}
+
+
+def test_retrieve_tarballs_sizes_chunks_from_cost():
+    """
+    Tests that every repository is resolved and that chunks shrink when a query costs more than one point.
+    """
+    requester = FakeRequester()
+    client = mock.Mock(_Github__requester=requester)
+    urls = [f"https://github.com/owner/repo{i}" for i in range(50)]
+
+    repos = list(retrieve_tarballs(urls, ["main"] * len(urls), client, chunk=20))
+
+    assert sorted(repo.name for repo in repos) == sorted(f"repo{i}" for i in range(50))
+    assert all(repo.sha == f"{repo.name}sha" for repo in repos)
+    assert requester.batch_sizes[0] == 20
+    assert max(requester.batch_sizes[1:]) == 10
+
+
+def test_retrieve_tarballs_caches_tags(tmp_path):
+    """
+    Tests that tags are only resolved once across pulls, while branches are resolved every time.
+    """
+    requester = FakeRequester()
+    client = mock.Mock(_Github__requester=requester)
+    urls = ["https://github.com/owner/tagged", "https://github.com/owner/branch"]
+
+    for _ in range(2):
+        ref_cache = RefCache(tmp_path / "refs.json")
+        repos = list(retrieve_tarballs(urls, ["1.0.0", "main"], client, ref_cache=ref_cache))
+        assert {repo.name: repo.sha for repo in repos} == {"tagged": "taggedsha", "branch": "branchsha"}
+
+    assert requester.batch_sizes == [2, 1]
+    assert ref_cache.hits == 1
+    assert RefCache(tmp_path / "refs.json", max_age=-1).get("owner", "tagged", "1.0.0") is None
+
+
+def test_prefetch_interleaves_sources():
+    """
+    Tests that items of a fast source are available before a slow source finishes.
+    """
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+
+    def slow():
+        slow_started.set()
+        release_slow.wait(5)
+        yield "slow"
+
+    items = prefetch([slow(), iter(["fast1", "fast2"])])
+    assert [next(items), next(items)] == ["fast1", "fast2"]
+    assert slow_started.is_set()
+    release_slow.set()
+    assert list(items) == ["slow"]
+
+
+def test_sync_replaces_only_changed_repositories(tmp_path, http_root):
+    """
+    Tests that a sync leaves repositories at an unchanged SHA untouched and swaps in changed ones.
+    """
+    root, url = http_root
+    new = manifest("changed").replace("0.0.0", "1.0.0")
+    make_tarball(root / "changed.tar.gz", "owner-changed-new", {"package.xml": new})
+    src_dir = tmp_path / "src"
+    previous = {}
+    for name in ["changed", "unchanged"]:
+        (src_dir / "ros1" / name / name).mkdir(parents=True)
+        (src_dir / "ros1" / name / name / "package.xml").write_text(manifest(name))
+        previous[name] = {"repo": name, "sha": "old", "path": str(src_dir / "ros1" / name / name), "whitelist": None}
+
+    pulls = [
+        RepoPull("ros1", RepoInformation("owner", "changed", True, "new", f"{url}/changed.tar.gz")),
+        RepoPull("ros1", RepoInformation("owner", "unchanged", True, "old", f"{url}/missing.tar.gz")),
+    ]
+    pulled = pull_repositories(pulls, src_dir, previous={"ros1": previous})
+
+    assert pulled == {"ros1": {"changed", "unchanged"}}
+    assert (src_dir / "ros1" / "changed" / "changed" / "package.xml").read_text() == new
+    assert (src_dir / "ros1" / "unchanged" / "unchanged" / "package.xml").read_text() == manifest("unchanged")
+    assert not list((src_dir / "ros1" / "changed").glob(".*"))
+    log = load_jsonl(src_dir / "ros1" / "ros1_repositories_data.jsonl")
+    assert {name: info["sha"] for name, info in log.items()} == {"changed": "new", "unchanged": "old"}
+    index = load_package_index(src_dir / "ros1" / "ros1_package_index.jsonl")
+    assert {entry["name"]: entry["version"] for entry in index} == {"changed": "1.0.0", "unchanged": "0.0.0"}
+
+
+def test_pull_writes_package_index(tmp_path, http_root):
+    """
+    Tests that the package index lists the packages catkin_pkg would find, without nested, ignored or hidden ones.
+    """
+    root, url = http_root
+    make_tarball(root / "repo.tar.gz", "owner-repo-abc1234", {
+        "pkg_a/package.xml": manifest("pkg_a"),
+        "pkg_a/nested/package.xml": manifest("nested"),
+        "ignored/CATKIN_IGNORE": "",
+        "ignored/pkg_b/package.xml": manifest("pkg_b"),
+        ".hidden/package.xml": manifest("hidden"),
+        "group/pkg_c/package.xml": manifest("pkg_c").replace("</license>", "</license><depend>pkg_a</depend>"),
+    })
+    src_dir = tmp_path / "src"
+
+    pulls = [RepoPull("ros1", RepoInformation("owner", "repo", True, "abc1234", f"{url}/repo.tar.gz"))]
+    pull_repositories(pulls, src_dir)
+
+    index = {entry["name"]: entry for entry in load_package_index(src_dir / "ros1" / "ros1_package_index.jsonl")}
+    assert {name: entry["path"] for name, entry in index.items()} == {
+        "pkg_a": "repo/repo/pkg_a",
+        "pkg_c": "repo/repo/group/pkg_c",
+    }
+    assert index["pkg_c"]["depends"]["exec_depends"] == [{"name": "pkg_a", "condition": None}]
+    assert set(packages_from_index(src_dir / "ros1" / "ros1_package_index.jsonl")) == {
+        "repo/repo/pkg_a", "repo/repo/group/pkg_c",
+    }
+
+
+def test_pull_links_repositories_shared_between_distributions(tmp_path, http_root):
+    """
+    Tests that a repository pulled by two distributions at the same SHA is fetched once and hard linked,
+    with the whitelist of each distribution applied.
+    """
+    root, url = http_root
+    make_tarball(root / "repo.tar.gz", "owner-repo-abc1234", {
+        "wanted/package.xml": manifest("wanted"),
+        "unwanted/package.xml": manifest("unwanted"),
+    })
+    src_dir = tmp_path / "src"
+    report = PullReport()
+
+    pulls = [
+        RepoPull("ros1", RepoInformation("owner", "repo", True, "abc1234", f"{url}/repo.tar.gz")),
+        # Fetching the second copy would fail
+        RepoPull("ros2", RepoInformation("owner", "repo", True, "abc1234", f"{url}/missing.tar.gz"), ["wanted"]),
+    ]
+    pull_repositories(pulls, src_dir, report=report)
+
+    ros1, ros2 = src_dir / "ros1" / "repo" / "repo", src_dir / "ros2" / "repo" / "repo"
+    assert (ros1 / "unwanted" / "package.xml").exists()
+    assert not (ros2 / "unwanted").exists()
+    assert (ros1 / "wanted" / "package.xml").stat().st_ino == (ros2 / "wanted" / "package.xml").stat().st_ino
+    assert [entry["name"] for entry in load_package_index(src_dir / "ros2" / "ros2_package_index.jsonl")] == ["wanted"]
+    assert report.repo("ros2", "repo").status == "linked"
+
+
+def test_graph_closure_limits_repositories():
+    """
+    Tests that only the repositories of the root packages' closure are needed, plus those of new dependencies.
+    """
+    graph = {"ros1": {
+        "app": {"path": "app_repo/app_repo/app", "source_depends": ["b:lib", "r:msgs"]},
+        "lib": {"path": "lib_repo/lib_repo", "source_depends": []},
+        "msgs": {"path": "common/common/msgs", "source_depends": []},
+        "tool": {"path": "tool_repo/tool_repo", "source_depends": ["r:msgs"]},
+        "plugin": {"path": "plugin_repo/plugin_repo", "source_depends": [], "member_of_groups": ["plugins"]},
+    }}
+    recipes = {
+        "common": {"distributions": {"ros1": {}, "ros2": {}}},
+        "flavours": {
+            "robot": {"distributions": {"ros1": {"root_packages": ["app"]}, "ros2": {"root_packages": []}}},
+        },
+    }
+    assert needed_repositories(graph, recipes) == {"ros1": {"app_repo", "lib_repo", "common"}, "ros2": None}
+
+    recipes["flavours"]["robot"]["distributions"]["ros1"]["root_packages"] = ["unknown"]
+    assert needed_repositories(graph, recipes) is None
+
+    def depends(*names):
+        return {"exec_depends": [{"name": name, "condition": None} for name in names]}
+
+    index = [
+        {"name": "app", "depends": depends("lib", "tool", "boost", "new_repo")},
+        {"name": "lib", "depends": depends()},
+    ]
+    repo_names = {"app_repo", "lib_repo", "common", "tool_repo", "new_repo", "plugin_repo"}
+    requested = {"app_repo", "lib_repo"}
+    assert missing_repositories(index, graph["ros1"], repo_names, requested, {}, {"boost"}) == {
+        "tool_repo", "new_repo",
+    }
+
+    # Dependencies that are neither known packages, repositories nor system dependencies can be anywhere
+    assert missing_repositories(index, graph["ros1"], repo_names, requested, {}, set()) is None
+
+    index[1]["depends"] = {"group_depends": [{"name": "plugins", "condition": None}]}
+    assert missing_repositories(index, graph["ros1"], repo_names, requested, {}, {"boost"}) == {
+        "tool_repo", "new_repo", "plugin_repo",
+    }
+    index[1]["depends"] = {"group_depends": [{"name": "new_plugins", "condition": None}]}
+    assert missing_repositories(index, graph["ros1"], repo_names, requested, {}, {"boost", "new_plugins"}) is None
+
+
+def git(cwd, *args):
+    return subprocess.run(
+        ["git", "-c", "user.name=Tailor", "-c", "user.email=tailor@example.com", *args],
+        cwd=cwd, check=True, capture_output=True, text=True,
+    ).stdout.strip()
+
+
+def test_git_backend_fetches_into_bare_cache(tmp_path):
+    """
+    Tests that repositories outside GitHub are resolved with git and fetched through the bare repository cache.
+    """
+    upstream = tmp_path / "upstream" / "my_repo"
+    upstream.mkdir(parents=True)
+    git(upstream, "init", "--quiet", "--initial-branch", "main")
+    (upstream / "package.xml").write_text("v1")
+    git(upstream, "add", "-A")
+    git(upstream, "commit", "--quiet", "-m", "v1")
+    git(upstream, "tag", "-a", "1.0.0", "-m", "release")
+    first = git(upstream, "rev-parse", "HEAD")
+    (upstream / "package.xml").write_text("v2")
+    git(upstream, "commit", "--quiet", "-am", "v2")
+
+    backend = GitBackend(tmp_path / "git-cache")
+    url = upstream.as_uri()
+    assert backend.handles(url)
+
+    repos = {repo.sha: repo for repo in backend.resolve([url, url], ["1.0.0", "main"])}
+    assert set(repos) == {first, git(upstream, "rev-parse", "HEAD")}
+    assert all(repo.name == "my_repo" for repo in repos.values())
+
+    repo_path = backend.fetch(repos[first], tmp_path / "src", None)
+    assert repo_path == tmp_path / "src" / "my_repo" / "my_repo"
+    assert (repo_path / "package.xml").read_text() == "v1"
+    assert backend.bare_repo(url).exists()
+
+
+def test_git_backend_resolves_exact_refs(tmp_path):
+    """
+    Tests that refs resolve to the branch or tag of exactly that name, not to one sharing its suffix.
+    """
+    upstream = tmp_path / "upstream" / "my_repo"
+    upstream.mkdir(parents=True)
+    git(upstream, "init", "--quiet", "--initial-branch", "main")
+    (upstream / "package.xml").write_text("main")
+    git(upstream, "add", "-A")
+    git(upstream, "commit", "--quiet", "-m", "main")
+    main = git(upstream, "rev-parse", "HEAD")
+    git(upstream, "checkout", "--quiet", "-b", "feature/main")
+    (upstream / "package.xml").write_text("feature")
+    git(upstream, "commit", "--quiet", "-am", "feature")
+    feature = git(upstream, "rev-parse", "HEAD")
+    git(upstream, "tag", "-a", "release", "-m", "release")
+    git(upstream, "branch", "release", main)
+
+    backend = GitBackend(tmp_path / "git-cache")
+    url = upstream.as_uri()
+    assert backend._resolve_one(url, "main").sha == main
+    assert backend._resolve_one(url, "feature/main").sha == feature
+    assert backend._resolve_one(url, "refs/heads/main").sha == main
+    # Tags take precedence over branches of the same name, and resolve to the commit they point to
+    assert backend._resolve_one(url, "release").sha == feature
+    with pytest.raises(RuntimeError):
+        backend._resolve_one(url, "ain")
@@ -0,0 +1,35 @@
+import json
+
+from unittest import mock
+
+import pytest
+
+from tailor_distro.source_image import create_source_image, manifest_path, mount_source_image
+
+
+def fake_mksquashfs(command, check):
+    # mksquashfs <src> <image> ...
+    with open(command[2], "wb") as f:
+        f.write(b"image")
+
+
+def test_source_image_manifest_lists_repositories(tmp_path):
+    """
+    Tests that the source image manifest lists the repositories of every distribution, and protects the image.
+    """
+    src_dir = tmp_path / "src"
+    (src_dir / "ros1").mkdir(parents=True)
+    (src_dir / "ros1" / "ros1_repositories_data.jsonl").write_text(
+        json.dumps({"owner": "owner", "repo": "repo", "sha": "abc1234", "path": "x", "whitelist": None}) + "\n"
+    )
+    image = tmp_path / "src.squashfs"
+
+    with mock.patch("tailor_distro.source_image.subprocess.run", side_effect=fake_mksquashfs) as run:
+        manifest = create_source_image(src_dir, image)
+    assert run.call_args[0][0][:3] == ["mksquashfs", str(src_dir), str(image)]
+    assert manifest["distributions"] == {"ros1": {"repo": {"owner": "owner", "sha": "abc1234"}}}
+    assert json.loads(manifest_path(image).read_text()) == manifest
+
+    image.write_bytes(b"corrupted")
+    with pytest.raises(RuntimeError):
+        mount_source_image(image, tmp_path / "workspace" / "src")